@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Measures the import cost of each django_adelaidex.lti module, in a fresh interpreter
+after django.setup(), and lists the heavy third party modules it pulls in.
+
+    python benchmarks/import_time.py [--repeat 5] [--check]
+
+On interpreters which support `python -X importtime` (3.7+), the cumulative time it
+reports is used; otherwise the import is timed directly.
+
+With --check, exits with an error if any module loads the LTI verification stack
+(ims_lti_py, oauth2, httplib2), so startup regressions fail CI.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = (
+    'django_adelaidex.lti.models',
+    'django_adelaidex.lti.backends',
+    'django_adelaidex.lti.middleware',
+    'django_adelaidex.lti.views',
+    'django_adelaidex.lti.context_processors',
+    'django_adelaidex.lti.urls',
+    'django_adelaidex.lti.admin',
+)
+
+# Modules which are expensive to load, and only needed to verify launches
+HEAVY_MODULES = ('ims_lti_py', 'oauth2', 'httplib2', 'lxml')
+
+CHILD = '''
+import json, os, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_adelaidex.lti.tests.settings')
+import django
+django.setup()
+before = set(sys.modules)
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+loaded = sorted(name for name in set(sys.modules) - before if sys.modules[name] is not None)
+print(json.dumps({'seconds': elapsed, 'modules': loaded}))
+'''
+
+
+def supports_importtime():
+    return sys.version_info >= (3, 7)
+
+
+def importtime_seconds(stderr, module):
+    '''Return the cumulative import time of module from `-X importtime` output.'''
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and line.rstrip().endswith(' ' + module):
+            fields = line[len('import time:'):].split('|')
+            try:
+                return int(fields[1]) / 1e6
+            except (IndexError, ValueError):
+                pass
+    return None
+
+
+def measure(module):
+    '''Import module in a fresh interpreter, and return (seconds, heavy modules loaded).'''
+    command = [sys.executable]
+    if supports_importtime():
+        command += ['-X', 'importtime']
+    command += ['-c', CHILD % module]
+    child = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    (stdout, stderr) = child.communicate()
+    if child.returncode:
+        raise RuntimeError('Could not import %s:\n%s' % (module, stderr))
+    result = json.loads(stdout.strip().splitlines()[-1])
+    seconds = result['seconds']
+    if supports_importtime():
+        seconds = importtime_seconds(stderr, module) or seconds
+    heavy = sorted(set(name.split('.')[0] for name in result['modules']
+                       if name.split('.')[0] in HEAVY_MODULES))
+    return (seconds, heavy)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Imports per module; the fastest is reported (default: %(default)s).')
+    parser.add_argument('--check', action='store_true',
+                        help='Fail if a module loads the LTI verification stack.')
+    args = parser.parse_args()
+
+    failures = []
+    for module in MODULES:
+        timings = []
+        heavy = []
+        for i in range(args.repeat):
+            (seconds, heavy) = measure(module)
+            timings.append(seconds)
+        print('%-42s %8.1f ms  %s' % (module, min(timings) * 1000, ' '.join(heavy)))
+        if heavy:
+            failures.append(module)
+
+    if args.check and failures:
+        print('\nThese modules load the LTI verification stack at import: %s' % ', '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+Compares the CPU time per launch of verifying the launch signature and reading the
+launch fields with ims_lti_py's DjangoToolProvider, against django_adelaidex.lti.oauth.
+
+    python benchmarks/launch_verify.py [--launches 2000] [--params 30]
+
+Both verifiers check the same signed launch requests, so the difference is the
+per-launch saving of the native verifier.  Needs ims_lti_py installed.
+'''
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_adelaidex.lti.tests.settings')
+
+import django
+django.setup()
+
+from django.test import RequestFactory
+from ims_lti_py.tool_provider import DjangoToolProvider
+
+from django_adelaidex.lti.oauth import LaunchFields, verify_request
+from django_adelaidex.lti.replay import sign_launch
+
+KEY = 'benchmark-key'
+SECRET = 'benchmark-secret'
+URL = 'http://testserver/lti/'
+
+
+def launch_requests(count, extra_params):
+    '''Return count signed launch requests, each with extra_params custom params.'''
+    factory = RequestFactory()
+    requests = []
+    for index in range(count):
+        params = {
+            'lti_message_type': 'basic-lti-launch-request',
+            'lti_version': 'LTI-1p0',
+            'resource_link_id': 'link',
+            'user_id': 'student%d' % index,
+            'lis_person_sourcedid': 'sis:%d' % index,
+            'lis_person_contact_email_primary': 'student%d@example.com' % index,
+            'lis_person_name_given': 'Student',
+            'lis_person_name_family': u'Number %d' % index,
+        }
+        for extra in range(extra_params):
+            params['custom_param_%d' % extra] = 'value %d' % extra
+        requests.append(factory.post('/lti/', sign_launch(URL, params, KEY, SECRET)))
+    for request in requests:
+        # parse the bodies up front, so neither verifier is charged for it
+        request.POST
+    return requests
+
+
+def tool_provider_launch(request):
+    tool_provider = DjangoToolProvider(KEY, SECRET, request.POST.dict())
+    assert tool_provider.is_valid_request(request)
+    return (tool_provider.lis_person_sourcedid, tool_provider.lis_person_contact_email_primary,
+            tool_provider.lis_person_name_family)
+
+
+def native_launch(request):
+    assert verify_request(request, SECRET)
+    launch = LaunchFields(request.POST.dict())
+    return (launch.lis_person_sourcedid, launch.lis_person_contact_email_primary,
+            launch.lis_person_name_family)
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run(verifier, requests, repeat):
+    '''Return the fastest of repeat runs of the verifier, in CPU seconds per launch.'''
+    best = None
+    for i in range(repeat):
+        start = cpu_time()
+        for request in requests:
+            verifier(request)
+        elapsed = (cpu_time() - start) / len(requests)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--launches', type=int, default=2000,
+                        help='Signed launches to verify (default: %(default)s).')
+    parser.add_argument('--params', type=int, default=30,
+                        help='Custom params per launch (default: %(default)s).')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per verifier; the fastest is reported (default: %(default)s).')
+    args = parser.parse_args()
+
+    requests = launch_requests(args.launches, args.params)
+    results = []
+    for (name, verifier) in (('DjangoToolProvider', tool_provider_launch),
+                             ('django_adelaidex.lti.oauth', native_launch)):
+        seconds = run(verifier, requests, args.repeat)
+        results.append(seconds)
+        print('%-28s %8.1f us/launch' % (name, seconds * 1e6))
+    if results[1]:
+        print('%-28s %8.1fx' % ('speedup', results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
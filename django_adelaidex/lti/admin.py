@@ -1,15 +1,54 @@
 from django.contrib import admin
-from django_adelaidex.lti.models import User, Cohort
+from django_adelaidex.lti.models import User, Cohort, CohortCredential, CohortMembership, CohortStats, LaunchRollup
+
+class CohortMembershipInline(admin.TabularInline):
+    model = CohortMembership
+    fields = ('cohort', 'first_name', 'is_staff',)
+    extra = 0
+
 
 class UserAdmin(admin.ModelAdmin):
     readonly_fields = ('password',)
     list_display = ('username', 'first_name', 'is_staff',)
     list_filter = ('is_staff', 'is_active',)
+    inlines = (CohortMembershipInline,)
 
 admin.site.register(User, UserAdmin)
 
 
+class CohortCredentialInline(admin.TabularInline):
+    model = CohortCredential
+    fields = ('oauth_secret', 'is_active', 'valid_from', 'valid_until',)
+    extra = 0
+
+
 class CohortAdmin(admin.ModelAdmin):
-    list_display = ('title', 'oauth_key','is_default',)
+    list_display = ('title', 'oauth_key','is_default', 'users', 'staff', 'active_users',)
+    list_select_related = ('stats',)
+    inlines = (CohortCredentialInline,)
+
+    def _stats(self, obj, counter):
+        try:
+            return getattr(obj.stats, counter)
+        except CohortStats.DoesNotExist:
+            return None
+
+    def users(self, obj):
+        return self._stats(obj, 'users')
+
+    def staff(self, obj):
+        return self._stats(obj, 'staff')
+
+    def active_users(self, obj):
+        return self._stats(obj, 'active_users')
+    active_users.short_description = 'active in last %d days' % CohortStats.ACTIVE_DAYS
 
 admin.site.register(Cohort, CohortAdmin)
+
+
+class LaunchRollupAdmin(admin.ModelAdmin):
+    list_display = ('hour', 'cohort', 'launches', 'unique_users', 'new_users', 'returning_users',)
+    list_filter = ('cohort',)
+    date_hierarchy = 'hour'
+
+admin.site.register(LaunchRollup, LaunchRollupAdmin)
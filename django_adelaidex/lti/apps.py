@@ -0,0 +1,22 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class LTIConfig(AppConfig):
+    name = 'django_adelaidex.lti'
+    label = 'lti'
+    verbose_name = 'LTI'
+
+    def ready(self):
+        '''Validate the LTI settings, build the settings snapshot used by the hot paths,
+           connect the pre-rendered page and ETag signals, and if
+           settings.ADELAIDEX_LTI_WARMUP, warm up the caches on the first request.'''
+        from django_adelaidex.lti.conf import get_config
+        get_config().settings_cohort()
+
+        # connect the pre-rendered page and ETag signals
+        from django_adelaidex.lti import conditional, pages
+
+        if getattr(settings, 'ADELAIDEX_LTI_WARMUP', False):
+            from django_adelaidex.lti.warmup import warm_up_on_first_request
+            warm_up_on_first_request()
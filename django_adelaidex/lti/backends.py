@@ -1,8 +1,10 @@
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.db.models import Q
 
-from ims_lti_py.tool_provider import DjangoToolProvider
 from time import time
 import sys
 import logging
@@ -10,17 +12,29 @@ import logging
 logger = logging.getLogger(__name__)
 
 from django.conf import settings
-from django_auth_lti.backends import LTIAuthBackend
-from django_adelaidex.lti.models import Cohort
+from django_adelaidex.lti import metrics, tracing
+from django_adelaidex.lti.conf import get_config
+from django_adelaidex.lti.models import CohortMembership, permission_cache_key
+from django_adelaidex.lti.oauth import LaunchFields, find_secret
+from django_adelaidex.lti.registry import cohort_registry
+from django_adelaidex.lti.throttling import LaunchThrottled, throttle_key, throttle_user
+from django_adelaidex.lti.singleflight import coalesce_settings, launch_flights
+from django_adelaidex.lti.validation import LaunchRejected, validate_launch
+from django_adelaidex.lti.events import record_launch
+from django_adelaidex.lti.deferred import DEFERRED_FIELDS, deferred_settings, defer_user_update
 
 
-class CohortLTIAuthBackend(LTIAuthBackend):
+class CohortLTIAuthBackend(ModelBackend):
 
     """
     By default, the ``authenticate`` method creates ``User`` objects for
     usernames that don't already exist in the database, and assigns them to an appropriate Cohort.
     Subclasses can disable this behavior by setting the ``create_unknown_user``
     attribute to ``False``.
+
+    Provides the same interface as django_auth_lti's ``LTIAuthBackend``, but verifies
+    launch signatures with django_adelaidex.lti.oauth instead of ims_lti_py, so it doesn't
+    load the LTI verification stack (ims_lti_py, oauth2, httplib2) at all.
     """
 
     # Create a User object if not already in the database?
@@ -28,98 +42,244 @@ class CohortLTIAuthBackend(LTIAuthBackend):
     # Username prefix for users without an sis source id
     unknown_user_prefix = "cuid:"
 
+    def get_default_username(self, launch, prefix=''):
+        '''Return a default username for launches without a lis_person_sourcedid.'''
+        username = launch.get_custom_param('canvas_user_login_id') or launch.user_id
+        return prefix + username
+
+    def clean_username(self, username):
+        return username
+
+    def get_all_permissions(self, user_obj, obj=None):
+        '''If ADELAIDEX_LTI_PERMISSION_CACHE_TTL is set, cache each user's permissions in
+           the Django cache for that many seconds, so permission checks don't query the
+           group and permission tables on every request.
+
+           Cached permissions are invalidated by the User and Group signals in models.py,
+           which only clear the cache of the process making the change.  So the default
+           cache must be shared by all processes (e.g. memcached or the database), and not
+           the process-local LocMemCache, or other processes keep stale permissions until
+           the TTL expires.'''
+        if not user_obj.is_active or user_obj.is_anonymous() or obj is not None:
+            return set()
+        ttl = getattr(settings, 'ADELAIDEX_LTI_PERMISSION_CACHE_TTL', 0)
+        if ttl and not hasattr(user_obj, '_perm_cache'):
+            membership = getattr(user_obj, 'active_membership', None)
+            key = permission_cache_key(user_obj.pk, membership.is_staff if membership else None)
+            perms = cache.get(key)
+            if perms is None:
+                perms = super(CohortLTIAuthBackend, self).get_all_permissions(user_obj, obj)
+                cache.set(key, perms, ttl)
+            user_obj._perm_cache = perms
+        return super(CohortLTIAuthBackend, self).get_all_permissions(user_obj, obj)
+
+    def _get_group_permissions(self, user_obj):
+        '''Users active in another of their cohorts have the staff group's permissions
+           only if they're staff in that cohort, whatever their role in their own.'''
+        perms = super(CohortLTIAuthBackend, self)._get_group_permissions(user_obj)
+        membership = getattr(user_obj, 'active_membership', None)
+        staff_group = get_config().staff_group_id()
+        if membership is None or not staff_group:
+            return perms
+        groups = Q(group__in=user_obj.groups.exclude(pk=staff_group))
+        if membership.is_staff:
+            groups |= Q(group=staff_group)
+        return Permission.objects.filter(groups).distinct()
+
     def authenticate(self, request):
+        '''Authenticate the LTI launch request, recording the outcome and duration.'''
+        start = time()
+        with tracing.span('lti.launch') as span:
+            try:
+                user = self.authenticate_launch(request)
+            except LaunchThrottled:
+                metrics.launches.inc(result='throttled')
+                span.set_attribute('result', 'throttled')
+                raise
+            except LaunchRejected:
+                metrics.launches.inc(result='rejected')
+                span.set_attribute('result', 'rejected')
+                raise
+            except PermissionDenied:
+                metrics.launches.inc(result='denied')
+                metrics.permission_denied.inc(source='backend')
+                span.set_attribute('result', 'denied')
+                raise
+            finally:
+                metrics.launch_duration.observe(time() - start)
+
+            result = 'success' if user else 'failure'
+            metrics.launches.inc(result=result)
+            span.set_attribute('result', result)
+            return user
+
+    def authenticate_launch(self, request):
 
         logger.info("about to begin authentication process")
 
-        request_key = request.POST.get('oauth_consumer_key', None)
+        # Reject malformed launches, and unknown keys, before any crypto or database work
+        postparams = request.POST.dict()
+        try:
+            cohort = validate_launch(postparams)
+        except LaunchRejected as rejected:
+            logger.error("Rejected launch: %s" % rejected)
+            raise
+        request_key = postparams['oauth_consumer_key']
+
+        # Refuse launches over the key's rate limit, before doing any more work
+        self.throttle(request, throttle_key(request_key, cohort), request_key)
+
+        # Duplicate submissions of the same signed launch share the first one's outcome
+        conf = coalesce_settings()
+        if conf['NONCE_TTL']:
+            nonce_key = u'%s:%s:%s' % (request_key, postparams['oauth_nonce'], postparams['oauth_signature'])
+            user = self.coalesce('nonce', nonce_key, conf['NONCE_TTL'], conf['WAIT'],
+                                 lambda: self.verify_launch(request, request_key, cohort, postparams))
+        else:
+            user = self.verify_launch(request, request_key, cohort, postparams)
+        return self.activate_cohort(user, cohort)
+
+    def throttle(self, request, retry_after, request_key, username=None):
+        '''Refuse the launch if it's over a rate limit.'''
+        if retry_after:
+            logger.warning("Throttled launch for key %s, user %s" % (request_key, username))
+            request.lti_throttled = retry_after
+            raise LaunchThrottled(retry_after)
+
+    def activate_cohort(self, user, cohort):
+        '''Set the user's active_membership of the launch cohort, adding it if needed, or
+           None if the launch cohort is the user's own, along with their staff role there.
+           The login then stores the active cohort in the user's session.'''
+        if user and not hasattr(user, 'active_membership'):
+            membership = None
+            if cohort and user.cohort_id and user.cohort_id != cohort.pk:
+                membership = CohortMembership.objects.join(user, cohort)
+            user.activate_membership(membership)
+        return user
+
+    def coalesce(self, kind, key, ttl, wait, launch):
+        '''Run launch() under a single-flight lock for the given key, so concurrent or
+           recent launches with the same key reuse its user instead of repeating the work.'''
+        launched = []
+
+        def run():
+            user = launch()
+            launched.append(user)
+            return user.pk if user else None
 
-        if request_key is None:
-            logger.error("Request doesn't contain an oauth_consumer_key; can't continue.")
-            return None
+        flight_key = u'%s:%s' % (kind, key)
+        (user_id, shared) = launch_flights.do(flight_key, run, ttl, wait)
+        if not shared:
+            return launched[0]
 
-        oauth_credentials = getattr(settings, 'LTI_OAUTH_CREDENTIALS', {})
-        cohorts = Cohort.objects.filter(oauth_key=request_key).all()
-        cohort = None
-        if cohorts:
-            cohort = cohorts[0]
+        UserModel = get_user_model()
+        try:
+            user = UserModel.objects.get(pk=user_id)
+        except UserModel.DoesNotExist:
+            launch_flights.forget(flight_key)
+            return launch()
 
-        # Let settings.LTI_OAUTH_CREDENTIALS secret override the database cohort secret
-        secret = oauth_credentials.get(request_key)
-        if secret is None and cohort:
-            secret = cohort.oauth_secret
+        logger.debug('reusing %s launch for user %s' % (kind, user_id))
+        metrics.coalesced_launches.inc(kind=kind)
+        return user
 
-        if secret is None:
+    def verify_launch(self, request, request_key, cohort, postparams):
+        '''Check the launch signature, and return the launching user.'''
+        # Accept the settings.LTI_OAUTH_CREDENTIALS secret, the cohort secret, or any of the
+        # cohort's valid credentials, trying the one which last verified a launch first
+        secrets = cohort_registry.secrets(request_key)
+
+        if not secrets:
             logger.error("Could not get a secret for key %s" % request_key)
             raise PermissionDenied
 
-        logger.debug('using key/secret %s/%s' % (request_key, secret))
-        tool_provider = DjangoToolProvider(request_key, secret, request.POST.dict())
+        logger.debug('using key %s with %d secrets' % (request_key, len(secrets)))
 
-        postparams = request.POST.dict()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('request is secure: %s' % request.is_secure())
+            for key in postparams:
+                logger.debug('POST %s: %s' % (key, postparams.get(key)))
 
-        logger.debug('request is secure: %s' % request.is_secure())
-        for key in postparams:
-            logger.debug('POST %s: %s' % (key, postparams.get(key)))
+            logger.debug('request abs url is %s' % request.build_absolute_uri())
 
-        logger.debug('request abs url is %s' % request.build_absolute_uri())
-
-        for key in request.META:
-            logger.debug('META %s: %s' % (key, request.META.get(key)))
+            for key in request.META:
+                logger.debug('META %s: %s' % (key, request.META.get(key)))
 
         logger.info("about to check the signature")
 
-        valid = False
+        secret = None
         try:
-            valid = tool_provider.is_valid_request(request)
+            secret = find_secret(request, secrets)
         except:
             logger.error(str(sys.exc_info()[0]))
-            valid = False
+            secret = None
         finally:
-            if not valid:
+            if secret is None:
                 logger.error("Invalid request: signature check failed.")
+                metrics.signature_failures.inc()
                 raise PermissionDenied
+        cohort_registry.prefer(request_key, secret)
 
         logger.info("done checking the signature")
 
-        logger.info("about to check the timestamp: %d" % int(tool_provider.oauth_timestamp))
-        if time() - int(tool_provider.oauth_timestamp) > 60 * 60:
-            logger.error("OAuth timestamp is too old.")
-            #raise PermissionDenied
-        else:
-            logger.info("timestamp looks good")
-
-        logger.info("done checking the timestamp")
-
         # (this is where we should check the nonce)
 
         # if we got this far, the user is good
-
-        user = None
+        launch = LaunchFields(postparams)
 
         # Retrieve username from LTI parameter or default to an overridable function return value
-        username = tool_provider.lis_person_sourcedid or self.get_default_username(
-            tool_provider, prefix=self.unknown_user_prefix)
+        username = launch.lis_person_sourcedid or self.get_default_username(
+            launch, prefix=self.unknown_user_prefix)
         username = self.clean_username(username)  # Clean it
 
-        email = tool_provider.lis_person_contact_email_primary
-        first_name = tool_provider.lis_person_name_given
-        last_name = tool_provider.lis_person_name_family
+        # Refuse launches over the user's rate limit, before writing to the user
+        self.throttle(request, throttle_user(request_key, username, cohort), request_key, username)
+
+        email = launch.lis_person_contact_email_primary
+        first_name = launch.lis_person_name_given
+        last_name = launch.lis_person_name_family
 
         logger.info("We have a valid username: %s" % username)
 
+        # LTI launch fields to store against the user
+        launch_fields = {}
+        if cohort:
+            launch_fields['cohort'] = cohort
+        if email:
+            launch_fields['email'] = email
+        # FIXME ADX-192: should really be using our own nickname field, instead
+        # of requiring first_name to be unique.
+        #if first_name:
+        #    launch_fields['first_name'] = first_name
+        if last_name:
+            launch_fields['last_name'] = last_name
+
+        # Repeated launches by the same user within the window share one outcome
+        conf = coalesce_settings()
+        window = conf['USER_WINDOW']
+        if window:
+            return self.coalesce('user', u'%s:%s:%d' % (request_key, username, time() // window),
+                                 window, conf['WAIT'],
+                                 lambda: self.update_user(username, launch_fields))
+        return self.update_user(username, launch_fields)
+
+    def update_user(self, username, launch_fields):
+        '''Find or create the named user, and store the launch fields against them.'''
+        user = None
+        created = False
         UserModel = get_user_model()
 
         # Note that this could be accomplished in one try-except clause, but
         # instead we use get_or_create when creating unknown users since it has
         # built-in safeguards for multiple threads.
         if self.create_unknown_user:
-            user, created = UserModel.objects.get_or_create(**{
+            user, created = UserModel.objects.get_or_create(defaults=launch_fields, **{
                 UserModel.USERNAME_FIELD: username,
             })
 
             if created:
                 logger.debug('authenticate created a new user for %s' % username)
+                metrics.user_writes.inc(result='created')
             else:
                 logger.debug('authenticate found an existing user for %s' % username)
 
@@ -131,20 +291,37 @@ class CohortLTIAuthBackend(LTIAuthBackend):
             except UserModel.DoesNotExist:
                 logger.debug('authenticate could not find user %s' % username)
                 # should return some kind of error here?
-                pass
-
-        # update the user
-        if cohort:
-            user.cohort = cohort
-        if email:
-            user.email = email
-        # FIXME ADX-192: should really be using our own nickname field, instead
-        # of requiring first_name to be unique.
-        #if first_name:
-        #    user.first_name = first_name
-        if last_name:
-            user.last_name = last_name
-        user.save()
-        logger.debug("updated the user record in the database")
+                return None
+
+        # Launches from another of the user's cohorts use the user's membership of it,
+        # rather than moving the user between cohorts
+        cohort = launch_fields.get('cohort')
+        if cohort and user.cohort_id and user.cohort_id != cohort.pk:
+            launch_fields = dict(launch_fields)
+            del launch_fields['cohort']
+        self.activate_cohort(user, cohort)
+
+        # update the user, along with the login timestamps, in a single query
+        changed = user.update_launch(**launch_fields)
+        record_launch(user, is_new=created)
+
+        # leave the non-critical fields for the deferred update worker, if enabled
+        if deferred_settings()['MODE']:
+            later = [name for name in changed if name in DEFERRED_FIELDS]
+            if later:
+                changed = [name for name in changed if name not in later]
+                defer_user_update(user.pk, dict((name, getattr(user, name)) for name in later))
+                logger.debug("deferred updating the user record: %s" % ', '.join(later))
+                metrics.user_writes.inc(result='deferred')
+                if not changed:
+                    return user
+
+        if changed:
+            user.save(update_fields=changed)
+            logger.debug("updated the user record in the database: %s" % ', '.join(changed))
+            metrics.user_writes.inc(result='updated')
+        else:
+            logger.debug("user record is up to date")
+            metrics.user_writes.inc(result='unchanged')
 
         return user
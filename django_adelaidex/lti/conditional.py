@@ -0,0 +1,126 @@
+'''
+Weak ETags and conditional GETs for the lti-entry and lti-user-profile pages, so an
+unchanged page reloaded in the LMS iframe costs a header check instead of a render.
+
+Enable with:
+
+    ADELAIDEX_LTI_CONDITIONAL_VIEWS = {
+        'ENABLED': True,
+        'TEMPLATE_VERSION': '',     # change on each deploy which changes the templates
+    }
+
+The ETag is derived from the user's id, nickname, time zone, active cohort and staff
+status, a marker which changes whenever the user, their CohortMemberships or any Cohort
+is saved, the template version, and the rest of the request the page shows: its path
+and query string, CSRF cookie and language.  The markers are kept in the Django cache,
+and saves which only touch last_login or last_launch, as each LTI launch does, leave
+them alone.
+'''
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import signals
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.utils.translation import get_language
+import hashlib
+import uuid
+
+from django_adelaidex.lti import metrics
+from django_adelaidex.lti.models import Cohort, CohortMembership, User
+
+# User fields which aren't shown on the pages
+UNRENDERED_FIELDS = set(('last_login', 'last_launch',))
+
+COHORTS_MARKER = 'cohorts'
+
+
+def conditional_settings():
+    '''Return settings.ADELAIDEX_LTI_CONDITIONAL_VIEWS, with defaults filled in.'''
+    conf = {
+        'ENABLED': False,
+        'TEMPLATE_VERSION': '',
+    }
+    conf.update(getattr(settings, 'ADELAIDEX_LTI_CONDITIONAL_VIEWS', {}))
+    return conf
+
+
+def marker_key(name):
+    return 'lti-etag:%s' % name
+
+
+def markers(*names):
+    '''Return the current marker for each name, starting new ones for any missing.'''
+    keys = [marker_key(name) for name in names]
+    found = cache.get_many(keys)
+    missing = dict((key, uuid.uuid4().hex) for key in keys if key not in found)
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return [found[key] for key in keys]
+
+
+def user_etag(request, user, template_name):
+    '''Return the (unquoted) ETag for the user's page, rendered from the template.'''
+    (user_marker, cohorts_marker) = markers('user:%s' % user.pk, COHORTS_MARKER)
+    profile = getattr(user, 'active_membership', None) or user
+    parts = (
+        user.pk,
+        profile.first_name,
+        user.time_zone,
+        user.active_cohort_id(),
+        profile.is_staff,
+        user_marker,
+        cohorts_marker,
+        conditional_settings()['TEMPLATE_VERSION'],
+        template_name,
+        request.get_full_path(),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+        get_language(),
+    )
+    return hashlib.md5(u'\n'.join(u'%s' % part for part in parts).encode('utf-8')).hexdigest()
+
+
+def serves(request):
+    '''Return True if the request can be answered conditionally.'''
+    return (request.method in ('GET', 'HEAD') and request.user.is_authenticated() and
+            conditional_settings()['ENABLED'])
+
+
+def set_etag(response, etag):
+    response['ETag'] = 'W/%s' % quote_etag(etag)
+    # browsers must check back before reusing the page
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def not_modified_response(request, page, etag):
+    '''Return a 304 Not Modified if the request's If-None-Match matches the ETag,
+       or None if the page must be rendered.'''
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        metrics.conditional_gets.inc(page=page, result='modified')
+        return None
+    metrics.conditional_gets.inc(page=page, result='not_modified')
+    return set_etag(response, etag)
+
+
+@receiver(signals.post_save, sender=User, dispatch_uid='etag_user_save')
+@receiver(signals.post_delete, sender=User, dispatch_uid='etag_user_delete')
+def user_changed(sender, instance=None, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= UNRENDERED_FIELDS:
+        return
+    cache.delete(marker_key('user:%s' % instance.pk))
+
+
+@receiver(signals.post_save, sender=CohortMembership, dispatch_uid='etag_membership_save')
+@receiver(signals.post_delete, sender=CohortMembership, dispatch_uid='etag_membership_delete')
+def membership_changed(sender, instance=None, **kwargs):
+    cache.delete(marker_key('user:%s' % instance.user_id))
+
+
+@receiver(signals.post_save, sender=Cohort, dispatch_uid='etag_cohort_save')
+@receiver(signals.post_delete, sender=Cohort, dispatch_uid='etag_cohort_delete')
+def cohort_changed(sender, **kwargs):
+    '''Pages show their cohort's title.'''
+    cache.delete(marker_key(COHORTS_MARKER))
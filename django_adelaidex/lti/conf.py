@@ -0,0 +1,168 @@
+'''
+A read-only snapshot of the LTI app's main settings, validated and built once at startup
+by django_adelaidex.lti.apps.LTIConfig.ready(), so hot paths don't re-read and re-check
+django.conf.settings on every request.
+
+The snapshot is rebuilt when the settings are changed by override_settings in tests.
+'''
+from django.conf import settings
+from django.core import checks
+from django.core.cache import DEFAULT_CACHE_ALIAS
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from collections import namedtuple
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Settings captured in the snapshot
+SETTING_NAMES = (
+    'ADELAIDEX_LTI',
+    'LTI_OAUTH_CREDENTIALS',
+    'ADELAIDEX_LTI_DISQUS',
+    'ADELAIDEX_LTI_STAFF_MEMBER_GROUP',
+)
+
+
+class LTISettings(namedtuple('LTISettings', [
+        'oauth_credentials', 'link_text', 'login_url', 'enrol_url', 'persist_params',
+        'disqus_shortname', 'disqus_secret_key', 'disqus_public_key', 'disqus_default_email',
+        'staff_member_group', 'has_settings_cohort'])):
+    '''Validated, read-only LTI settings.  oauth_credentials is a tuple of (key, secret)
+       pairs.  Values looked up from the database are kept in the module's _resolved.'''
+    __slots__ = ()
+
+    @classmethod
+    def from_settings(cls, lti, oauth_credentials, disqus, staff_member_group):
+        for (name, value) in (('ADELAIDEX_LTI', lti),
+                              ('LTI_OAUTH_CREDENTIALS', oauth_credentials),
+                              ('ADELAIDEX_LTI_DISQUS', disqus)):
+            if not isinstance(value, dict):
+                raise ImproperlyConfigured('settings.%s must be a dict' % name)
+        if staff_member_group is not None and not isinstance(staff_member_group, (int, long, basestring)):
+            raise ImproperlyConfigured(
+                'settings.ADELAIDEX_LTI_STAFF_MEMBER_GROUP must be a Group id or name')
+
+        return cls(
+            oauth_credentials=tuple(oauth_credentials.items()),
+            link_text=lti.get('LINK_TEXT'),
+            login_url=lti.get('LOGIN_URL'),
+            enrol_url=lti.get('ENROL_URL'),
+            persist_params=tuple(lti.get('PERSIST_PARAMS', [])),
+            disqus_shortname=disqus.get('SHORTNAME', ''),
+            disqus_secret_key=disqus.get('SECRET_KEY', ''),
+            disqus_public_key=disqus.get('PUBLIC_KEY', ''),
+            disqus_default_email=disqus.get('DEFAULT_EMAIL', ''),
+            staff_member_group=staff_member_group,
+            has_settings_cohort=bool(lti or oauth_credentials),
+        )
+
+    def has_oauth_key(self, oauth_key):
+        return self.oauth_secret(oauth_key) is not None
+
+    def oauth_secret(self, oauth_key):
+        for (key, secret) in self.oauth_credentials:
+            if key == oauth_key:
+                return secret
+        return None
+
+    def staff_group_id(self):
+        '''Return the id of the ADELAIDEX_LTI_STAFF_MEMBER_GROUP, looking it up by name the
+           first time if need be.  Returns None if not configured, or if the named group
+           doesn't exist (yet), so saving users doesn't fail.  The lookup is kept until the
+           settings change, or a Group is saved or deleted.'''
+        group = self.staff_member_group
+        if not isinstance(group, basestring):
+            return group
+        if 'staff_group_id' not in _resolved:
+            from django.contrib.auth.models import Group
+            try:
+                _resolved['staff_group_id'] = Group.objects.get(name=group).pk
+            except Group.DoesNotExist:
+                logger.warning('settings.ADELAIDEX_LTI_STAFF_MEMBER_GROUP names a missing group: %s', group)
+                _resolved['staff_group_id'] = None
+        return _resolved['staff_group_id']
+
+    def settings_cohort(self):
+        '''Return the unsaved Cohort described by ADELAIDEX_LTI and LTI_OAUTH_CREDENTIALS,
+           or None if neither are set.  It's built once, and shared by all callers, so
+           don't change or save it.'''
+        if not self.has_settings_cohort:
+            return None
+        with _lock:
+            if 'settings_cohort' not in _resolved:
+                (oauth_key, oauth_secret) = (self.oauth_credentials or ((None, None),))[0]
+                # models.py uses this module, so import Cohort on first use
+                from django_adelaidex.lti.models import Cohort
+                _resolved['settings_cohort'] = Cohort(
+                    title=self.link_text,
+                    login_url=self.login_url,
+                    enrol_url=self.enrol_url,
+                    _persist_params="\n".join(self.persist_params),
+                    oauth_key=oauth_key,
+                    oauth_secret=oauth_secret,
+                    is_default=True,
+                )
+        return _resolved['settings_cohort']
+
+
+_config = None
+
+# Values resolved from the current snapshot, cleared along with it
+_resolved = {}
+_lock = threading.Lock()
+
+
+def forget_staff_group():
+    '''Look up the ADELAIDEX_LTI_STAFF_MEMBER_GROUP again on next use.'''
+    _resolved.pop('staff_group_id', None)
+
+
+def load_config():
+    '''Build and validate a new snapshot from django.conf.settings.'''
+    return LTISettings.from_settings(
+        lti=getattr(settings, 'ADELAIDEX_LTI', {}),
+        oauth_credentials=getattr(settings, 'LTI_OAUTH_CREDENTIALS', {}),
+        disqus=getattr(settings, 'ADELAIDEX_LTI_DISQUS', {}),
+        staff_member_group=getattr(settings, 'ADELAIDEX_LTI_STAFF_MEMBER_GROUP', None),
+    )
+
+
+def get_config():
+    '''Return the current settings snapshot.'''
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
+
+
+@receiver(setting_changed)
+def reset_config(sender, setting=None, **kwargs):
+    global _config
+    if setting in SETTING_NAMES:
+        _config = None
+        _resolved.clear()
+
+
+# Cache backends which aren't shared between processes
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+@checks.register()
+def check_permission_cache(app_configs, **kwargs):
+    '''Warn if permissions are cached in a cache other processes can't clear.'''
+    if not getattr(settings, 'ADELAIDEX_LTI_PERMISSION_CACHE_TTL', 0):
+        return []
+    backend = settings.CACHES.get(DEFAULT_CACHE_ALIAS, {}).get('BACKEND')
+    if backend not in LOCAL_CACHE_BACKENDS:
+        return []
+    return [checks.Warning(
+        'ADELAIDEX_LTI_PERMISSION_CACHE_TTL is set, but the default cache is %s' % backend,
+        hint='Permission changes only clear the cache of the process which made them, so '
+             'use a cache shared by all processes, such as memcached or the database cache.',
+        id='lti.W001',
+    )]
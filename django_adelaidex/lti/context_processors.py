@@ -1,4 +1,3 @@
-from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.safestring import mark_safe
 from django.contrib.auth import REDIRECT_FIELD_NAME
@@ -9,8 +8,11 @@ import json
 import time
 
 from django_adelaidex.lti.models import Cohort
+from django_adelaidex.lti import tracing
+from django_adelaidex.lti.conf import get_config
 
 
+@tracing.traced('lti.context.lti_settings')
 def lti_settings(request):
     '''
     Adds LTI-related settings to the context.
@@ -21,40 +23,48 @@ def lti_settings(request):
     else:
         lti = {'ADELAIDEX_LTI_LINK_TEXT': ''}
 
+    lti['ADELAIDEX_LTI_QUERY_STRING'] = lti_query_string(request)
+    lti['ADELAIDEX_LTI_NEXT_PAGE'] = lti_next_page(request)
+    return lti
+
+
+def lti_query_string(request):
+    '''Returns the request's query string, with a leading ?, or empty.'''
     query_string = request.META.get('QUERY_STRING', '')
     if query_string:
         query_string = '?%s' % query_string
-    lti['ADELAIDEX_LTI_QUERY_STRING'] = query_string
+    return query_string
+
 
+def lti_next_page(request):
+    '''Returns the page to continue to after login.'''
     next_param = request.GET.get(REDIRECT_FIELD_NAME)
     if next_param:
-        lti['ADELAIDEX_LTI_NEXT_PAGE'] = next_param
-    else:
-        lti['ADELAIDEX_LTI_NEXT_PAGE'] = reverse('lti-entry')
-
-    return lti
+        return next_param
+    return reverse('lti-entry')
 
 
+@tracing.traced('lti.context.disqus_settings')
 def disqus_settings(request):
     '''
     Adds DISQUS-related settings to the context.
     '''
-    disqus_settings = getattr(settings, 'ADELAIDEX_LTI_DISQUS', {})
-    return {'DISQUS_SHORTNAME': disqus_settings.get('SHORTNAME', '')}
+    return {'DISQUS_SHORTNAME': get_config().disqus_shortname}
 
 
+@tracing.traced('lti.context.disqus_sso')
 def disqus_sso(request):
     # ref https://github.com/disqus/DISQUS-API-Recipes/blob/master/sso/python/sso.py
     # create a JSON packet of our user data attributes
     
-    disqus_settings = getattr(settings, 'ADELAIDEX_LTI_DISQUS', {})
+    config = get_config()
 
     # Get the authenticated user's email, or use the default 
     email = None
     if request.user.is_authenticated():
         email = request.user.email
         if not email:
-            default_email = disqus_settings.get('DEFAULT_EMAIL', '')
+            default_email = config.disqus_default_email
             if default_email:
                 email = default_email.format(user=request.user)
 
@@ -72,7 +82,7 @@ def disqus_sso(request):
     # generate a timestamp for signing the message
     timestamp = int(time.time())
     # generate our hmac signature
-    sig = hmac.HMAC(disqus_settings.get('SECRET_KEY', ''), '%s %s' %
+    sig = hmac.HMAC(config.disqus_secret_key, '%s %s' %
                     (message, timestamp), hashlib.sha1).hexdigest()
  
     # return a script tag to insert the sso message
@@ -84,7 +94,7 @@ def disqus_sso(request):
         message=message,
         timestamp=timestamp,
         sig=sig,
-        pub_key=disqus_settings.get('PUBLIC_KEY', ''),
+        pub_key=config.disqus_public_key,
     )
 
     return {'DISQUS_SSO': mark_safe(script)}
@@ -0,0 +1,165 @@
+'''
+Deferred writes of the non-critical User fields updated by each LTI launch.
+
+With settings.ADELAIDEX_LTI_DEFERRED_UPDATES['MODE'] set, launches only write the
+fields needed to log in (the user and their cohort) inline, and buffer the rest in
+memory.  A background thread in each process writes the pending updates every INTERVAL
+seconds, or as soon as BATCH_SIZE users are pending, and at exit:
+
+  'thread': to the users.
+  'queue':  to the auth_user_deferred_update table, in one INSERT, to be applied to the
+            users by running `manage.py lti_deferred_updates` periodically.
+
+Updates for the same user are coalesced, so each user is written at most once per batch.
+'''
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+import atexit
+import json
+import logging
+import os
+import threading
+
+from django_adelaidex.lti import metrics
+from django_adelaidex.lti.models import DeferredUserUpdate
+
+logger = logging.getLogger(__name__)
+
+# User fields which can be written after the launch response
+DEFERRED_FIELDS = ('email', 'last_name', 'last_login', 'last_launch',)
+
+
+def deferred_settings():
+    '''Return settings.ADELAIDEX_LTI_DEFERRED_UPDATES, with defaults filled in.'''
+    conf = {
+        'MODE': None,
+        'BATCH_SIZE': 100,
+        'INTERVAL': 1,
+    }
+    conf.update(getattr(settings, 'ADELAIDEX_LTI_DEFERRED_UPDATES', {}))
+    return conf
+
+
+def merge_updates(pending, user_id, fields):
+    '''Merge the fields into the pending {user_id: {field: value}} updates, later values winning.'''
+    pending.setdefault(user_id, {}).update(fields)
+
+
+def apply_updates(updates):
+    '''Write the {user_id: {field: value}} updates, saving only the changed fields so the
+       User signals keep CohortStats up to date.  Returns the number of users written.'''
+    if not updates:
+        return 0
+    UserModel = get_user_model()
+    written = 0
+    with transaction.atomic():
+        for user in UserModel.objects.filter(pk__in=updates.keys()):
+            fields = updates[user.pk]
+            for (name, value) in fields.items():
+                setattr(user, name, value)
+            user.save(update_fields=fields.keys())
+            written += 1
+    metrics.deferred_updates.inc(written)
+    return written
+
+
+def queue_updates(updates):
+    '''Insert the {user_id: {field: value}} updates into the DeferredUserUpdate table, with
+       a single query.  Returns the number of users queued.'''
+    if not updates:
+        return 0
+    DeferredUserUpdate.objects.bulk_create([
+        DeferredUserUpdate(user_id=user_id, fields=json.dumps(fields, cls=DjangoJSONEncoder))
+        for (user_id, fields) in updates.items()])
+    return len(updates)
+
+
+class DeferredUpdates(object):
+    '''Buffers pending updates in memory, and writes them from a background thread.'''
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = os.getpid()
+
+    def add(self, user_id, fields):
+        conf = deferred_settings()
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked: the parent's thread and updates stay with the parent
+                self.pid = os.getpid()
+                self.pending = {}
+                self.thread = None
+            merge_updates(self.pending, user_id, fields)
+            if self.thread is None:
+                self.start()
+            if len(self.pending) >= conf['BATCH_SIZE']:
+                self.wakeup.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='lti-deferred-updates')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def flush(self):
+        '''Apply or queue the pending updates, and clear them.  Returns the number of users
+           written.  If they can't be written, they're returned to pending for the next flush.'''
+        with self.lock:
+            (updates, self.pending) = (self.pending, {})
+        try:
+            if deferred_settings()['MODE'] == 'queue':
+                return queue_updates(updates)
+            return apply_updates(updates)
+        except Exception:
+            with self.lock:
+                # updates added since the swap are newer, so they win
+                for (user_id, fields) in self.pending.items():
+                    merge_updates(updates, user_id, fields)
+                self.pending = updates
+            raise
+
+    def run(self):
+        while True:
+            self.wakeup.wait(deferred_settings()['INTERVAL'])
+            self.wakeup.clear()
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception:
+                logger.exception('Could not apply deferred user updates')
+
+
+deferred_updates = DeferredUpdates()
+atexit.register(deferred_updates.flush)
+
+
+def defer_user_update(user_id, fields):
+    '''Schedule the {field: value} changes to be written to the user later.'''
+    deferred_updates.add(user_id, fields)
+
+
+def process_queued_updates(batch_size=None):
+    '''Apply the updates queued in the DeferredUserUpdate table, a batch at a time.
+       Returns the number of users written.'''
+    if not batch_size:
+        batch_size = deferred_settings()['BATCH_SIZE']
+    UserModel = get_user_model()
+    written = 0
+    while True:
+        queued = list(DeferredUserUpdate.objects.order_by('id')[:batch_size])
+        if not queued:
+            break
+        updates = {}
+        for entry in queued:
+            fields = dict((name, UserModel._meta.get_field(name).to_python(value))
+                          for (name, value) in json.loads(entry.fields).items()
+                          if name in DEFERRED_FIELDS)
+            merge_updates(updates, entry.user_id, fields)
+        with transaction.atomic():
+            written += apply_updates(updates)
+            DeferredUserUpdate.objects.filter(id__in=[entry.id for entry in queued]).delete()
+    return written
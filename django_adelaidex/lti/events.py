@@ -0,0 +1,105 @@
+'''
+Buffered recording of successful LTI launches into the LaunchEvent table.
+
+Each process collects launches in memory, and writes them with a single bulk_create
+once BATCH_SIZE launches are waiting, or the oldest has waited INTERVAL seconds.  A timer
+thread writes them after INTERVAL seconds even if no more launches arrive.
+Enable with:
+
+    ADELAIDEX_LTI_LAUNCH_EVENTS = {
+        'ENABLED': True,
+        'BATCH_SIZE': 50,
+        'INTERVAL': 10,
+    }
+'''
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils import timezone
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django_adelaidex.lti.models import LaunchEvent
+
+logger = logging.getLogger(__name__)
+
+
+def events_settings():
+    '''Return settings.ADELAIDEX_LTI_LAUNCH_EVENTS, with defaults filled in.'''
+    conf = {
+        'ENABLED': False,
+        'BATCH_SIZE': 50,
+        'INTERVAL': 10,
+    }
+    conf.update(getattr(settings, 'ADELAIDEX_LTI_LAUNCH_EVENTS', {}))
+    return conf
+
+
+class LaunchEventBuffer(object):
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.oldest = None
+
+    def add(self, event):
+        conf = events_settings()
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked: the parent's events are the parent's to write
+                self.pid = os.getpid()
+                self.events = []
+            first = not self.events
+            if first:
+                self.oldest = time.time()
+            self.events.append(event)
+            due = (len(self.events) >= conf['BATCH_SIZE'] or
+                   time.time() - self.oldest >= conf['INTERVAL'])
+        if due:
+            self.flush()
+        elif first:
+            self.start_timer(conf['INTERVAL'])
+
+    def start_timer(self, interval):
+        '''Flush after the interval, in case no more launches arrive to do it.'''
+        timer = threading.Timer(interval, self.flush_from_timer)
+        timer.daemon = True
+        timer.start()
+
+    def flush_from_timer(self):
+        try:
+            self.flush()
+        finally:
+            # the timer thread's own connection
+            connection.close()
+
+    def flush(self):
+        '''Write the buffered events.  Returns the number written.'''
+        with self.lock:
+            (events, self.events) = (self.events, [])
+        if not events:
+            return 0
+        try:
+            LaunchEvent.objects.bulk_create(events)
+        except DatabaseError:
+            logger.exception('Could not record %d launch events' % len(events))
+            return 0
+        return len(events)
+
+
+launch_events = LaunchEventBuffer()
+atexit.register(launch_events.flush)
+
+
+def record_launch(user, is_new=False):
+    '''Buffer a LaunchEvent for the user's launch from their active cohort, if enabled.'''
+    if events_settings()['ENABLED']:
+        launch_events.add(LaunchEvent(
+            cohort_id=user.active_cohort_id(),
+            user_id=user.pk,
+            is_new=is_new,
+            launched_at=timezone.now(),
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from django_adelaidex.lti.models import CohortStats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalized CohortStats counters from auth_user.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+            help='Number of users to count per query (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        updated = CohortStats.objects.recompute(chunk_size=options['chunk_size'])
+        self.stdout.write('Recomputed stats for %d cohorts.' % updated)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from django_adelaidex.lti.deferred import process_queued_updates
+
+
+class Command(BaseCommand):
+    help = 'Applies the User updates queued by LTI launches with ADELAIDEX_LTI_DEFERRED_UPDATES["MODE"] = "queue".'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+            help='Number of queued updates to apply per transaction (default: BATCH_SIZE setting).')
+
+    def handle(self, *args, **options):
+        written = process_queued_updates(batch_size=options['batch_size'])
+        self.stdout.write('Applied deferred updates to %d users.' % written)
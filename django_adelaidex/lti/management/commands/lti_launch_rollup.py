@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from django_adelaidex.lti.models import LaunchRollup
+
+
+class Command(BaseCommand):
+    help = 'Summarises new LaunchEvents into the hourly per-cohort LaunchRollup table.'
+
+    def handle(self, *args, **options):
+        written = LaunchRollup.objects.rollup()
+        self.stdout.write('Rolled up launches for %d cohort hours.' % written)
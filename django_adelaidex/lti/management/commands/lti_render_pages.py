@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from django_adelaidex.lti.pages import render_pages
+
+
+class Command(BaseCommand):
+    help = 'Pre-renders the lti-403 and lti-inactive pages served to anonymous users.'
+
+    def handle(self, *args, **options):
+        rendered = render_pages()
+        self.stdout.write('Rendered %d pages.' % rendered)
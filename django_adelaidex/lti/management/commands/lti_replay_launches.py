@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_adelaidex.lti.models import Cohort
+from django_adelaidex.lti.replay import ClientSender, HTTPSender, read_launches, replay_launches
+
+
+class Command(BaseCommand):
+    help = ('Replays launches recorded by LaunchRecordingMiddleware, re-signed with a '
+            'cohort\'s oauth credentials, against a server or this project in-process.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('recording',
+            help='JSON lines file of recorded launches.')
+        parser.add_argument('--cohort', required=True,
+            help='oauth key of the Cohort whose credentials sign the launches.')
+        parser.add_argument('--url', default=None,
+            help='Base URL of the server to launch, e.g. http://localhost:8000 '
+                 '(default: in-process, using the Django test client).')
+        parser.add_argument('--rate', type=float, default=None,
+            help='Launches per second (default: the recorded timing).')
+        parser.add_argument('--speed', type=float, default=1.0,
+            help='Speed up the recorded timing by this factor (default: %(default)s).')
+        parser.add_argument('--concurrency', type=int, default=1,
+            help='Maximum launches in flight (default: %(default)s).')
+
+    def handle(self, *args, **options):
+        try:
+            cohort = Cohort.objects.get(oauth_key=options['cohort'])
+        except Cohort.DoesNotExist:
+            raise CommandError('No cohort with oauth key %s' % options['cohort'])
+
+        if options['url']:
+            sender = HTTPSender(options['url'])
+        else:
+            sender = ClientSender()
+
+        with open(options['recording']) as recording:
+            launches = list(read_launches(recording))
+
+        results = replay_launches(launches, sender, cohort.oauth_key, cohort.oauth_secret,
+                                  rate=options['rate'], speed=options['speed'],
+                                  concurrency=options['concurrency'])
+
+        statuses = {}
+        for (status, seconds) in results:
+            statuses[status] = statuses.get(status, 0) + 1
+        timings = sorted(seconds for (status, seconds) in results)
+
+        self.stdout.write('Replayed %d launches.' % len(results))
+        for status in sorted(statuses):
+            self.stdout.write('  status %s: %d' % (status, statuses[status]))
+        if timings:
+            for percentile in (50, 90, 99):
+                index = min(len(timings) - 1, len(timings) * percentile // 100)
+                self.stdout.write('  p%d: %.1f ms' % (percentile, timings[index] * 1000))
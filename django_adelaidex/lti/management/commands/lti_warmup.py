@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from django_adelaidex.lti.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = 'Preloads the LTI cohort, time zone, URL and template caches.'
+
+    def handle(self, *args, **options):
+        loaded = warm_up()
+        for name in sorted(loaded):
+            self.stdout.write('Warmed up %d %s.' % (loaded[name], name.replace('_', ' ')))
@@ -0,0 +1,389 @@
+'''
+Counters and histograms for the LTI app, exposed in Prometheus text format by
+django_adelaidex.lti.views.MetricsView.
+
+Each process keeps its own values in memory.  To aggregate across worker processes,
+set settings.ADELAIDEX_LTI_METRICS['DIRECTORY'] to a directory shared by the workers on
+one host: each process writes its values there within FLUSH_INTERVAL seconds of a change
+and when it exits, and the exposition sums them all.  The files of processes which have
+exited are merged into one archive file, so their counters keep counting up.
+'''
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import atexit
+import errno
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+_settings = None
+
+
+def metrics_settings():
+    '''Return settings.ADELAIDEX_LTI_METRICS, with defaults filled in.  Read once, since
+       every metric update checks it, and again when override_settings changes it.'''
+    global _settings
+    if _settings is None:
+        conf = {
+            'ENABLED': False,
+            'ALLOWED_IPS': [],
+            'DIRECTORY': None,
+            'FLUSH_INTERVAL': 5,
+        }
+        conf.update(getattr(settings, 'ADELAIDEX_LTI_METRICS', {}))
+        _settings = conf
+    return _settings
+
+
+@receiver(setting_changed)
+def reset_settings(sender, setting=None, **kwargs):
+    global _settings
+    if setting == 'ADELAIDEX_LTI_METRICS':
+        _settings = None
+
+
+class Metric(object):
+    '''Base class for metrics: values are stored per tuple of label values.'''
+    __metaclass__ = ABCMeta
+
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self, values):
+        '''Yield (suffix, labels, value) for the given {label values: value} dict.'''
+
+    @abstractmethod
+    def merge(self, total, value):
+        '''Return the total (None at first) with another process's value added.'''
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.registry.check_pid()
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+    def samples(self, values):
+        for key in sorted(values):
+            yield ('', key, values[key])
+
+    def merge(self, total, value):
+        return (total or 0) + value
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        '''Values are stored as [count per bucket..., count above buckets, sum].'''
+        key = self._key(labels)
+        with self.registry.lock:
+            self.registry.check_pid()
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for (index, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                index = len(self.buckets)
+            counts[index] += 1
+            counts[-1] += value
+        self.registry.maybe_flush()
+
+    def samples(self, values):
+        for key in sorted(values):
+            counts = values[key]
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                yield ('_bucket', key + (('le', bound),), cumulative)
+            yield ('_sum', key, counts[-1])
+            yield ('_count', key, cumulative)
+
+    def merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for (a, b) in zip(total, value)]
+
+
+class Registry(object):
+
+    # Where the values of processes which have exited are merged, in the shared directory
+    ARCHIVE_FILENAME = 'metrics-archive.json'
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.last_flush = time.time()
+        self.flushed_pid = None
+        self.flush_pending = False
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), **kwargs):
+        return self.register(Histogram(self, name, documentation, labelnames, **kwargs))
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Duplicate metric %s' % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def check_pid(self):
+        '''Forked children start from zero, so they don't double count the parent's values.
+           Must be called with the lock held.'''
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.flush_pending = False
+            for metric in self.metrics.values():
+                metric.values = {}
+
+    def reset(self):
+        with self.lock:
+            for metric in self.metrics.values():
+                metric.values = {}
+
+    def snapshot(self):
+        '''Return this process's values, in a form that can be stored as JSON.'''
+        with self.lock:
+            self.check_pid()
+            return dict((name, [[list(key), value] for (key, value) in metric.values.items()])
+                        for (name, metric) in self.metrics.items())
+
+    def filename(self, directory, pid=None):
+        return os.path.join(directory, 'metrics-%d.json' % (pid or os.getpid()))
+
+    def maybe_flush(self):
+        '''Flush if FLUSH_INTERVAL has passed since the last flush, or else make sure a
+           timer will, so a process which goes quiet still writes its last values.'''
+        conf = metrics_settings()
+        if not conf['DIRECTORY']:
+            return
+        wait = self.last_flush + conf['FLUSH_INTERVAL'] - time.time()
+        if wait <= 0:
+            self.flush(conf['DIRECTORY'])
+        elif not self.flush_pending:
+            self.flush_pending = True
+            self.start_timer(wait, conf['DIRECTORY'])
+
+    def start_timer(self, wait, directory):
+        timer = threading.Timer(wait, self.flush, [directory])
+        timer.daemon = True
+        timer.start()
+
+    def flush_at_exit(self):
+        directory = metrics_settings()['DIRECTORY']
+        if directory:
+            self.flush(directory)
+
+    def flush(self, directory):
+        '''Write this process's values to the shared directory.'''
+        self.last_flush = time.time()
+        self.flush_pending = False
+        filename = self.filename(directory)
+        if self.flushed_pid != os.getpid():
+            # a file already there is from an exited process which had our pid
+            self.flushed_pid = os.getpid()
+            if os.path.exists(filename):
+                self.archive(directory, [filename])
+        tmp_filename = '%s.tmp' % filename
+        try:
+            with open(tmp_filename, 'w') as tmp:
+                json.dump(self.snapshot(), tmp)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            logger.exception('Could not write metrics to %s' % filename)
+
+    def read(self, filename):
+        '''Return the snapshot stored in the file, or None if it can't be read.'''
+        try:
+            with open(filename) as stored:
+                return json.load(stored)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def archive(self, directory, filenames):
+        '''Merge the files of exited processes into the archive file and remove them, so
+           their counters keep their totals.  Holds a lock on the directory, so each file
+           is only merged once.'''
+        archive_filename = os.path.join(directory, self.ARCHIVE_FILENAME)
+        try:
+            with open(os.path.join(directory, 'metrics.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                snapshots = [self.read(archive_filename) or {}]
+                merged = []
+                for filename in filenames:
+                    snapshot = self.read(filename)
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+                        merged.append(filename)
+                if not merged:
+                    return
+                totals = self.merge(snapshots)
+                tmp_filename = '%s.tmp' % archive_filename
+                with open(tmp_filename, 'w') as tmp:
+                    json.dump(dict((name, [[list(key), value] for (key, value) in values.items()])
+                                   for (name, values) in totals.items()), tmp)
+                os.rename(tmp_filename, archive_filename)
+                for filename in merged:
+                    os.remove(filename)
+        except (IOError, OSError):
+            logger.exception('Could not archive metrics in %s' % directory)
+
+    def exited_filenames(self, filenames):
+        '''Return the per-process files whose process has exited.'''
+        exited = []
+        for filename in filenames:
+            match = PID_FILENAME.search(filename)
+            if match and not pid_running(int(match.group(1))):
+                exited.append(filename)
+        return exited
+
+    def merge(self, snapshots):
+        '''Return {metric name: {label values: value}}, summed across the snapshots.'''
+        totals = dict((name, {}) for name in self.metrics)
+        for snapshot in snapshots:
+            for (name, values) in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                for (key, value) in values:
+                    key = tuple(key)
+                    totals[name][key] = metric.merge(totals[name].get(key), value)
+        return totals
+
+    def collect(self):
+        '''Return {metric name: {label values: value}}, summed across all processes
+           which have written to the shared directory, including those which have exited.'''
+        snapshots = [self.snapshot()]
+        directory = metrics_settings()['DIRECTORY']
+        if directory:
+            filenames = glob.glob(os.path.join(directory, 'metrics-*.json'))
+            exited = self.exited_filenames(filenames)
+            if exited:
+                self.archive(directory, exited)
+                filenames = glob.glob(os.path.join(directory, 'metrics-*.json'))
+            own_filename = self.filename(directory)
+            for filename in filenames:
+                if filename == own_filename:
+                    continue
+                snapshot = self.read(filename)
+                if snapshot is None:
+                    logger.warning('Could not read metrics from %s' % filename)
+                    continue
+                snapshots.append(snapshot)
+        return self.merge(snapshots)
+
+    def expose(self):
+        '''Return all metrics in the Prometheus text exposition format.'''
+        directory = metrics_settings()['DIRECTORY']
+        if directory:
+            self.flush(directory)
+        lines = []
+        totals = self.collect()
+        for (name, metric) in self.metrics.items():
+            lines.append('# HELP %s %s' % (name, metric.documentation))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for (suffix, key, value) in metric.samples(totals[name]):
+                labels = list(zip(metric.labelnames, key[:len(metric.labelnames)]))
+                labels.extend(key[len(metric.labelnames):])
+                lines.append('%s%s%s %s' % (name, suffix, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+PID_FILENAME = re.compile(r'metrics-(\d+)\.json$')
+
+
+def pid_running(pid):
+    '''Return True if a process with the pid is running on this host.'''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value)) for (name, value) in labels)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+atexit.register(registry.flush_at_exit)
+
+launches = registry.counter('lti_launches_total',
+    'LTI launch requests, by result.', ['result'])
+launch_duration = registry.histogram('lti_launch_duration_seconds',
+    'Time spent authenticating LTI launches.')
+launch_rejections = registry.counter('lti_launch_rejections_total',
+    'LTI launches rejected before signature verification, by reason.', ['reason'])
+signature_failures = registry.counter('lti_signature_failures_total',
+    'LTI launches with an invalid OAuth signature.')
+permission_denied = registry.counter('lti_permission_denied_total',
+    'Requests denied access, by source.', ['source'])
+coalesced_launches = registry.counter('lti_coalesced_launches_total',
+    'Duplicate LTI launches which reused the outcome of an earlier launch, by kind.', ['kind'])
+user_writes = registry.counter('lti_user_writes_total',
+    'User records created, updated or left unchanged by LTI launches.', ['result'])
+deferred_updates = registry.counter('lti_deferred_updates_total',
+    'Users written by the deferred update worker or queue.')
+cohort_lookups = registry.counter('lti_cohort_cache_total',
+    'Cohort registry lookups, by whether the cohort was cached (hit) or loaded (miss).', ['result'])
+stale_cohorts = registry.counter('lti_cohort_stale_total',
+    'Cohorts served past their cache TTL, by reason: refreshing, or a database error.', ['reason'])
+anonymous_requests = registry.counter('lti_anonymous_requests_total',
+    'Requests from anonymous users.')
+page_cache = registry.counter('lti_page_cache_total',
+    'Pre-rendered page requests, by page and whether the page was already rendered.', ['page', 'result'])
+conditional_gets = registry.counter('lti_conditional_get_total',
+    'Conditional page GETs, by page and whether the page was modified.', ['page', 'result'])
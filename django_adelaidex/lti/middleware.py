@@ -1,8 +1,24 @@
 # https://docs.djangoproject.com/en/1.7/topics/i18n/timezones/#selecting-the-current-time-zone
 import pytz
 import threading
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
+from StringIO import StringIO
+from django.conf import settings
+from django.core.urlresolvers import resolve, Resolver404
+from django.http import HttpResponse
 from django.utils import timezone
-from django_adelaidex.lti.models import Cohort
+from django_adelaidex.lti.models import Cohort, activate_session_cohort
+from django_adelaidex.lti import metrics
+from django_adelaidex.lti.replay import launch_recorder
+
+logger = logging.getLogger(__name__)
 
 class TimezoneMiddleware(object):
     '''Use the currently-authenticated user's configured timezone
@@ -26,5 +42,139 @@ class AnonymousCohortMiddleware(object):
         user = request.user
         if user and not user.is_authenticated():
             '''Store current, default cohort against the user'''
+            metrics.anonymous_requests.inc()
             cohort = Cohort.objects.get_current(user)
             setattr(user, 'cohort', cohort)
+
+
+class ActiveCohortMiddleware(object):
+    '''Give users who last launched from one of their other cohorts their CohortMembership
+       of it, as user.active_membership, so the current cohort, nickname and staff role
+       (including user.is_staff, in memory) come from there.
+
+       Place after django.contrib.auth.middleware.AuthenticationMiddleware.'''
+
+    def process_request(self, request):
+        user = request.user
+        if user and user.is_authenticated():
+            activate_session_cohort(user, request.session)
+        return None
+
+
+class LaunchThrottleMiddleware(object):
+    '''Responds to LTI launches refused by CohortLTIAuthBackend's rate limits with
+       a plain 429 page, without rendering any templates.
+
+       Place after django_auth_lti.middleware.LTIAuthMiddleware.'''
+
+    content = ('<html><head><title>Too many requests</title></head><body>'
+               '<h1>Too many requests</h1>'
+               '<p>Please wait a moment, and then try again.</p>'
+               '</body></html>')
+
+    def process_request(self, request):
+        retry_after = getattr(request, 'lti_throttled', None)
+        if retry_after:
+            response = HttpResponse(self.content, status=429)
+            response['Retry-After'] = str(int(retry_after) + 1)
+            return response
+        return None
+
+
+class LaunchRecordingMiddleware(object):
+    '''Records a sanitized copy of LTI launch POSTs, for replay by
+       `manage.py lti_replay_launches`.  See django_adelaidex.lti.replay.
+
+       Place before django_auth_lti.middleware.LTIAuthMiddleware.'''
+
+    def process_request(self, request):
+        if request.method == 'POST' and request.POST.get('lti_message_type'):
+            launch_recorder.record(request)
+        return None
+
+
+class ProfilingMiddleware(object):
+    '''Profiles a sample of requests to the lti-* urls with cProfile, writing the
+       stats to .prof files and logging the top functions.
+
+       Configure with settings.ADELAIDEX_LTI_PROFILING; see profiling_settings().
+       Staff users (or anyone sending the configured TOKEN) can force a request to be
+       profiled by sending the HEADER.
+
+       Place after AuthenticationMiddleware, but before LTIAuthMiddleware, so that
+       launch authentication is included in the profile.'''
+
+    def process_request(self, request):
+        conf = profiling_settings()
+        if self.sampled(request, conf):
+            profiler = cProfile.Profile()
+            request.lti_profiler = profiler
+            profiler.enable()
+        return None
+
+    def process_response(self, request, response):
+        profiler = getattr(request, 'lti_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            del request.lti_profiler
+            self.save(request, profiler, profiling_settings())
+        return response
+
+    def sampled(self, request, conf):
+        header = request.META.get(conf['HEADER'])
+        if header is not None:
+            if conf['TOKEN'] and header == conf['TOKEN']:
+                return True
+            user = getattr(request, 'user', None)
+            return bool(user and user.is_authenticated() and user.is_staff)
+
+        if not conf['RATE'] or random.random() >= conf['RATE']:
+            return False
+        return self.url_name(request).startswith('lti-')
+
+    def url_name(self, request):
+        try:
+            return resolve(request.path_info).url_name or ''
+        except Resolver404:
+            return ''
+
+    def save(self, request, profiler, conf):
+        directory = conf['DIRECTORY']
+        url_name = self.url_name(request) or 'unknown'
+        now = time.time()
+        filename = os.path.join(directory, '%s.%06d-%s-%d.prof' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int((now % 1) * 1e6),
+            url_name, os.getpid()))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            profiler.dump_stats(filename)
+            self.rotate(directory, conf['MAX_FILES'])
+        except (IOError, OSError):
+            logger.exception('Could not write profile to %s' % filename)
+
+        summary = StringIO()
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.sort_stats('cumulative').print_stats(conf['TOP'])
+        logger.info('Profiled %s %s (%s):\n%s' % (
+            request.method, request.path, filename, summary.getvalue()))
+
+    def rotate(self, directory, max_files):
+        '''Remove the oldest profiles, leaving max_files.'''
+        profiles = sorted(glob.glob(os.path.join(directory, '*.prof')), key=os.path.getmtime)
+        for filename in profiles[:max(len(profiles) - max_files, 0)]:
+            os.remove(filename)
+
+
+def profiling_settings():
+    '''Return settings.ADELAIDEX_LTI_PROFILING, with defaults filled in.'''
+    conf = {
+        'RATE': 0,                          # fraction of lti-* requests to profile
+        'HEADER': 'HTTP_X_LTI_PROFILE',     # request.META key which forces profiling
+        'TOKEN': None,                      # HEADER value which forces profiling for non-staff
+        'DIRECTORY': os.path.join(tempfile.gettempdir(), 'lti-profiles'),
+        'MAX_FILES': 100,
+        'TOP': 20,                          # functions to log
+    }
+    conf.update(getattr(settings, 'ADELAIDEX_LTI_PROFILING', {}))
+    return conf
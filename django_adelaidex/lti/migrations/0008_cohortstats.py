@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0007_auto_20160121_1051'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CohortStats',
+            fields=[
+                ('cohort', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='lti.Cohort')),
+                ('users', models.IntegerField(default=0, verbose_name='users')),
+                ('staff', models.IntegerField(default=0, verbose_name='staff')),
+                ('active_users', models.IntegerField(default=0, help_text='Users who have logged in during the last 7 days.', verbose_name='active users')),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'auth_cohort_stats',
+                'verbose_name': 'cohort stats',
+                'verbose_name_plural': 'cohort stats',
+            },
+        ),
+    ]
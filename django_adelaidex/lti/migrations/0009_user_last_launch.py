@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0008_cohortstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='last_launch',
+            field=models.DateTimeField(blank=True, default=None, help_text='Time of the most recent LTI launch.', null=True, verbose_name='last launch'),
+        ),
+    ]
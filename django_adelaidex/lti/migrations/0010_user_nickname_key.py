@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+import django_adelaidex.util.fields
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_nickname_key(apps, schema_editor):
+    '''Set nickname_key from first_name, in primary key chunks.
+
+       Existing nicknames which differ only by case keep a NULL nickname_key, so they
+       don't violate the new unique constraint; 0016_resolve_nickname_clashes renames them.'''
+    User = apps.get_model('lti', 'User')
+    claimed = set()
+
+    max_pk = User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    start = 0
+    while start < max_pk:
+        users = User.objects.filter(pk__gt=start, pk__lte=start + BACKFILL_CHUNK_SIZE,
+                                    first_name__isnull=False).exclude(first_name='')
+        with transaction.atomic():
+            for (pk, cohort_id, first_name) in users.order_by('pk').values_list(
+                    'pk', 'cohort_id', 'first_name'):
+                key = first_name.lower()
+                if cohort_id is not None:
+                    if (cohort_id, key) in claimed:
+                        continue
+                    claimed.add((cohort_id, key))
+                User.objects.filter(pk=pk).update(nickname_key=key)
+        start += BACKFILL_CHUNK_SIZE
+
+
+def clear_nickname_key(apps, schema_editor):
+    User = apps.get_model('lti', 'User')
+    User.objects.update(nickname_key=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0009_user_last_launch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='nickname_key',
+            field=django_adelaidex.util.fields.NullableCharField(blank=True, default=None, editable=False, help_text='Lower case nickname, unique within the cohort.', max_length=255, null=True, verbose_name='nickname key'),
+        ),
+        migrations.RunPython(backfill_nickname_key, clear_nickname_key),
+        migrations.AlterUniqueTogether(
+            name='user',
+            unique_together=set([('first_name', 'cohort'), ('nickname_key', 'cohort')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0010_user_nickname_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cohort',
+            name='launch_rate_limit',
+            field=models.PositiveIntegerField(blank=True, default=None, help_text='Optional. Maximum LTI launches per minute using this oauth key. Defaults to settings.ADELAIDEX_LTI_THROTTLE["KEY_RATE"].', null=True, verbose_name='launch rate limit'),
+        ),
+        migrations.AddField(
+            model_name='cohort',
+            name='user_launch_rate_limit',
+            field=models.PositiveIntegerField(blank=True, default=None, help_text='Optional. Maximum LTI launches per minute for each user. Defaults to settings.ADELAIDEX_LTI_THROTTLE["USER_RATE"].', null=True, verbose_name='user launch rate limit'),
+        ),
+    ]
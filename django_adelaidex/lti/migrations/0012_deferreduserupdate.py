@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0011_cohort_launch_rate_limits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeferredUserUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fields', models.TextField(help_text='JSON object of field names to values.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lti.User')),
+            ],
+            options={
+                'db_table': 'auth_user_deferred_update',
+            },
+        ),
+    ]
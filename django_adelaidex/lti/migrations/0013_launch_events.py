@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0012_deferreduserupdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LaunchEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_new', models.BooleanField(default=False, help_text='Whether the user was created by this launch.', verbose_name='new user')),
+                ('launched_at', models.DateTimeField(db_index=True, verbose_name='launched at')),
+                ('cohort', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='lti.Cohort')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lti.User')),
+            ],
+            options={
+                'db_table': 'auth_launch_event',
+            },
+        ),
+        migrations.CreateModel(
+            name='LaunchRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(db_index=True, verbose_name='hour')),
+                ('launches', models.IntegerField(default=0, verbose_name='launches')),
+                ('unique_users', models.IntegerField(default=0, verbose_name='unique users')),
+                ('new_users', models.IntegerField(default=0, verbose_name='new users')),
+                ('returning_users', models.IntegerField(default=0, verbose_name='returning users')),
+                ('cohort', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='lti.Cohort')),
+            ],
+            options={
+                'db_table': 'auth_launch_hourly',
+                'verbose_name': 'hourly launches',
+                'verbose_name_plural': 'hourly launches',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='launchrollup',
+            unique_together=set([('cohort', 'hour')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0013_launch_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CohortCredential',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('oauth_secret', models.CharField(help_text='Required. 255 characters or fewer. Letters, digits, spaces and punctuation only.', max_length=255, validators=[django.core.validators.RegexValidator(b'^[\\w\\s,;|.!@#$%^&*()?+_-]+$', 'Enter a valid oauth secret.', b'invalid')], verbose_name='oauth secret')),
+                ('is_active', models.BooleanField(default=True, verbose_name='active')),
+                ('valid_from', models.DateTimeField(blank=True, default=None, help_text='Optional. Launches signed with this secret are refused before this time.', null=True, verbose_name='valid from')),
+                ('valid_until', models.DateTimeField(blank=True, default=None, help_text='Optional. Launches signed with this secret are refused after this time.', null=True, verbose_name='valid until')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('cohort', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='credentials', to='lti.Cohort')),
+            ],
+            options={
+                'db_table': 'auth_cohort_credential',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='cohortcredential',
+            unique_together=set([('cohort', 'oauth_secret')]),
+        ),
+    ]
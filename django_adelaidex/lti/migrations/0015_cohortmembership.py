@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models, transaction
+import django.db.models.deletion
+import django_adelaidex.util.fields
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_memberships(apps, schema_editor):
+    '''Add each cohort user's membership of their own cohort, in primary key chunks.'''
+    User = apps.get_model('lti', 'User')
+    CohortMembership = apps.get_model('lti', 'CohortMembership')
+
+    max_pk = User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    start = 0
+    while start < max_pk:
+        users = User.objects.filter(pk__gt=start, pk__lte=start + BACKFILL_CHUNK_SIZE,
+                                    cohort__isnull=False)
+        with transaction.atomic():
+            CohortMembership.objects.bulk_create([
+                CohortMembership(user_id=pk, cohort_id=cohort_id, first_name=first_name,
+                                 nickname_key=nickname_key, is_staff=is_staff)
+                for (pk, cohort_id, first_name, nickname_key, is_staff) in users.order_by('pk').values_list(
+                    'pk', 'cohort_id', 'first_name', 'nickname_key', 'is_staff')
+            ])
+        start += BACKFILL_CHUNK_SIZE
+
+
+def clear_memberships(apps, schema_editor):
+    CohortMembership = apps.get_model('lti', 'CohortMembership')
+    CohortMembership.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0014_cohortcredential'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CohortMembership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_name', django_adelaidex.util.fields.NullableCharField(blank=True, default=None, max_length=255, null=True, validators=[django.core.validators.RegexValidator(b'^[\\w.@+-]+$', 'Please enter a valid nickname.', b'invalid')], verbose_name='nickname')),
+                ('nickname_key', django_adelaidex.util.fields.NullableCharField(blank=True, default=None, editable=False, help_text='Lower case nickname, unique within the cohort.', max_length=255, null=True, verbose_name='nickname key')),
+                ('is_staff', models.BooleanField(default=False, verbose_name='staff status')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('cohort', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='lti.Cohort')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='lti.User')),
+            ],
+            options={
+                'db_table': 'auth_cohort_membership',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='cohortmembership',
+            unique_together=set([('user', 'cohort'), ('cohort', 'nickname_key')]),
+        ),
+        migrations.RunPython(backfill_memberships, clear_memberships),
+    ]
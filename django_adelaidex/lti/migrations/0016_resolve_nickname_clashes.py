@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+
+NICKNAME_MAX_LENGTH = 255
+
+
+def free_nickname(first_name, taken):
+    '''Return first_name with the lowest numeric suffix whose lower case isn't taken.'''
+    number = 2
+    while True:
+        suffix = '%d' % number
+        candidate = first_name[:NICKNAME_MAX_LENGTH - len(suffix)] + suffix
+        if candidate.lower() not in taken:
+            return candidate
+        number += 1
+
+
+def resolve_nickname_clashes(apps, schema_editor):
+    '''Rename the cohort users whose nicknames differ from another's only by case.
+
+       0010_user_nickname_key left these with a NULL nickname_key, but User.save()
+       recomputes it, so their next save would violate the (nickname_key, cohort)
+       constraint.  Each gets the lowest free numbered variant of their nickname, in
+       their user row and their own cohort's membership.'''
+    User = apps.get_model('lti', 'User')
+    CohortMembership = apps.get_model('lti', 'CohortMembership')
+
+    clashes = User.objects.filter(cohort__isnull=False, nickname_key__isnull=True,
+                                  first_name__isnull=False).exclude(first_name='')
+    with transaction.atomic():
+        for (pk, cohort_id, first_name) in clashes.order_by('pk').values_list(
+                'pk', 'cohort_id', 'first_name'):
+            taken = set(CohortMembership.objects.filter(cohort_id=cohort_id).exclude(
+                nickname_key=None).values_list('nickname_key', flat=True))
+            taken.update(User.objects.filter(cohort_id=cohort_id).exclude(
+                nickname_key=None).values_list('nickname_key', flat=True))
+            nickname = free_nickname(first_name, taken)
+            User.objects.filter(pk=pk).update(first_name=nickname, nickname_key=nickname.lower())
+            CohortMembership.objects.filter(user_id=pk, cohort_id=cohort_id).update(
+                first_name=nickname, nickname_key=nickname.lower())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0015_cohortmembership'),
+    ]
+
+    operations = [
+        migrations.RunPython(resolve_nickname_clashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0016_resolve_nickname_clashes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='launchrollup',
+            name='last_event_id',
+            field=models.IntegerField(default=0, editable=False, help_text='The highest LaunchEvent id counted, so the next rollup knows which events are new.', verbose_name='last event id'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from django.db import migrations
+from django.db.models import Count, Sum, Case, When, IntegerField
+from django.utils import timezone
+
+# CohortStats.ACTIVE_DAYS
+ACTIVE_DAYS = 7
+
+
+def recount_cohort_stats(apps, schema_editor):
+    '''Recount every cohort's users.  0008_cohortstats added the table empty, and earlier
+       data migrations wrote users with QuerySet.update(), which the counters don't see.'''
+    Cohort = apps.get_model('lti', 'Cohort')
+    CohortStats = apps.get_model('lti', 'CohortStats')
+    User = apps.get_model('lti', 'User')
+
+    active_since = timezone.now() - timedelta(days=ACTIVE_DAYS)
+    counts = dict((row['cohort'], row) for row in User.objects.filter(cohort__isnull=False).order_by(
+        ).values('cohort').annotate(
+            users=Count('pk'),
+            staff=Sum(Case(When(is_staff=True, then=1), default=0, output_field=IntegerField())),
+            active_users=Sum(Case(When(last_login__gte=active_since, then=1),
+                                  default=0, output_field=IntegerField())),
+        ))
+    for cohort_id in Cohort.objects.values_list('pk', flat=True):
+        row = counts.get(cohort_id, {})
+        CohortStats.objects.update_or_create(cohort_id=cohort_id, defaults=dict(
+            (name, row.get(name) or 0) for name in ('users', 'staff', 'active_users')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lti', '0017_launchrollup_last_event_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(recount_cohort_stats, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,5 @@
 from django.db import models, transaction, IntegrityError
-from django.db.models import signals
+from django.db.models import signals, F, Q, Count, Max, Sum, Case, When, IntegerField
 from django.dispatch import receiver
 from django.forms import ModelForm
 from django.core import validators
@@ -7,14 +7,32 @@ from django.utils import timezone
 from django.utils.http import urlquote
 from django.utils.translation import ugettext_lazy as _
 from django.core.mail import send_mail
+from django.core.cache import cache
 from django.conf import settings
-from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
+from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, Group, Permission
 from django.contrib.auth.models import UserManager
+from django.contrib.auth.models import update_last_login as django_update_last_login
+from django.contrib.auth.signals import user_logged_in
 from django.core.exceptions import ValidationError
+from collections import defaultdict
+from datetime import timedelta
+import hashlib
+import operator
+import random
 import re
 
 from django_adelaidex.util.fields import NullableCharField, UniqueBooleanField
-from django_adelaidex.util.widgets import SelectTimeZoneWidget
+from django_adelaidex.lti import tracing
+from django_adelaidex.lti.conf import forget_staff_group, get_config
+from django_adelaidex.lti.widgets import CachedSelectTimeZoneWidget
+
+
+validate_oauth_secret = validators.RegexValidator(r'^[\w\s,;|.!@#$%^&*()?+_-]+$',
+                                                  _('Enter a valid oauth secret.'), 'invalid')
+
+validate_nickname = validators.RegexValidator(r'^[\w.@+-]+$', _('Please enter a valid nickname.'), 'invalid')
+
+NICKNAME_TAKEN_MESSAGE = _('Someone in this cohort already has this nickname.')
 
 
 class Cohort(models.Model):
@@ -40,9 +58,7 @@ class Cohort(models.Model):
     oauth_secret = models.CharField(_('oauth secret'), max_length=255, unique=True,
         help_text=_('Required. 255 characters or fewer. Letters, digits, spaces and '
                     'punctuation only.'),
-        validators=[
-            validators.RegexValidator(r'^[\w\s,;|.!@#$%^&*()?+_-]+$', _('Enter a valid oauth secret.'), 'invalid'),
-        ])
+        validators=[validate_oauth_secret])
     _persist_params = models.TextField(_('persistent parameters'), blank=True, null=True, default=None,
         help_text=_('List of parameters sent by the LTI producer to this application, '
                     'which should be preserved during authentication. Put each parameter name on a new line.'),
@@ -51,6 +67,14 @@ class Cohort(models.Model):
     is_default = UniqueBooleanField(help_text=_('Optional. Cohort to use for non-authenticated users. '
                                                 'Only one Cohort can be the default.'))
 
+    launch_rate_limit = models.PositiveIntegerField(_('launch rate limit'), blank=True, null=True, default=None,
+        help_text=_('Optional. Maximum LTI launches per minute using this oauth key. '
+                    'Defaults to settings.ADELAIDEX_LTI_THROTTLE["KEY_RATE"].'))
+    user_launch_rate_limit = models.PositiveIntegerField(_('user launch rate limit'), blank=True, null=True,
+        default=None,
+        help_text=_('Optional. Maximum LTI launches per minute for each user. '
+                    'Defaults to settings.ADELAIDEX_LTI_THROTTLE["USER_RATE"].'))
+
     created_at = models.DateTimeField(auto_now_add=True, editable=False)
     modified_at = models.DateTimeField(auto_now=True, editable=False)
 
@@ -64,42 +88,30 @@ class Cohort(models.Model):
 
     class CohortManager(models.Manager):
 
+        @tracing.traced('lti.cohort.get_current')
         def get_current(self, user=None):
-            '''Return the user's cohort, if set;
+            '''Return the cohort of the user's active CohortMembership, if set;
+               or the user's cohort, if set;
                or the default cohort, if found in the database;
                or a cohort constructed from ADELAIDEX_LTI settings, if found;
                or None all else fails.'''
 
             current = None
 
-            if user and hasattr(user, 'cohort'):
+            membership = getattr(user, 'active_membership', None)
+            if membership:
+                current = membership.cohort
+            elif user and hasattr(user, 'cohort'):
                 current = user.cohort
 
             if not current:
-                default = self.filter(is_default=True)
-                if default:
-                    current = default[0]
+                # registry.py uses this module, so import it on first use
+                from django_adelaidex.lti.registry import cohort_registry
+                current = cohort_registry.default()
 
             if not current:
-                lti_settings = getattr(settings, 'ADELAIDEX_LTI', {})
-                lti_oauth = getattr(settings, 'LTI_OAUTH_CREDENTIALS', {})
-                if lti_settings or lti_oauth:
-                    oauth_key = None
-                    oauth_secret = None
-                    if lti_oauth:
-                        oauth_key = lti_oauth.keys()[0]
-                        oauth_secret = lti_oauth[oauth_key]
-
-                    current = Cohort(
-                        title=lti_settings.get('LINK_TEXT'),
-                        login_url=lti_settings.get('LOGIN_URL'),
-                        enrol_url=lti_settings.get('ENROL_URL'),
-                        _persist_params="\n".join(lti_settings.get('PERSIST_PARAMS', [])),
-                        oauth_key=oauth_key,
-                        oauth_secret=oauth_secret,
-                        is_default=True,
-                    )
-                
+                current = get_config().settings_cohort()
+
             return current
 
     objects = CohortManager()
@@ -111,6 +123,150 @@ class Cohort(models.Model):
         return unicode(self).encode('utf-8')
 
 
+class CohortCredential(models.Model):
+    '''An additional oauth secret accepted for a Cohort's oauth key, so secrets can be
+       rotated without downtime: add the new secret, switch the consumer over, then
+       deactivate the old one.'''
+    class Meta:
+        db_table = 'auth_cohort_credential'
+        unique_together = (('cohort', 'oauth_secret'),)
+
+    cohort = models.ForeignKey(Cohort, on_delete=models.CASCADE, related_name='credentials')
+    oauth_secret = models.CharField(_('oauth secret'), max_length=255,
+        help_text=_('Required. 255 characters or fewer. Letters, digits, spaces and '
+                    'punctuation only.'),
+        validators=[validate_oauth_secret])
+    is_active = models.BooleanField(_('active'), default=True)
+    valid_from = models.DateTimeField(_('valid from'), blank=True, null=True, default=None,
+        help_text=_('Optional. Launches signed with this secret are refused before this time.'))
+    valid_until = models.DateTimeField(_('valid until'), blank=True, null=True, default=None,
+        help_text=_('Optional. Launches signed with this secret are refused after this time.'))
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    def is_valid(self, now=None):
+        '''Return True if this secret is active, and now is within its validity window.'''
+        if not now:
+            now = timezone.now()
+        return (self.is_active and
+                (self.valid_from is None or self.valid_from <= now) and
+                (self.valid_until is None or now < self.valid_until))
+
+    def __unicode__(self):
+        return '%s credential %s' % (self.cohort.oauth_key, self.pk)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class CohortStats(models.Model):
+    '''Denormalized user counts for a Cohort, so dashboards and admin pages don't have
+       to COUNT over auth_user.
+
+       Counters are adjusted with F() expressions whenever a User is saved or deleted.
+       QuerySet.update() and bulk_create() bypass the model signals, so code (including
+       data migrations) which changes users with them must call CohortStats.objects.adjust()
+       with the changes made, or recount() the cohorts affected.
+
+       Users are counted as active when they log in, but can only age out of the
+       ACTIVE_DAYS window when the counts are recomputed, so schedule
+       `manage.py lti_cohort_stats` to run daily.'''
+    class Meta:
+        db_table = 'auth_cohort_stats'
+        verbose_name = _('cohort stats')
+        verbose_name_plural = _('cohort stats')
+
+    ACTIVE_DAYS = 7
+
+    cohort = models.OneToOneField(Cohort, primary_key=True, related_name='stats')
+    users = models.IntegerField(_('users'), default=0)
+    staff = models.IntegerField(_('staff'), default=0)
+    active_users = models.IntegerField(_('active users'), default=0,
+        help_text=_('Users who have logged in during the last 7 days.'))
+    modified_at = models.DateTimeField(auto_now=True, editable=False)
+
+    COUNTERS = ('users', 'staff', 'active_users',)
+
+    class CohortStatsManager(models.Manager):
+
+        def counters(self):
+            '''Return the aggregate expression for each counter.'''
+            active_since = timezone.now() - timedelta(days=CohortStats.ACTIVE_DAYS)
+            return {
+                'users': Count('pk'),
+                'staff': Sum(Case(When(is_staff=True, then=1),
+                                  default=0, output_field=IntegerField())),
+                'active_users': Sum(Case(When(last_login__gte=active_since, then=1),
+                                         default=0, output_field=IntegerField())),
+            }
+
+        def adjust(self, deltas):
+            '''Apply deltas, a dict of {cohort_id: {counter: delta}}, to the stored counters.
+
+               Missing rows are seeded by counting the cohort's users, so this should be
+               called after the changes have been written.'''
+            for cohort_id, changes in deltas.items():
+                changes = dict((name, delta) for (name, delta) in changes.items() if delta)
+                if not cohort_id or not changes:
+                    continue
+
+                updates = dict((name, F(name) + delta) for (name, delta) in changes.items())
+                updates['modified_at'] = timezone.now()
+                if self.filter(cohort_id=cohort_id).update(**updates):
+                    continue
+
+                counts = User.objects.filter(cohort_id=cohort_id).aggregate(**self.counters())
+                try:
+                    with transaction.atomic():
+                        self.create(cohort_id=cohort_id,
+                                    **dict((name, counts[name] or 0) for name in CohortStats.COUNTERS))
+                except IntegrityError:
+                    # Seeded concurrently; the seed included our change.
+                    pass
+
+        def recompute(self, chunk_size=1000):
+            '''Recount every cohort's users, scanning auth_user in primary key chunks
+               to avoid holding a long table scan.  Returns the number of cohorts updated.'''
+            totals = defaultdict(lambda: dict((name, 0) for name in CohortStats.COUNTERS))
+
+            max_pk = User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+            start = 0
+            while start < max_pk:
+                users = User.objects.filter(pk__gt=start, pk__lte=start + chunk_size,
+                                            cohort__isnull=False)
+                for row in users.order_by().values('cohort').annotate(**self.counters()):
+                    for name in CohortStats.COUNTERS:
+                        totals[row['cohort']][name] += row[name] or 0
+                start += chunk_size
+
+            updated = 0
+            for cohort_id in Cohort.objects.values_list('pk', flat=True):
+                self.store(cohort_id, totals[cohort_id])
+                updated += 1
+            return updated
+
+        def recount(self, cohort_ids):
+            '''Recount the given cohorts' users, e.g. after changing them with
+               QuerySet.update() or bulk_create().'''
+            for cohort_id in cohort_ids:
+                counts = User.objects.filter(cohort_id=cohort_id).aggregate(**self.counters())
+                self.store(cohort_id, dict((name, counts[name] or 0) for name in CohortStats.COUNTERS))
+
+        def store(self, cohort_id, counts):
+            '''Write the cohort's counters, creating its row if need be.  Safe to run
+               concurrently with another first store for the cohort.'''
+            defaults = dict(counts, modified_at=timezone.now())
+            self.update_or_create(cohort_id=cohort_id, defaults=defaults)
+
+    objects = CohortStatsManager()
+
+    def __unicode__(self):
+        return '%s: %d users, %d staff, %d active' % (
+            self.cohort_id, self.users, self.staff, self.active_users)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
 class UserManager(UserManager):
 
     def create_superuser(self, username, email=None, password=None, **extra_fields):
@@ -121,6 +277,74 @@ class UserManager(UserManager):
         return self._create_user(username, email, password, is_staff=True, is_superuser=False,
                                  **extra_fields)
 
+    def cohort_nicknames(self, cohort_id, user):
+        '''Return a queryset of everyone else's nickname_keys in the cohort: their
+           CohortMemberships, or for users without a cohort, their User rows.'''
+        if cohort_id is None:
+            return self.filter(cohort=None).exclude(pk=user.pk)
+        return CohortMembership.objects.filter(cohort_id=cohort_id).exclude(user_id=user.pk)
+
+    def nickname_available(self, nickname, user):
+        '''Return True if no one else in the user's active cohort has the given nickname,
+           ignoring case.
+
+           Clashes are cached for ADELAIDEX_LTI_NICKNAME_CACHE_TTL seconds (default 30),
+           so repeated checks as a student types don't all reach the database.'''
+        key = normalize_nickname(nickname)
+        if not key or key == user.active_nickname_key():
+            return True
+
+        cohort_id = user.active_cohort_id()
+        cache_key = 'lti-nickname-taken:%s:%s' % (
+            cohort_id, hashlib.md5(key.encode('utf-8')).hexdigest())
+        if cache.get(cache_key):
+            return False
+
+        taken = self.cohort_nicknames(cohort_id, user).filter(nickname_key=key).exists()
+        if taken:
+            cache.set(cache_key, True, getattr(settings, 'ADELAIDEX_LTI_NICKNAME_CACHE_TTL', 30))
+        return not taken
+
+    def suggest_nicknames(self, nickname, user, count=3):
+        '''Return up to count available variations on the given nickname, in the user's
+           active cohort.
+
+           Fetches all the cohort nicknames starting with the given nickname in a single
+           range query over nickname_key, rather than checking each candidate.'''
+        base = nickname[:self.model._meta.get_field('first_name').max_length - 4]
+        prefix = normalize_nickname(base)
+        if not prefix:
+            return []
+
+        taken = set(self.cohort_nicknames(user.active_cohort_id(), user).filter(
+            nickname_key__gte=prefix,
+            nickname_key__lt=prefix + u'\uffff',
+        ).values_list('nickname_key', flat=True))
+
+        # Offer the lowest free number first, then random ones, so students
+        # picking the same nickname at once aren't all offered the same suggestions.
+        numbers = [n for n in range(2, len(taken) + 3)
+                   if '%s%d' % (prefix, n) not in taken][:1]
+        numbers.extend(random.sample(range(10, 1000), count * 2))
+
+        suggestions = []
+        for number in numbers:
+            for pattern in ('%s%d', '%s_%d',):
+                candidate = pattern % (base, number)
+                if normalize_nickname(candidate) not in taken and candidate not in suggestions:
+                    suggestions.append(candidate)
+                    break
+            if len(suggestions) >= count:
+                break
+        return suggestions
+
+
+def normalize_nickname(first_name):
+    '''Return the case-insensitive key for a nickname.'''
+    if not first_name:
+        return None
+    return first_name.lower()
+
 
 class User(AbstractBaseUser, PermissionsMixin):
     """
@@ -138,9 +362,7 @@ class User(AbstractBaseUser, PermissionsMixin):
             blank=True, null=True, default=None,
             help_text=_('255 characters or fewer. Letters, digits and '
                         '@/./+/-/_ only.'),
-            validators=[
-                validators.RegexValidator(r'^[\w.@+-]+$', _('Please enter a valid nickname.'), 'invalid'),
-            ])
+            validators=[validate_nickname])
     last_name = models.CharField(_('last name'), max_length=255, blank=True)
     email = models.EmailField(_('email address'), blank=True)
     is_staff = models.BooleanField(_('staff status'), default=False,
@@ -157,6 +379,13 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     cohort = models.ForeignKey(Cohort, blank=True, null=True, default=None)
 
+    nickname_key = NullableCharField(_('nickname key'), max_length=255,
+            blank=True, null=True, default=None, editable=False,
+            help_text=_('Lower case nickname, unique within the cohort.'))
+
+    last_launch = models.DateTimeField(_('last launch'), blank=True, null=True, default=None,
+        help_text=_('Time of the most recent LTI launch.'))
+
     objects = UserManager()
 
     USERNAME_FIELD = 'username'
@@ -165,7 +394,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = _('user')
         verbose_name_plural = _('users')
-        unique_together = ('first_name', 'cohort',)
+        unique_together = (('first_name', 'cohort',), ('nickname_key', 'cohort',),)
         db_table = 'auth_user'
 
     def __unicode__(self):
@@ -174,6 +403,52 @@ class User(AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return unicode(self).encode('utf-8')
 
+    def save(self, *args, **kwargs):
+        # Keep the case-insensitive nickname_key in step with first_name
+        self.nickname_key = normalize_nickname(self.first_name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields and 'first_name' in update_fields and 'nickname_key' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['nickname_key']
+        if getattr(self, 'active_membership', None) is None:
+            return super(User, self).save(*args, **kwargs)
+        # is_staff is the active membership's in memory; write the user's own
+        (active_is_staff, self.is_staff) = (self.is_staff, self.__dict__.get('_own_is_staff', self.is_staff))
+        try:
+            super(User, self).save(*args, **kwargs)
+        finally:
+            self.is_staff = active_is_staff
+
+    def validate_unique(self, exclude=None):
+        '''Also check the nickname against the other memberships of the user's cohort, which
+           the (nickname_key, cohort) constraint on User can't see.'''
+        super(User, self).validate_unique(exclude=exclude)
+        if exclude and 'first_name' in exclude:
+            return
+        key = normalize_nickname(self.first_name)
+        if key and self.cohort_id and CohortMembership.objects.filter(
+                cohort_id=self.cohort_id, nickname_key=key).exclude(user_id=self.pk).exists():
+            raise ValidationError({'first_name': NICKNAME_TAKEN_MESSAGE})
+
+    def activate_membership(self, membership):
+        '''Make the CohortMembership, or None for the user's own cohort, their active one.
+
+           The user's is_staff becomes the membership's in memory, so staff checks use
+           their role in the cohort they launched from.  save() still writes their own.'''
+        if not hasattr(self, '_own_is_staff'):
+            self._own_is_staff = self.is_staff
+        self.active_membership = membership
+        self.is_staff = membership.is_staff if membership else self._own_is_staff
+
+    def active_cohort_id(self):
+        '''Return the id of the cohort the user is active in: their active_membership's,
+           if the backend or ActiveCohortMiddleware set one, or their own.'''
+        membership = getattr(self, 'active_membership', None)
+        return membership.cohort_id if membership else self.cohort_id
+
+    def active_nickname_key(self):
+        membership = getattr(self, 'active_membership', None)
+        return membership.nickname_key if membership else self.nickname_key
+
     def get_full_name(self):
         """
         Returns the first_name plus the last_name, with a space in between.
@@ -191,11 +466,167 @@ class User(AbstractBaseUser, PermissionsMixin):
         """
         send_mail(subject, message, from_email, [self.email], **kwargs)
 
+    def touch_launch(self, now=None):
+        '''Set last_login and last_launch to now, unless they were set within the
+           ADELAIDEX_LTI_LAST_LOGIN_WINDOW.
+
+           Returns the list of changed fields, to be saved with any other launch changes.'''
+        if not now:
+            now = timezone.now()
+        changed = []
+        for field in ('last_login', 'last_launch',):
+            if timestamp_is_stale(getattr(self, field), now):
+                setattr(self, field, now)
+                changed.append(field)
+
+        # Let update_last_login know that this login has been recorded.
+        self._login_recorded = True
+        return changed
+
+    def update_launch(self, now=None, **fields):
+        '''Apply the given LTI launch fields, and touch the launch timestamps.
+
+           Returns the list of changed fields, so they can be written in a single UPDATE.'''
+        changed = []
+        for (name, value) in fields.items():
+            current = getattr(self, self._meta.get_field(name).attname)
+            if current != getattr(value, 'pk', value):
+                setattr(self, name, value)
+                changed.append(name)
+        changed.extend(self.touch_launch(now))
+        return changed
+
+
+def timestamp_is_stale(value, now=None):
+    '''Return True if the given last_login or last_launch value is older than
+       settings.ADELAIDEX_LTI_LAST_LOGIN_WINDOW minutes (default 0).'''
+    if not value:
+        return True
+    if not now:
+        now = timezone.now()
+    window = getattr(settings, 'ADELAIDEX_LTI_LAST_LOGIN_WINDOW', 0)
+    return value < now - timedelta(minutes=window)
+
+
+def update_last_login(sender, user, **kwargs):
+    '''Replaces django.contrib.auth.models.update_last_login, to avoid rewriting
+       last_login when it's already been recorded, or is within the
+       ADELAIDEX_LTI_LAST_LOGIN_WINDOW.'''
+    if getattr(user, '_login_recorded', False):
+        return
+    now = timezone.now()
+    if timestamp_is_stale(user.last_login, now):
+        user.last_login = now
+        user.save(update_fields=['last_login'])
+
+user_logged_in.disconnect(django_update_last_login)
+user_logged_in.connect(update_last_login, dispatch_uid='update_last_login')
+
+# Session key for the cohort the user last launched from; see ActiveCohortMiddleware
+ACTIVE_COHORT_SESSION_KEY = '_lti_cohort_id'
+
+
+@receiver(user_logged_in, dispatch_uid='remember_active_cohort')
+def remember_active_cohort(sender, request=None, user=None, **kwargs):
+    '''Keep the cohort an LTI launch logged the user in from in their session.'''
+    if hasattr(user, 'active_membership') and hasattr(request, 'session'):
+        request.session[ACTIVE_COHORT_SESSION_KEY] = user.active_cohort_id()
+
+
+def activate_session_cohort(user, session):
+    '''Activate the user's membership of the cohort in their session, unless one is already
+       active, and return it.  Returns None for the user's own cohort.'''
+    if hasattr(user, 'active_membership'):
+        return user.active_membership
+    membership = None
+    cohort_id = session.get(ACTIVE_COHORT_SESSION_KEY)
+    if cohort_id and cohort_id != user.cohort_id:
+        membership = CohortMembership.objects.select_related('cohort').filter(
+            user_id=user.pk, cohort_id=cohort_id).first()
+    user.activate_membership(membership)
+    return membership
+
+
+def cohort_stats_state(user):
+    '''Return the (cohort_id, is_staff, is_active) CohortStats counters this user contributes to.'''
+    if not user.cohort_id:
+        return None
+    active_since = timezone.now() - timedelta(days=CohortStats.ACTIVE_DAYS)
+    is_active = bool(user.last_login and user.last_login >= active_since)
+    return (user.cohort_id, bool(user.is_staff), is_active)
+
+
+def cohort_stats_deltas(old_state, new_state):
+    '''Return the CohortStats.objects.adjust() deltas for a user moving between states.'''
+    deltas = defaultdict(lambda: defaultdict(int))
+    for (state, sign) in ((old_state, -1), (new_state, 1)):
+        if state:
+            (cohort_id, is_staff, is_active) = state
+            deltas[cohort_id]['users'] += sign
+            deltas[cohort_id]['staff'] += sign * is_staff
+            deltas[cohort_id]['active_users'] += sign * is_active
+    return deltas
+
+
+@receiver(signals.post_init, sender=User)
+def remember_cohort_stats(sender, instance=None, **kwargs):
+    '''Remember the user's counters as loaded, so post_save can adjust CohortStats.'''
+    instance._cohort_stats_state = cohort_stats_state(instance)
+
+
+@receiver(signals.post_save, sender=User)
+def update_cohort_stats(sender, instance=None, created=False, raw=False, **kwargs):
+    '''Adjust the CohortStats counters by the difference this save made.'''
+    if raw:
+        return
+    old_state = None if created else instance._cohort_stats_state
+    new_state = cohort_stats_state(instance)
+    if old_state != new_state:
+        CohortStats.objects.adjust(cohort_stats_deltas(old_state, new_state))
+    instance._cohort_stats_state = new_state
+
+
+@receiver(signals.post_delete, sender=User)
+def remove_cohort_stats(sender, instance=None, **kwargs):
+    CohortStats.objects.adjust(cohort_stats_deltas(instance._cohort_stats_state, None))
+
+
+def permission_cache_key(user_id, membership_is_staff=None):
+    '''Return the cache key for the user's permissions, in their own cohort (None), or as
+       staff or not in another cohort; see CohortLTIAuthBackend.'''
+    if membership_is_staff is None:
+        return 'lti-perms:%s' % user_id
+    return 'lti-perms:%s:%s' % (user_id, 'staff' if membership_is_staff else 'member')
+
+
+def invalidate_permissions(user_ids):
+    '''Drop the permissions cached by CohortLTIAuthBackend for the given users.'''
+    keys = [permission_cache_key(user_id, membership_is_staff)
+            for user_id in user_ids for membership_is_staff in (None, True, False)]
+    if keys:
+        cache.delete_many(keys)
+
+
+def group_member_ids(group_ids):
+    return list(User.objects.filter(groups__in=group_ids).values_list('pk', flat=True).distinct())
+
+
+# User fields which change the permissions a user has
+PERMISSION_FIELDS = set(('is_active', 'is_staff', 'is_superuser',))
+
 
 @receiver(signals.post_save, sender=User)
-def post_save(sender, instance=None, **kwargs):
+def post_save(sender, instance=None, update_fields=None, **kwargs):
     '''user.is_staff determines membership in ADELAIDEX_LTI_STAFF_MEMBER_GROUP'''
-    staff_group = getattr(settings, 'ADELAIDEX_LTI_STAFF_MEMBER_GROUP')
+    if update_fields is not None:
+        if PERMISSION_FIELDS & set(update_fields):
+            invalidate_permissions([instance.pk])
+        if 'is_staff' not in update_fields:
+            # is_staff wasn't saved, so group membership can't have changed
+            return
+    else:
+        invalidate_permissions([instance.pk])
+    staff_group = get_config().staff_group_id()
     if staff_group:
         if instance.is_staff:
             try:
@@ -208,32 +639,338 @@ def post_save(sender, instance=None, **kwargs):
             instance.groups.remove(staff_group)
 
 
+# m2m_changed actions which change the permissions users have
+PERMISSION_ACTIONS = ('post_add', 'post_remove', 'pre_clear', 'post_clear',)
+
+
+def invalidate_around(instance, before, find_user_ids):
+    '''Invalidate the permissions of the users affected by a clear() or delete, both before
+       and after it, in case they were cached again in between.  The users are found
+       before, since the change removes the rows which find them.'''
+    if before:
+        instance._permission_user_ids = list(find_user_ids())
+        invalidate_permissions(instance._permission_user_ids)
+    else:
+        invalidate_permissions(instance.__dict__.pop('_permission_user_ids', []))
+
+
+@receiver(signals.m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    '''Users added to or removed from groups gain or lose the groups' permissions.'''
+    if action not in PERMISSION_ACTIONS:
+        return
+    if not reverse:
+        invalidate_permissions([instance.pk])
+    elif action in ('pre_clear', 'post_clear'):
+        invalidate_around(instance, action == 'pre_clear', lambda: group_member_ids([instance.pk]))
+    else:
+        invalidate_permissions(pk_set)
+
+
+@receiver(signals.m2m_changed, sender=User.user_permissions.through)
+def user_permissions_changed(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    if action not in PERMISSION_ACTIONS:
+        return
+    if not reverse:
+        invalidate_permissions([instance.pk])
+    elif action in ('pre_clear', 'post_clear'):
+        invalidate_around(instance, action == 'pre_clear', lambda: permission_holder_ids(instance, groups=False))
+    else:
+        invalidate_permissions(pk_set)
+
+
+@receiver(signals.m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    '''Changing a group's permissions changes the permissions of all its members.'''
+    if action not in PERMISSION_ACTIONS:
+        return
+    if not reverse:
+        invalidate_permissions(group_member_ids([instance.pk]))
+    elif action in ('pre_clear', 'post_clear'):
+        invalidate_around(instance, action == 'pre_clear',
+                          lambda: group_member_ids(instance.group_set.values_list('pk', flat=True)))
+    else:
+        invalidate_permissions(group_member_ids(pk_set))
+
+
+@receiver(signals.pre_delete, sender=Group)
+def group_deleted(sender, instance=None, **kwargs):
+    invalidate_permissions(group_member_ids([instance.pk]))
+
+
+@receiver(signals.post_save, sender=Group, dispatch_uid='staff_group_saved')
+@receiver(signals.post_delete, sender=Group, dispatch_uid='staff_group_deleted')
+def staff_group_changed(sender, **kwargs):
+    '''The ADELAIDEX_LTI_STAFF_MEMBER_GROUP may have been created, renamed or deleted.'''
+    forget_staff_group()
+
+
+def permission_holder_ids(permission, groups=True):
+    '''Return the ids of the users granted the permission, directly or through their groups.'''
+    user_ids = set(User.objects.filter(user_permissions=permission).values_list('pk', flat=True))
+    if groups:
+        user_ids.update(group_member_ids(permission.group_set.values_list('pk', flat=True)))
+    return user_ids
+
+
+@receiver(signals.pre_delete, sender=Permission, dispatch_uid='permission_pre_delete')
+@receiver(signals.post_delete, sender=Permission, dispatch_uid='permission_post_delete')
+def permission_deleted(sender, instance=None, **kwargs):
+    '''Deleting a permission removes it from its users and groups without m2m_changed.'''
+    invalidate_around(instance, kwargs['signal'] is signals.pre_delete,
+                      lambda: permission_holder_ids(instance))
+
+
+class CohortMembership(models.Model):
+    '''A user's nickname and staff role in one of their cohorts.
+
+       user.cohort is the cohort the user first launched from, and its membership is kept
+       in step with the user's own first_name and is_staff.  Launches from the user's
+       other cohorts use their memberships instead, so they don't move the user between
+       cohorts.  Nicknames are unique within each cohort's memberships.'''
+    class Meta:
+        db_table = 'auth_cohort_membership'
+        unique_together = (('user', 'cohort',), ('cohort', 'nickname_key',),)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='memberships')
+    cohort = models.ForeignKey(Cohort, on_delete=models.CASCADE, related_name='memberships')
+    first_name = NullableCharField(_('nickname'), max_length=255,
+            blank=True, null=True, default=None,
+            validators=[validate_nickname])
+    nickname_key = NullableCharField(_('nickname key'), max_length=255,
+            blank=True, null=True, default=None, editable=False,
+            help_text=_('Lower case nickname, unique within the cohort.'))
+    is_staff = models.BooleanField(_('staff status'), default=False)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class CohortMembershipManager(models.Manager):
+
+        def join(self, user, cohort):
+            '''Return the user's membership of the cohort, adding it if they don't have one.
+
+               New memberships have no nickname, so the entry form asks for one, and
+               records the user's staff role in the cohort.'''
+            membership = self.get_or_create(user=user, cohort=cohort)[0]
+            membership.cohort = cohort
+            return membership
+
+        def sync(self, user):
+            '''Copy the user's nickname and staff role to their membership of their own cohort.
+
+               Raises ValidationError if another member of the cohort has the nickname,
+               leaving any enclosing transaction usable.'''
+            if not user.cohort_id:
+                return
+            fields = {
+                'first_name': user.first_name,
+                'nickname_key': normalize_nickname(user.first_name),
+                'is_staff': user.is_staff,
+            }
+            try:
+                with transaction.atomic():
+                    if not self.filter(user_id=user.pk, cohort_id=user.cohort_id).update(**fields):
+                        self.create(user_id=user.pk, cohort_id=user.cohort_id, **fields)
+            except IntegrityError:
+                raise ValidationError({'first_name': NICKNAME_TAKEN_MESSAGE})
+
+    objects = CohortMembershipManager()
+
+    def save(self, *args, **kwargs):
+        self.nickname_key = normalize_nickname(self.first_name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields and 'first_name' in update_fields and 'nickname_key' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['nickname_key']
+        super(CohortMembership, self).save(*args, **kwargs)
+
+    def __unicode__(self):
+        return '%s in %s' % (self.user, self.cohort)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+# User fields copied to the membership of the user's own cohort
+MEMBERSHIP_FIELDS = set(('first_name', 'nickname_key', 'is_staff', 'cohort',))
+
+
+@receiver(signals.post_save, sender=User, dispatch_uid='sync_cohort_membership')
+def sync_cohort_membership(sender, instance=None, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and not MEMBERSHIP_FIELDS & set(update_fields)):
+        return
+    CohortMembership.objects.sync(instance)
+
+
+class DeferredUserUpdate(models.Model):
+    '''User field changes from LTI launches, queued to be written later by
+       `manage.py lti_deferred_updates`.  See django_adelaidex.lti.deferred.'''
+    class Meta:
+        db_table = 'auth_user_deferred_update'
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    fields = models.TextField(help_text=_('JSON object of field names to values.'))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class LaunchEvent(models.Model):
+    '''A successful LTI launch.  Written in batches by django_adelaidex.lti.events,
+       and summarised into LaunchRollup by `manage.py lti_launch_rollup`.'''
+    class Meta:
+        db_table = 'auth_launch_event'
+
+    cohort = models.ForeignKey(Cohort, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    is_new = models.BooleanField(_('new user'), default=False,
+        help_text=_('Whether the user was created by this launch.'))
+    launched_at = models.DateTimeField(_('launched at'), db_index=True)
+
+
+class LaunchRollup(models.Model):
+    '''Hourly launch counts for each cohort, so reports don't scan LaunchEvent.'''
+    class Meta:
+        db_table = 'auth_launch_hourly'
+        unique_together = (('cohort', 'hour'),)
+        verbose_name = _('hourly launches')
+        verbose_name_plural = _('hourly launches')
+
+    cohort = models.ForeignKey(Cohort, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    hour = models.DateTimeField(_('hour'), db_index=True)
+    launches = models.IntegerField(_('launches'), default=0)
+    unique_users = models.IntegerField(_('unique users'), default=0)
+    new_users = models.IntegerField(_('new users'), default=0)
+    returning_users = models.IntegerField(_('returning users'), default=0)
+    last_event_id = models.IntegerField(_('last event id'), default=0, editable=False,
+        help_text=_('The highest LaunchEvent id counted, so the next rollup knows which events are new.'))
+
+    class LaunchRollupManager(models.Manager):
+
+        def rollup(self):
+            '''Summarise the LaunchEvents written since the last rollup.
+
+               Every hour with a new event is recounted in full, since the buffered writers
+               can deliver events late, into hours which were already rolled up.  New events
+               are those after the highest last_event_id rolled up.  Returns the number of
+               hourly rows written.'''
+            watermark = self.aggregate(last=Max('last_event_id'))['last'] or 0
+            new_events = LaunchEvent.objects.filter(id__gt=watermark)
+            hours = set(launched_at.replace(minute=0, second=0, microsecond=0)
+                        for launched_at in new_events.values_list('launched_at', flat=True).iterator())
+            if not hours:
+                return 0
+
+            events = LaunchEvent.objects.filter(reduce(operator.or_, [
+                Q(launched_at__gte=hour, launched_at__lt=hour + timedelta(hours=1))
+                for hour in hours
+            ]))
+            totals = {}
+            rows = events.order_by('launched_at').values_list('id', 'cohort', 'user', 'is_new', 'launched_at')
+            for (event_id, cohort_id, user_id, is_new, launched_at) in rows.iterator():
+                hour = launched_at.replace(minute=0, second=0, microsecond=0)
+                counts = totals.get((cohort_id, hour))
+                if counts is None:
+                    counts = totals[(cohort_id, hour)] = {'launches': 0, 'users': set(), 'new': set(),
+                                                          'last': 0}
+                counts['launches'] += 1
+                counts['users'].add(user_id)
+                if is_new:
+                    counts['new'].add(user_id)
+                counts['last'] = max(counts['last'], event_id)
+
+            with transaction.atomic():
+                self.filter(hour__in=hours).delete()
+                self.bulk_create([
+                    LaunchRollup(cohort_id=cohort_id, hour=hour,
+                                 launches=counts['launches'],
+                                 unique_users=len(counts['users']),
+                                 new_users=len(counts['new']),
+                                 returning_users=len(counts['users'] - counts['new']),
+                                 last_event_id=counts['last'])
+                    for ((cohort_id, hour), counts) in totals.items()
+                ])
+            return len(totals)
+
+    objects = LaunchRollupManager()
+
+
 class UserForm(ModelForm):
     class Meta:
         model = User
         fields = ['first_name', 'time_zone', 'cohort', ]
         widgets = {
-            'time_zone': SelectTimeZoneWidget,
+            'time_zone': CachedSelectTimeZoneWidget,
         }
 
     def __init__(self, *args, **kwargs):
+        self.prepare_base_fields()
         super(UserForm, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def prepare_base_fields(cls):
+        '''Set up the form class's base fields, which each form instance copies, once.'''
+        if cls.__dict__.get('_base_fields_prepared'):
+            return
+
         # n.b I have no idea why ModelForm doesn't already do this!
-        for field in self._meta.fields:
-            self.fields[field].validators = self._meta.model._meta.get_field(field).validators
+        for field in cls._meta.fields:
+            cls.base_fields[field].validators = list(cls._meta.model._meta.get_field(field).validators)
 
         # Require the user to provide a nickname
-        first_name = self.fields['first_name']
-        first_name.required = True
+        cls.base_fields['first_name'].required = True
+        cls._base_fields_prepared = True
+
+    duplicate_nickname_message = ('Someone with this nickname already exists in your cohort. '
+                                  'Please try a different nickname.')
+
+    # Available alternatives, when the chosen nickname is taken
+    nickname_suggestions = []
 
     def clean_first_name(self):
         # Strip leading/trailing spaces from nickname
         first_name = self.cleaned_data.get('first_name', '').strip()
 
-        duplicate = User.objects.filter(cohort=self.instance.cohort,
-            first_name=first_name).exclude(id=self.instance.id)
-        if duplicate.exists():
-            raise ValidationError('Someone with this nickname already exists in your cohort. '
-                                  'Please try a different nickname.')
+        # The (nickname_key, cohort) unique constraint can't see duplicates between users
+        # without a cohort, so check for those here.  Cohort users are checked by save().
+        if first_name and not self.instance.active_cohort_id():
+            duplicate = User.objects.filter(cohort=None,
+                nickname_key=normalize_nickname(first_name)).exclude(id=self.instance.id)
+            if duplicate.exists():
+                self.nickname_suggestions = User.objects.suggest_nicknames(first_name, self.instance)
+                raise ValidationError(self.duplicate_nickname_message)
         return first_name
+
+    def validate_unique(self):
+        '''Leave nickname uniqueness to the database constraints; see save().'''
+        exclude = self._get_validation_exclusions()
+        exclude.extend(['first_name', 'nickname_key'])
+        try:
+            self.instance.validate_unique(exclude=exclude)
+        except ValidationError as e:
+            self._update_errors(e)
+
+    def save(self, commit=True):
+        '''Claim the nickname by writing it, and letting the (nickname_key, cohort)
+           unique constraints reject duplicates, rather than checking first.
+
+           Users active in another of their cohorts (see CohortMembership) have their
+           nickname and staff role saved to that membership, and only their time zone
+           to the user.
+
+           On a duplicate, adds the nickname error and suggestions to the form,
+           and returns None.'''
+        if not commit:
+            return super(UserForm, self).save(commit=False)
+        membership = getattr(self.instance, 'active_membership', None)
+        try:
+            with transaction.atomic():
+                if membership is None:
+                    return super(UserForm, self).save(commit=True)
+                membership.first_name = self.instance.first_name
+                membership.is_staff = self.instance.is_staff
+                membership.save(update_fields=['first_name', 'is_staff'])
+                self.instance.save(update_fields=['time_zone'])
+                return self.instance
+        except (IntegrityError, ValidationError):
+            # ValidationError: the nickname is taken in the user's cohort's memberships
+            first_name = self.cleaned_data['first_name']
+            self.add_error('first_name', self.duplicate_nickname_message)
+            self.nickname_suggestions = User.objects.suggest_nicknames(first_name, self.instance)
+            return None
@@ -0,0 +1,152 @@
+'''
+Verifies the OAuth 1.0 HMAC-SHA1 signature on LTI launches, without building an
+ims_lti_py DjangoToolProvider or an oauth2 Request for each launch.
+
+The signature base string is built in one pass over the request's query and POST
+params (RFC 5849 section 3.4.1), and the keyed HMAC for each consumer secret is cached,
+so each launch only hashes its own base string.  Signatures are compared in constant time.
+'''
+from base64 import b64encode
+from hashlib import sha1
+from urllib import quote
+import hmac
+import threading
+
+# LTI launch params used by the backend
+LAUNCH_FIELDS = (
+    'user_id',
+    'lis_person_sourcedid',
+    'lis_person_contact_email_primary',
+    'lis_person_name_given',
+    'lis_person_name_family',
+)
+
+DEFAULT_PORTS = {
+    'http': '80',
+    'https': '443',
+}
+
+
+try:
+    compare_digest = hmac.compare_digest
+except AttributeError:
+    # Python < 2.7.7
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for (x, y) in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+def escape(value):
+    '''Percent-encode the value as RFC 5849 section 3.6 requires.'''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return quote(value, safe='~')
+
+
+def base_string_uri(scheme, host, path):
+    '''Return the base string URI for the request: lowercase scheme and host, without
+       the default port, query or fragment.'''
+    scheme = scheme.lower()
+    host = host.lower()
+    if ':' in host:
+        (hostname, port) = host.rsplit(':', 1)
+        if DEFAULT_PORTS.get(scheme) == port:
+            host = hostname
+    return '%s://%s%s' % (scheme, host, path or '/')
+
+
+def signature_base_string(method, uri, params):
+    '''Return the signature base string for the (name, value) params, which may repeat
+       names; oauth_signature is excluded.'''
+    pairs = sorted((escape(name), escape(value)) for (name, value) in params
+                   if name != 'oauth_signature')
+    return '&'.join((
+        escape(method.upper()),
+        escape(uri),
+        escape('&'.join('%s=%s' % pair for pair in pairs)),
+    ))
+
+
+class HMACKeys(object):
+    '''Caches an HMAC-SHA1 object keyed with each consumer secret, so signing only
+       copies the keyed state instead of re-deriving the padded key.'''
+
+    max_size = 1000
+
+    def __init__(self):
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def get(self, secret):
+        keyed = self.keys.get(secret)
+        if keyed is None:
+            keyed = hmac.new('%s&' % escape(secret), digestmod=sha1)
+            with self.lock:
+                if len(self.keys) >= self.max_size:
+                    self.keys.clear()
+                self.keys[secret] = keyed
+        return keyed.copy()
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+
+
+hmac_keys = HMACKeys()
+
+
+def sign(base_string, secret):
+    '''Return the base64 HMAC-SHA1 signature of the base string with the consumer secret.'''
+    digest = hmac_keys.get(secret)
+    digest.update(base_string)
+    return b64encode(digest.digest())
+
+
+def request_params(request):
+    '''Return the (name, value) pairs from the request's query string and POST body.'''
+    params = []
+    for query in (request.GET, request.POST):
+        for (name, values) in query.lists():
+            params.extend((name, value) for value in values)
+    return params
+
+
+def find_secret(request, secrets):
+    '''Return the first of the consumer secrets which signed the request with a valid
+       HMAC-SHA1 signature, or None if none did.
+
+       The launch parameters, timestamp and nonce are checked by
+       django_adelaidex.lti.validation.validate_launch before this is called.'''
+    signature = request.POST.get('oauth_signature')
+    if not signature or request.POST.get('oauth_version', '1.0') != '1.0':
+        return None
+    if isinstance(signature, unicode):
+        signature = signature.encode('utf-8')
+    uri = base_string_uri(request.scheme, request.get_host(), request.path)
+    base_string = signature_base_string(request.method, uri, request_params(request))
+    for secret in secrets:
+        if compare_digest(sign(base_string, secret), signature):
+            return secret
+    return None
+
+
+def verify_request(request, secret):
+    '''Return True if the request carries a valid HMAC-SHA1 signature for the consumer secret.'''
+    return find_secret(request, [secret]) is not None
+
+
+class LaunchFields(object):
+    '''The LTI launch fields the backend uses, with the same attribute names and
+       get_custom_param() method as ims_lti_py's ToolProvider.'''
+
+    def __init__(self, params):
+        for name in LAUNCH_FIELDS:
+            setattr(self, name, params.get(name))
+        self.params = params
+
+    def get_custom_param(self, name):
+        return self.params.get('custom_%s' % name)
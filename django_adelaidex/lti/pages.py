@@ -0,0 +1,179 @@
+'''
+Pre-rendered lti-403 and lti-inactive pages, served to anonymous visitors without
+running the template engine, context processors or cohort queries on every hit.
+
+Enable with:
+
+    ADELAIDEX_LTI_STATIC_PAGES = {
+        'ENABLED': True,
+        'TIMEOUT': None,    # cache timeout in seconds; None to keep until the Cohort changes
+    }
+
+Each page is rendered once per cohort, from a request made up for an anonymous user of
+that cohort, in the default language, and stored in the Django cache.  Nothing from the
+visitor's own request is rendered into it: the per-request query string and next page
+are rendered as placeholders, and filled in when the page is served, along with an ETag
+so repeat visits get a 304.
+
+A cohort's pages are re-rendered when it's saved, and dropped when it's deleted.  All
+the pages are dropped when the LTI settings change.  Run `manage.py lti_render_pages`
+after deploying template changes.
+'''
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.core.urlresolvers import resolve, reverse
+from django.db import transaction
+from django.db.models import signals
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.html import escape
+from django.utils.http import quote_etag
+from django.utils import translation
+import hashlib
+import logging
+
+from django_adelaidex.lti import metrics
+from django_adelaidex.lti.context_processors import lti_next_page, lti_query_string
+from django_adelaidex.lti.models import Cohort
+
+logger = logging.getLogger(__name__)
+
+# URL names of the pre-rendered pages
+PAGE_NAMES = ('lti-403', 'lti-inactive',)
+
+# Rendered in place of the per-request context, and replaced when served
+QUERY_STRING_PLACEHOLDER = 'ADELAIDEXLTIQUERYSTRINGPLACEHOLDER'
+NEXT_PAGE_PLACEHOLDER = 'ADELAIDEXLTINEXTPAGEPLACEHOLDER'
+
+# Settings which change the rendered pages
+SETTING_NAMES = (
+    'ADELAIDEX_LTI',
+    'LTI_OAUTH_CREDENTIALS',
+    'ADELAIDEX_LTI_STATIC_PAGES',
+    'TEMPLATES',
+)
+
+
+def pages_settings():
+    '''Return settings.ADELAIDEX_LTI_STATIC_PAGES, with defaults filled in.'''
+    conf = {
+        'ENABLED': False,
+        'TIMEOUT': None,
+    }
+    conf.update(getattr(settings, 'ADELAIDEX_LTI_STATIC_PAGES', {}))
+    return conf
+
+
+# Part of every page key, and bumped to drop all the pages when the settings change
+_generation = 0
+
+
+def page_key(name, cohort=None):
+    '''Return the cache key of the named page, as rendered for the cohort.  Pages for the
+       cohort built from the settings, or for no cohort, are keyed by None.'''
+    return 'lti-page:%d:%s:%s' % (_generation, name, getattr(cohort, 'pk', None))
+
+
+def page_request(name, cohort=None):
+    '''Return an anonymous GET request for the named page, as seen by the cohort, to
+       render it with.'''
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = reverse(name)
+    request.META = {
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'QUERY_STRING': '',
+    }
+    request.user = AnonymousUser()
+    # as set by AnonymousCohortMiddleware
+    request.user.cohort = cohort
+    return request
+
+
+def render_page(name, cohort=None):
+    '''Render the named page for an anonymous user of the cohort, with placeholders for
+       the per-request context, and store it in the cache.  Returns the rendered page.'''
+    view_class = resolve(reverse(name)).func.view_class
+    with translation.override(settings.LANGUAGE_CODE):
+        content = render_to_string(view_class.template_name, {
+            'ADELAIDEX_LTI_QUERY_STRING': QUERY_STRING_PLACEHOLDER,
+            'ADELAIDEX_LTI_NEXT_PAGE': NEXT_PAGE_PLACEHOLDER,
+        }, request=page_request(name, cohort))
+    page = content.encode('utf-8')
+    cache.set(page_key(name, cohort), page, pages_settings()['TIMEOUT'])
+    return page
+
+
+def render_pages(cohort=None):
+    '''Render all the pre-rendered pages for the cohort, by default the one anonymous
+       users see.  Returns the number rendered.'''
+    if cohort is None:
+        cohort = Cohort.objects.get_current()
+    for name in PAGE_NAMES:
+        render_page(name, cohort)
+    return len(PAGE_NAMES)
+
+
+def clear_pages(cohort=None):
+    cache.delete_many([page_key(name, cohort) for name in PAGE_NAMES])
+
+
+def serves(request):
+    '''Return True if the request can be served a pre-rendered page.'''
+    return (request.method in ('GET', 'HEAD') and not request.user.is_authenticated() and
+            pages_settings()['ENABLED'])
+
+
+def page_response(request, name):
+    '''Return the pre-rendered page, filled in for this request, or a 304 Not Modified
+       if the request's If-None-Match matches its ETag.'''
+    cohort = Cohort.objects.get_current(request.user)
+    page = cache.get(page_key(name, cohort))
+    if page is None:
+        metrics.page_cache.inc(page=name, result='miss')
+        page = render_page(name, cohort)
+    else:
+        metrics.page_cache.inc(page=name, result='hit')
+
+    content = page.replace(
+        QUERY_STRING_PLACEHOLDER, escape(lti_query_string(request)).encode('utf-8')).replace(
+        NEXT_PAGE_PLACEHOLDER, escape(lti_next_page(request)).encode('utf-8'))
+    etag = hashlib.md5(content).hexdigest()
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content)
+    response['ETag'] = quote_etag(etag)
+    return response
+
+
+@receiver(signals.post_save, sender=Cohort, dispatch_uid='render_pages_cohort_save')
+@receiver(signals.post_delete, sender=Cohort, dispatch_uid='render_pages_cohort_delete')
+def cohort_changed(sender, instance=None, **kwargs):
+    '''Drop the cohort's pages, and re-render them once the change is committed if
+       anonymous users see the cohort.'''
+    if pages_settings()['ENABLED']:
+        clear_pages(instance)
+        if instance.is_default and kwargs['signal'] is signals.post_save:
+            transaction.on_commit(lambda: render_pages_safely(instance))
+
+
+def render_pages_safely(cohort):
+    try:
+        render_pages(cohort)
+    except Exception:
+        # the next hit on each page will render it
+        logger.exception('Could not pre-render the LTI pages for %s' % cohort)
+        clear_pages(cohort)
+
+
+@receiver(setting_changed)
+def settings_changed(sender, setting=None, **kwargs):
+    global _generation
+    if setting in SETTING_NAMES:
+        _generation += 1
@@ -0,0 +1,221 @@
+'''
+Process-local registry of Cohorts by oauth consumer key, so LTI launches don't need
+to query the database to find their Cohort or its secrets.
+
+Entries expire after settings.ADELAIDEX_LTI_COHORT_CACHE_TTL seconds (default 60), and
+are dropped as soon as a Cohort or CohortCredential is saved or deleted in this process.
+Unknown keys are remembered too, so launches with bogus keys are also cheap to refuse.
+
+The default cohort, which Cohort.objects.get_current() uses for anonymous users, is
+cached the same way.
+
+With settings.ADELAIDEX_LTI_COHORT_CACHE_STALE seconds (default 0, disabled), expired
+entries are served for up to that much longer while a single background thread reloads
+them, so launches don't wait on the database, and keep working through brief database
+outages.
+
+The registry also remembers which secret last verified a launch for each key, so
+verification tries that one first, rather than every secret the key accepts.
+'''
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, connection
+from django.db.models import signals
+from django.dispatch import receiver
+from django.utils import timezone
+import logging
+import threading
+import time
+
+from django_adelaidex.lti import metrics
+from django_adelaidex.lti.conf import SETTING_NAMES, get_config
+from django_adelaidex.lti.models import Cohort, CohortCredential
+
+logger = logging.getLogger(__name__)
+
+# The default cohort's key, which no oauth key can clash with
+DEFAULT_KEY = None
+
+class CohortRegistry(object):
+
+    # Forget everything once there are this many keys
+    max_size = 10000
+
+    def __init__(self):
+        self.cohorts = {}
+        self.preferred = {}
+        self.refreshing = set()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def ttl(self):
+        return getattr(settings, 'ADELAIDEX_LTI_COHORT_CACHE_TTL', 60)
+
+    def stale_ttl(self):
+        return getattr(settings, 'ADELAIDEX_LTI_COHORT_CACHE_STALE', 0)
+
+    def entry(self, oauth_key, now=None):
+        '''Return the (cohort, credentials, expires) entry for the oauth key, loading the
+           cohort from the database if missing or expired.  Credentials are None until
+           first needed.
+
+           Expired entries within the stale window are returned as they are, and
+           reloaded in the background.'''
+        if not now:
+            now = time.time()
+        entry = self.cohorts.get(oauth_key)
+        if entry and entry[2] > now:
+            metrics.cohort_lookups.inc(result='hit')
+            return entry
+
+        if entry and now < entry[2] + self.stale_ttl():
+            metrics.stale_cohorts.inc(reason='refresh')
+            self.refresh_async(oauth_key)
+            return entry
+
+        metrics.cohort_lookups.inc(result='miss')
+        return self.load(oauth_key, now)
+
+    def load(self, oauth_key, now=None, with_credentials=False):
+        '''Load the cohort for the oauth key, and its credentials if asked, from the database.'''
+        generation = self.generation
+        if oauth_key is DEFAULT_KEY:
+            cohort = Cohort.objects.filter(is_default=True).first()
+        else:
+            cohort = Cohort.objects.filter(oauth_key=oauth_key).first()
+        credentials = None
+        if cohort and with_credentials:
+            credentials = cohort.credentials.all()
+        return self.set(oauth_key, cohort, now, credentials, generation)
+
+    def refresh_async(self, oauth_key):
+        '''Reload the oauth key's entry in a background thread, unless one is already
+           doing so.'''
+        with self.lock:
+            if oauth_key in self.refreshing:
+                return False
+            self.refreshing.add(oauth_key)
+        self.spawn(self.refresh, oauth_key)
+        return True
+
+    def refresh(self, oauth_key):
+        try:
+            self.load(oauth_key, with_credentials=oauth_key is not DEFAULT_KEY)
+        except DatabaseError:
+            logger.warning('Could not refresh the cohort for key %s' % oauth_key, exc_info=True)
+        finally:
+            with self.lock:
+                self.refreshing.discard(oauth_key)
+
+    def spawn(self, target, *args):
+        def run():
+            try:
+                target(*args)
+            finally:
+                connection.close()
+        thread = threading.Thread(target=run, name='lti-cohort-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def get(self, oauth_key, now=None):
+        '''Return the Cohort with the given oauth key, or None if there isn't one.'''
+        return self.entry(oauth_key, now)[0]
+
+    def set(self, oauth_key, cohort, now=None, credentials=None, generation=None):
+        '''Store the cohort, and its credentials if given, against the oauth key.
+           Loads which started before the registry was last cleared aren't stored.'''
+        if not now:
+            now = time.time()
+        if credentials is not None:
+            credentials = tuple(sorted(credentials, key=lambda credential: credential.created_at,
+                                       reverse=True))
+        entry = (cohort, credentials, now + self.ttl())
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return entry
+            if len(self.cohorts) >= self.max_size:
+                self.cohorts = {}
+                self.preferred = {}
+            self.cohorts[oauth_key] = entry
+        return entry
+
+    def default(self, now=None):
+        '''Return the default Cohort, or None if there isn't one.'''
+        return self.get(DEFAULT_KEY, now)
+
+    def credentials(self, oauth_key, now=None):
+        '''Return the CohortCredentials for the oauth key's cohort, newest first.'''
+        (cohort, credentials, expires) = self.entry(oauth_key, now)
+        if cohort is None:
+            return ()
+        if credentials is None:
+            try:
+                credentials = self.set(oauth_key, cohort, expires - self.ttl(),
+                                       credentials=cohort.credentials.all())[1]
+            except DatabaseError:
+                # the cohort's own secret still works
+                logger.warning('Could not load the credentials for key %s' % oauth_key, exc_info=True)
+                return ()
+        return credentials
+
+    def secrets(self, oauth_key, now=None):
+        '''Return the secrets accepted for the oauth key, the last one to verify a launch first:
+
+             * the secret in settings.LTI_OAUTH_CREDENTIALS,
+             * the Cohort's oauth_secret,
+             * its valid CohortCredentials, newest first.'''
+        cohort = self.get(oauth_key, now)
+        secrets = []
+        secret = get_config().oauth_secret(oauth_key)
+        if secret is not None:
+            secrets.append(secret)
+        if cohort:
+            secrets.append(cohort.oauth_secret)
+            current = timezone.now()
+            secrets.extend(credential.oauth_secret for credential in self.credentials(oauth_key, now)
+                           if credential.is_valid(current))
+
+        ordered = []
+        preferred = self.preferred.get(oauth_key)
+        if preferred in secrets:
+            ordered.append(preferred)
+        for secret in secrets:
+            if secret not in ordered:
+                ordered.append(secret)
+        return ordered
+
+    def prefer(self, oauth_key, secret):
+        '''Remember that the secret verified a launch for the oauth key.'''
+        if self.preferred.get(oauth_key) != secret:
+            with self.lock:
+                self.preferred[oauth_key] = secret
+
+    def clear(self):
+        '''Drop the cached cohorts and credentials, keeping the preferred secrets.'''
+        with self.lock:
+            self.cohorts = {}
+            self.generation += 1
+
+    def reset(self):
+        with self.lock:
+            self.cohorts = {}
+            self.preferred = {}
+            self.generation += 1
+
+
+cohort_registry = CohortRegistry()
+
+
+@receiver(signals.post_save, sender=Cohort, dispatch_uid='clear_cohort_registry_save')
+@receiver(signals.post_delete, sender=Cohort, dispatch_uid='clear_cohort_registry_delete')
+@receiver(signals.post_save, sender=CohortCredential, dispatch_uid='clear_cohort_registry_credential_save')
+@receiver(signals.post_delete, sender=CohortCredential, dispatch_uid='clear_cohort_registry_credential_delete')
+def clear_cohort_registry(sender, **kwargs):
+    '''Cohort keys and secrets may have changed, so reload them on next use.'''
+    cohort_registry.clear()
+
+
+@receiver(setting_changed)
+def reset_cohort_registry(sender, setting=None, **kwargs):
+    if setting in SETTING_NAMES or setting.startswith('ADELAIDEX_LTI_COHORT_CACHE_'):
+        cohort_registry.reset()
@@ -0,0 +1,257 @@
+'''
+Record sanitized LTI launches, and replay them for load testing.
+
+Add django_adelaidex.lti.middleware.LaunchRecordingMiddleware and set:
+
+    ADELAIDEX_LTI_RECORDING = {
+        'FILE': '/var/log/myapp/launches.jsonl',
+        'RATE': 1.0,    # fraction of launches to record
+    }
+
+Each launch is appended to FILE as a line of JSON, with the oauth signature, nonce and
+consumer key removed, and personal details replaced by salted hashes.  Replay them with
+`manage.py lti_replay_launches`, which re-signs each launch with a test cohort's
+credentials.
+
+oauth2 and the Django test client are only imported when replaying, since the recording
+middleware is loaded by every worker.
+'''
+from django.conf import settings
+from Queue import Queue
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import urllib
+import urllib2
+
+logger = logging.getLogger(__name__)
+
+# Launch params which identify the student, and are hashed when recorded, with or
+# without a custom_ prefix
+PII_PARAMS = (
+    'user_id',
+    'user_image',
+    'lis_result_sourcedid',
+    'canvas_user_id',
+    'canvas_user_login_id',
+)
+
+# Families of launch params which identify the student, e.g. lis_person_name_full
+PII_PREFIXES = (
+    'lis_person_',
+    'ext_user_',
+)
+
+# Launch params which are only valid for the original launch, and are dropped when recorded
+SECRET_PARAMS = (
+    'oauth_consumer_key',
+    'oauth_nonce',
+    'oauth_signature',
+    'oauth_signature_method',
+    'oauth_timestamp',
+    'oauth_version',
+    'oauth_callback',
+)
+
+
+def recording_settings():
+    '''Return settings.ADELAIDEX_LTI_RECORDING, with defaults filled in.'''
+    conf = {
+        'FILE': None,
+        'RATE': 1.0,
+        'SALT': settings.SECRET_KEY,
+    }
+    conf.update(getattr(settings, 'ADELAIDEX_LTI_RECORDING', {}))
+    return conf
+
+
+def new_nonce():
+    return str(random.getrandbits(64))
+
+
+def sign_launch(url, params, key, secret, method='POST'):
+    '''Return a copy of the launch params, with the oauth params added and signed
+       with the given consumer key and secret.'''
+    from oauth2 import Request, Consumer, SignatureMethod_HMAC_SHA1
+    signer = SignatureMethod_HMAC_SHA1()
+    signed = dict(params)
+    signed.update({
+        'oauth_consumer_key': key,
+        'oauth_signature_method': signer.name,
+        'oauth_timestamp': str(int(time.time())),
+        'oauth_nonce': new_nonce(),
+        'oauth_version': '1.0',
+    })
+    request = Request(method, url, signed)
+    signed['oauth_signature'] = signer.sign(request, Consumer(key, secret), None)
+    return signed
+
+
+def hash_value(value, salt):
+    return hashlib.sha256(('%s:%s' % (salt, value)).encode('utf-8')).hexdigest()[:20]
+
+
+def is_pii(name):
+    '''Return True if the launch param identifies the student.'''
+    if name.startswith('custom_'):
+        name = name[len('custom_'):]
+    return name in PII_PARAMS or name.startswith(PII_PREFIXES)
+
+
+def sanitize_launch(params, salt):
+    '''Return the launch params without oauth secrets, and with personal details hashed.'''
+    sanitized = {}
+    for (name, value) in params.items():
+        if name in SECRET_PARAMS:
+            continue
+        if is_pii(name) and value:
+            value = hash_value(value, salt)
+            if 'email' in name:
+                value = '%s@example.com' % value
+        sanitized[name] = value
+    return sanitized
+
+
+class LaunchRecorder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def record(self, request):
+        '''Append the sanitized launch to the recording FILE, if sampled.'''
+        conf = recording_settings()
+        if not conf['FILE'] or random.random() >= conf['RATE']:
+            return False
+        line = json.dumps({
+            't': time.time(),
+            'path': request.path,
+            'params': sanitize_launch(request.POST.dict(), conf['SALT']),
+        })
+        try:
+            with self.lock:
+                with open(conf['FILE'], 'a') as recording:
+                    recording.write(line + '\n')
+        except (IOError, OSError):
+            logger.exception('Could not record launch to %s' % conf['FILE'])
+            return False
+        return True
+
+
+launch_recorder = LaunchRecorder()
+
+
+def read_launches(recording):
+    '''Yield the launches recorded in the given file object.'''
+    for line in recording:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def replay_schedule(launches, rate=None, speed=1.0):
+    '''Return (seconds from start, launch) pairs: rate launches per second if given,
+       or else the recorded timing, sped up by the given factor.'''
+    schedule = []
+    start = None
+    for (index, launch) in enumerate(launches):
+        if rate:
+            offset = index / float(rate)
+        else:
+            if start is None:
+                start = launch.get('t', 0)
+            offset = (launch.get('t', 0) - start) / float(speed)
+        schedule.append((offset, launch))
+    return schedule
+
+
+class HTTPSender(object):
+    '''Posts launches to a running server.'''
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def url(self, path):
+        return self.base_url + path
+
+    def send(self, url, params):
+        data = urllib.urlencode(dict((k, unicode(v).encode('utf-8')) for (k, v) in params.items()))
+        try:
+            return urllib2.urlopen(url, data).getcode()
+        except urllib2.HTTPError as error:
+            return error.code
+
+
+def replay_host():
+    '''Return a host name this project accepts: the first in settings.ALLOWED_HOSTS.'''
+    for host in settings.ALLOWED_HOSTS:
+        host = host.lstrip('.')
+        if host and host != '*':
+            return host
+    if '*' in settings.ALLOWED_HOSTS:
+        return 'testserver'
+    # allowed when DEBUG is on
+    return 'localhost'
+
+
+class ClientSender(object):
+    '''Posts launches to this Django project in-process, with the test client, on the
+       first host in settings.ALLOWED_HOSTS.'''
+
+    def __init__(self, host=None):
+        self.local = threading.local()
+        self.host = host or replay_host()
+
+    def url(self, path):
+        return 'http://%s%s' % (self.host, path)
+
+    def send(self, url, params):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            from django.test import Client
+            client = self.local.client = Client(HTTP_HOST=self.host)
+        client.logout()
+        return client.post(url[len(self.url('')):], params).status_code
+
+
+def replay_launches(launches, sender, key, secret, rate=None, speed=1.0, concurrency=1):
+    '''Re-sign and send the recorded launches on schedule, with up to concurrency
+       launches in flight.  Returns a list of (status code, seconds) for each launch.'''
+    queue = Queue(maxsize=concurrency * 2)
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+        while True:
+            launch = queue.get()
+            if launch is None:
+                break
+            url = sender.url(launch.get('path', '/'))
+            params = sign_launch(url, launch['params'], key, secret)
+            started = time.time()
+            try:
+                status = sender.send(url, params)
+            except Exception as error:
+                logger.warning('Launch failed: %s' % error)
+                status = None
+            with results_lock:
+                results.append((status, time.time() - started))
+
+    workers = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    start = time.time()
+    for (offset, launch) in replay_schedule(launches, rate, speed):
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        queue.put(launch)
+    for thread in workers:
+        queue.put(None)
+    for thread in workers:
+        thread.join()
+    return results
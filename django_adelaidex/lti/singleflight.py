@@ -0,0 +1,77 @@
+'''
+Single-flight coalescing of duplicate LTI launches.
+
+LMS iframes often submit the same launch twice within a second.  The first request
+to arrive takes a lock in the Django cache and does the work; duplicates arriving
+meanwhile wait for its result, and duplicates arriving shortly after reuse it.
+'''
+from django.conf import settings
+from django.core.cache import cache
+import hashlib
+import time
+
+
+def coalesce_settings():
+    '''Return settings.ADELAIDEX_LTI_COALESCE, with defaults filled in.
+
+       NONCE_TTL: seconds to remember the outcome of each (consumer key, nonce) launch.
+       USER_WINDOW: seconds in which launches by the same user share one outcome.
+       WAIT: seconds a duplicate launch waits for the first one to finish.
+       Any of these may be 0 to disable it.'''
+    conf = {
+        'NONCE_TTL': 30,
+        'USER_WINDOW': 0,
+        'WAIT': 2,
+    }
+    conf.update(getattr(settings, 'ADELAIDEX_LTI_COALESCE', {}))
+    return conf
+
+
+class SingleFlight(object):
+
+    # Seconds between checks for the first request's result
+    poll_interval = 0.05
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def cache_key(self, kind, key):
+        return '%s:%s:%s' % (self.prefix, kind, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def do(self, key, func, ttl, wait):
+        '''Return (result, shared): the result of func(), or of a concurrent or recent
+           call with the same key, and whether it was shared from another call.
+
+           Results of None are not shared.  If the call holding the lock doesn't
+           finish within wait seconds, func() is called anyway.'''
+        result_key = self.cache_key('result', key)
+        lock_key = self.cache_key('lock', key)
+
+        result = cache.get(result_key)
+        if result is not None:
+            return (result, True)
+
+        if not cache.add(lock_key, 1, int(wait) + 1):
+            deadline = time.time() + wait
+            while time.time() < deadline:
+                time.sleep(self.poll_interval)
+                result = cache.get(result_key)
+                if result is not None:
+                    return (result, True)
+                if cache.get(lock_key) is None:
+                    break
+            return (func(), False)
+
+        try:
+            result = func()
+            if result is not None:
+                cache.set(result_key, result, ttl)
+        finally:
+            cache.delete(lock_key)
+        return (result, False)
+
+    def forget(self, key):
+        cache.delete(self.cache_key('result', key))
+
+
+launch_flights = SingleFlight('lti-launch')
@@ -42,6 +42,8 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django_auth_lti.middleware.LTIAuthMiddleware',
+    'django_adelaidex.lti.middleware.LaunchThrottleMiddleware',
+    'django_adelaidex.lti.middleware.ActiveCohortMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django_adelaidex.lti.middleware.TimezoneMiddleware',
 )
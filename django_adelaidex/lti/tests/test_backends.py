@@ -0,0 +1,391 @@
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.conf import settings
+from django.db import connection
+from django.db.models import signals
+from django.core.cache import cache
+from django.contrib.auth.models import Group, Permission
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
+from django.core.management import call_command
+from django.utils.six import StringIO
+from mock import patch
+
+from django_adelaidex.lti.backends import CohortLTIAuthBackend
+from django_adelaidex.lti.models import Cohort, CohortCredential, CohortMembership, DeferredUserUpdate, User, UserForm
+from django_adelaidex.lti.oauth import hmac_keys
+from django_adelaidex.lti.registry import cohort_registry
+from django_adelaidex.lti.throttling import LaunchThrottled, launch_buckets
+from django_adelaidex.lti.validation import LaunchRejected
+from django_adelaidex.lti.replay import sign_launch
+from django_adelaidex.lti.tests.test_deferred import ManualDeferredUpdates
+from django_adelaidex.lti.tests.views import TestOauthPostView
+
+
+class CohortLTIAuthBackendTest(TestCase):
+
+    def setUp(self):
+        super(CohortLTIAuthBackendTest, self).setUp()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        self.backend = CohortLTIAuthBackend()
+        self.factory = RequestFactory()
+        cache.clear()
+        launch_buckets.reset()
+        cohort_registry.reset()
+
+    def launch_params(self, uid='student'):
+        path = reverse('lti-entry')
+        return TestOauthPostView().oauth_params(
+            action='http://testserver%s' % path, uid=uid, key=self.cohort.oauth_key)
+
+    def launch_request(self, uid='student', params=None):
+        return self.factory.post(reverse('lti-entry'), params or self.launch_params(uid))
+
+    def test_launch_creates_user(self):
+        user = self.backend.authenticate(self.launch_request())
+        self.assertIsNotNone(user)
+        self.assertEquals(user.username, 'cuid:student')
+        self.assertEquals(user.cohort, self.cohort)
+        self.assertIsNotNone(user.last_login)
+        self.assertIsNotNone(user.last_launch)
+
+        user = User.objects.get(username='cuid:student')
+        self.assertEquals(user.cohort, self.cohort)
+        self.assertIsNotNone(user.last_launch)
+
+    @override_settings(ADELAIDEX_LTI_LAST_LOGIN_WINDOW=10)
+    def test_relaunch_no_writes(self):
+        user = self.backend.authenticate(self.launch_request())
+        last_launch = User.objects.get(id=user.id).last_launch
+
+        with CaptureQueriesContext(connection) as queries:
+            user = self.backend.authenticate(self.launch_request())
+        self.assertIsNotNone(user)
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEquals(updates, [])
+        self.assertEquals(User.objects.get(id=user.id).last_launch, last_launch)
+
+    def test_relaunch_single_update(self):
+        user = self.backend.authenticate(self.launch_request())
+
+        with CaptureQueriesContext(connection) as queries:
+            user = self.backend.authenticate(self.launch_request())
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEquals(len(updates), 1)
+
+    @override_settings(ADELAIDEX_LTI_LAST_LOGIN_WINDOW=10)
+    def test_other_cohort_launch(self):
+        other = Cohort.objects.create(
+            title='Other Cohort',
+            oauth_key='otherkey',
+            oauth_secret='othersecret',
+            login_url='http://google.com',
+        )
+        user = self.backend.authenticate(self.launch_request())
+        self.assertIsNone(user.active_membership)
+
+        # Launching from another cohort adds a membership, and leaves the user's cohort alone
+        path = 'http://testserver%s' % reverse('lti-entry')
+        params = TestOauthPostView().oauth_params(action=path, uid='student', key=other.oauth_key)
+        user = self.backend.authenticate(self.launch_request(params=params))
+        self.assertEquals(user.active_membership.cohort, other)
+        self.assertEquals(Cohort.objects.get_current(user), other)
+        self.assertEquals(User.objects.get(id=user.id).cohort, self.cohort)
+        self.assertEquals(CohortMembership.objects.filter(user=user).count(), 2)
+
+        # Relaunching from it doesn't write anything
+        params = TestOauthPostView().oauth_params(action=path, uid='student', key=other.oauth_key)
+        with CaptureQueriesContext(connection) as queries:
+            user = self.backend.authenticate(self.launch_request(params=params))
+        writes = [q for q in queries.captured_queries
+                  if q['sql'].startswith('UPDATE') or q['sql'].startswith('INSERT')]
+        self.assertEquals(writes, [])
+        self.assertEquals(user.active_membership.cohort, other)
+
+        # And launching from the user's own cohort again returns to it
+        user = self.backend.authenticate(self.launch_request())
+        self.assertIsNone(user.active_membership)
+        self.assertEquals(Cohort.objects.get_current(user), self.cohort)
+
+    def test_throttled(self):
+        self.cohort.user_launch_rate_limit = 1
+        self.cohort.save()
+
+        self.assertIsNotNone(self.backend.authenticate(self.launch_request()))
+
+        request = self.launch_request()
+        self.assertRaises(LaunchThrottled, self.backend.authenticate, request)
+        self.assertTrue(request.lti_throttled > 0)
+
+        # Other users can still launch
+        self.assertIsNotNone(self.backend.authenticate(self.launch_request(uid='student2')))
+
+    def test_forged_launch_not_throttled(self):
+        self.cohort.user_launch_rate_limit = 1
+        self.cohort.save()
+        path = 'http://testserver%s' % reverse('lti-entry')
+        launch = {'user_id': 'student', 'lti_message_type': 'basic-lti-launch-request'}
+
+        # Launches with bad signatures don't use up the user's launches
+        for i in range(3):
+            params = sign_launch(path, launch, 'mykey', 'badsecret')
+            self.assertRaises(PermissionDenied, self.backend.authenticate,
+                              self.launch_request(params=params))
+
+        params = sign_launch(path, launch, 'mykey', 'mysecret')
+        self.assertIsNotNone(self.backend.authenticate(self.launch_request(params=params)))
+
+    def test_duplicate_launch(self):
+        params = self.launch_params()
+        user = self.backend.authenticate(self.launch_request(params=params))
+
+        # Resubmitted launch reuses the first one's user, without writes
+        with CaptureQueriesContext(connection) as queries:
+            duplicate = self.backend.authenticate(self.launch_request(params=params))
+        self.assertEquals(duplicate, user)
+        writes = [q for q in queries.captured_queries
+                  if q['sql'].startswith('UPDATE') or q['sql'].startswith('INSERT')]
+        self.assertEquals(writes, [])
+
+    @override_settings(ADELAIDEX_LTI_COALESCE={'NONCE_TTL': 0})
+    def test_duplicate_launch_disabled(self):
+        params = self.launch_params()
+        user = self.backend.authenticate(self.launch_request(params=params))
+
+        with CaptureQueriesContext(connection) as queries:
+            duplicate = self.backend.authenticate(self.launch_request(params=params))
+        self.assertEquals(duplicate, user)
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEquals(len(updates), 1)
+
+    @override_settings(ADELAIDEX_LTI_COALESCE={'USER_WINDOW': 60})
+    def test_user_window(self):
+        user = self.backend.authenticate(self.launch_request())
+
+        # New launch by the same user is verified, but reuses the user
+        with CaptureQueriesContext(connection) as queries:
+            relaunch = self.backend.authenticate(self.launch_request())
+        self.assertEquals(relaunch, user)
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEquals(updates, [])
+
+        # But an invalid signature is still refused
+        params = self.launch_params()
+        params['oauth_signature'] = 'invalid'
+        self.assertRaises(PermissionDenied, self.backend.authenticate, self.launch_request(params=params))
+
+    def test_rejected_before_signature(self):
+        params = self.launch_params()
+        params['oauth_timestamp'] = '1'
+        with self.assertNumQueries(0):
+            self.assertRaises(LaunchRejected, self.backend.authenticate, self.launch_request(params=params))
+
+        params = self.launch_params()
+        del params['oauth_consumer_key']
+        self.assertRaises(LaunchRejected, self.backend.authenticate, self.launch_request(params=params))
+
+    @override_settings(ADELAIDEX_LTI_DEFERRED_UPDATES={'MODE': 'queue'})
+    def test_deferred_updates(self):
+        updates = ManualDeferredUpdates()
+        with patch('django_adelaidex.lti.deferred.deferred_updates', updates):
+            user = self.backend.authenticate(self.launch_request())
+
+            # Relaunch buffers the timestamps instead of updating the user, or queueing them
+            with CaptureQueriesContext(connection) as queries:
+                self.backend.authenticate(self.launch_request())
+            writes = [q for q in queries.captured_queries
+                      if q['sql'].startswith('UPDATE') or q['sql'].startswith('INSERT')]
+            self.assertEquals(writes, [])
+
+        # Both launches are queued in one row
+        self.assertEquals(updates.flush(), 1)
+        self.assertEquals(DeferredUserUpdate.objects.filter(user=user).count(), 1)
+
+        self.assertIsNone(User.objects.get(id=user.id).last_launch)
+        call_command('lti_deferred_updates', stdout=StringIO())
+        self.assertIsNotNone(User.objects.get(id=user.id).last_launch)
+
+    def test_rotated_secrets(self):
+        path = 'http://testserver%s' % reverse('lti-entry')
+        launch = {'user_id': 'student', 'lti_message_type': 'basic-lti-launch-request'}
+        CohortCredential.objects.create(cohort=self.cohort, oauth_secret='newsecret')
+
+        # Launches signed with either secret are accepted
+        for secret in ('newsecret', 'mysecret', 'newsecret'):
+            params = sign_launch(path, launch, 'mykey', secret)
+            self.assertIsNotNone(self.backend.authenticate(self.launch_request(params=params)))
+        self.assertEquals(cohort_registry.secrets('mykey')[0], 'newsecret')
+
+        # Once verified, only the preferred secret is signed with
+        hmac_keys.clear()
+        params = sign_launch(path, launch, 'mykey', 'newsecret')
+        self.backend.authenticate(self.launch_request(params=params))
+        self.assertEquals(hmac_keys.keys.keys(), ['newsecret'])
+
+        # Until the credential is retired
+        CohortCredential.objects.filter(oauth_secret='newsecret').update(is_active=False)
+        cohort_registry.clear()
+        params = sign_launch(path, launch, 'mykey', 'newsecret')
+        self.assertRaises(PermissionDenied, self.backend.authenticate, self.launch_request(params=params))
+
+
+@override_settings(ADELAIDEX_LTI_PERMISSION_CACHE_TTL=300)
+class PermissionCacheTest(TestCase):
+
+    def setUp(self):
+        super(PermissionCacheTest, self).setUp()
+        cache.clear()
+        self.backend = CohortLTIAuthBackend()
+        self.group = Group.objects.create(name='Editors')
+        self.permission = Permission.objects.get(codename='change_cohort')
+        self.other_permission = Permission.objects.get(codename='delete_cohort')
+        self.group.permissions.add(self.permission)
+        self.user = User.objects.create_user('user1')
+        self.user.groups.add(self.group)
+
+    def fresh_user(self):
+        # as loaded by a new request
+        return User.objects.get(pk=self.user.pk)
+
+    def test_cached(self):
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.backend.has_perm(user, 'lti.change_cohort'))
+            self.assertFalse(self.backend.has_perm(user, 'lti.delete_cohort'))
+
+    def test_disabled(self):
+        with self.settings(ADELAIDEX_LTI_PERMISSION_CACHE_TTL=0):
+            self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+            self.assertIsNone(cache.get('lti-perms:%s' % self.user.pk))
+
+        # Disabled by default, since it needs a cache shared by all processes
+        with self.settings():
+            del settings.ADELAIDEX_LTI_PERMISSION_CACHE_TTL
+            self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+            self.assertIsNone(cache.get('lti-perms:%s' % self.user.pk))
+
+    def test_group_permissions_changed(self):
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'lti.delete_cohort'))
+        self.group.permissions.add(self.other_permission)
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.delete_cohort'))
+
+        self.group.permissions.clear()
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+
+    def test_user_groups_changed(self):
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+        self.user.groups.remove(self.group)
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+
+        self.group.user_set.add(self.user)
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+
+    def test_user_permissions_changed(self):
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'lti.delete_cohort'))
+        self.user.user_permissions.add(self.other_permission)
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.delete_cohort'))
+
+    def test_user_deactivated(self):
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+        self.user.is_active = True
+        self.user.save(update_fields=['is_active'])
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+
+    def test_group_deleted(self):
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+        self.group.delete()
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+
+    def test_cached_during_clear(self):
+        def cache_permissions(sender, action=None, **kwargs):
+            # another request caches the user's permissions before the rows are removed
+            if action == 'pre_clear':
+                self.backend.has_perm(self.fresh_user(), 'lti.change_cohort')
+
+        signals.m2m_changed.connect(cache_permissions, sender=Group.permissions.through)
+        try:
+            self.permission.group_set.clear()
+        finally:
+            signals.m2m_changed.disconnect(cache_permissions, sender=Group.permissions.through)
+        self.assertFalse(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+
+    def test_permission_deleted(self):
+        self.user.user_permissions.add(self.other_permission)
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.change_cohort'))
+        self.assertTrue(self.backend.has_perm(self.fresh_user(), 'lti.delete_cohort'))
+
+        self.permission.delete()
+        self.other_permission.delete()
+        user = self.fresh_user()
+        self.assertFalse(self.backend.has_perm(user, 'lti.change_cohort'))
+        self.assertFalse(self.backend.has_perm(user, 'lti.delete_cohort'))
+
+
+@override_settings(ADELAIDEX_LTI_PERMISSION_CACHE_TTL=300)
+class OtherCohortStaffTest(TestCase):
+    '''Users have the staff role, and the staff group's permissions, of the cohort they
+       launched from.'''
+    fixtures = ['000_staff_group.json']
+
+    def setUp(self):
+        super(OtherCohortStaffTest, self).setUp()
+        cache.clear()
+        self.backend = CohortLTIAuthBackend()
+        self.cohort = Cohort.objects.create(title='Test Cohort', oauth_key='mykey',
+                                            oauth_secret='mysecret', login_url='http://google.com')
+        self.cohort2 = Cohort.objects.create(title='Test Cohort 2', oauth_key='mykey2',
+                                             oauth_secret='mysecret2', login_url='http://google.com')
+
+    def test_instructor_in_other_cohort(self):
+        student = User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+
+        # An Instructor launch from the other cohort saves the entry form as staff there
+        user = User.objects.get(pk=student.pk)
+        user.activate_membership(CohortMembership.objects.join(user, self.cohort2))
+        user.is_staff = True
+        form = UserForm(instance=user, data={'first_name': 'Alice', 'cohort': self.cohort.id})
+        self.assertTrue(form.is_valid())
+        self.assertEquals(form.save(), user)
+
+        membership = CohortMembership.objects.get(user=student, cohort=self.cohort2)
+        self.assertTrue(membership.is_staff)
+        self.assertFalse(User.objects.get(pk=student.pk).is_staff)
+        self.assertEquals(list(student.groups.all()), [])
+
+        # Their requests in the other cohort are staff, with the staff group's permissions
+        user = User.objects.get(pk=student.pk)
+        user.activate_membership(membership)
+        self.assertTrue(user.is_staff)
+        self.assertTrue(self.backend.has_perm(user, 'lti.change_cohort'))
+
+        # Saving the user keeps their own role
+        user.save()
+        self.assertTrue(user.is_staff)
+        self.assertFalse(User.objects.get(pk=student.pk).is_staff)
+        self.assertEquals(list(student.groups.all()), [])
+
+        # And their requests in their own cohort aren't staff
+        user = User.objects.get(pk=student.pk)
+        user.activate_membership(None)
+        self.assertFalse(user.is_staff)
+        self.assertFalse(self.backend.has_perm(user, 'lti.change_cohort'))
+
+    def test_student_in_other_cohort(self):
+        staff = User.objects.create_staffuser('staff1', first_name='Bob', cohort=self.cohort)
+        self.assertTrue(self.backend.has_perm(User.objects.get(pk=staff.pk), 'lti.change_cohort'))
+
+        user = User.objects.get(pk=staff.pk)
+        user.activate_membership(CohortMembership.objects.join(user, self.cohort2))
+        self.assertFalse(user.is_staff)
+        self.assertFalse(self.backend.has_perm(user, 'lti.change_cohort'))
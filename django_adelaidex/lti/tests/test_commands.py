@@ -0,0 +1,129 @@
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+from django.utils.six import StringIO
+from datetime import datetime, timedelta
+import json
+import tempfile
+
+from django_adelaidex.lti.models import Cohort, CohortStats, LaunchEvent, LaunchRollup, User
+from django_adelaidex.lti.registry import cohort_registry
+from django_adelaidex.lti.throttling import launch_buckets
+
+
+class CohortStatsCommandTest(TestCase):
+
+    def test_recompute(self):
+        cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        User.objects.create_user('user1', cohort=cohort)
+        User.objects.create_staffuser('staff1', cohort=cohort)
+        CohortStats.objects.all().delete()
+
+        out = StringIO()
+        call_command('lti_cohort_stats', chunk_size=1, stdout=out)
+        self.assertEquals(out.getvalue().strip(), 'Recomputed stats for 1 cohorts.')
+
+        stats = CohortStats.objects.get(cohort=cohort)
+        self.assertEquals(stats.users, 2)
+        self.assertEquals(stats.staff, 1)
+        self.assertEquals(stats.active_users, 0)
+
+
+class LaunchRollupCommandTest(TestCase):
+
+    def test_rollup(self):
+        cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        user1 = User.objects.create_user('user1', cohort=cohort)
+        user2 = User.objects.create_user('user2', cohort=cohort)
+
+        hour = datetime(2016, 3, 1, 10, tzinfo=timezone.utc)
+        LaunchEvent.objects.bulk_create([
+            LaunchEvent(cohort=cohort, user=user1, is_new=True, launched_at=hour),
+            LaunchEvent(cohort=cohort, user=user1, launched_at=hour + timedelta(minutes=10)),
+            LaunchEvent(cohort=cohort, user=user2, launched_at=hour + timedelta(minutes=59)),
+            LaunchEvent(cohort=cohort, user=user2, launched_at=hour + timedelta(hours=1)),
+        ])
+
+        out = StringIO()
+        call_command('lti_launch_rollup', stdout=out)
+        self.assertEquals(out.getvalue().strip(), 'Rolled up launches for 2 cohort hours.')
+
+        first = LaunchRollup.objects.get(cohort=cohort, hour=hour)
+        self.assertEquals(first.launches, 3)
+        self.assertEquals(first.unique_users, 2)
+        self.assertEquals(first.new_users, 1)
+        self.assertEquals(first.returning_users, 1)
+
+        # Only the hours with new events are recounted
+        LaunchEvent.objects.create(cohort=cohort, user=user1,
+                                   launched_at=hour + timedelta(hours=1, minutes=5))
+        self.assertEquals(LaunchRollup.objects.rollup(), 1)
+        self.assertEquals(LaunchRollup.objects.count(), 2)
+
+        second = LaunchRollup.objects.get(cohort=cohort, hour=hour + timedelta(hours=1))
+        self.assertEquals(second.launches, 2)
+        self.assertEquals(second.unique_users, 2)
+        self.assertEquals(second.returning_users, 2)
+
+        # An event arriving late is counted into its already rolled up hour
+        LaunchEvent.objects.create(cohort=cohort, user=user2, is_new=True,
+                                   launched_at=hour + timedelta(minutes=30))
+        self.assertEquals(LaunchRollup.objects.rollup(), 1)
+        first = LaunchRollup.objects.get(cohort=cohort, hour=hour)
+        self.assertEquals(first.launches, 4)
+        self.assertEquals(first.new_users, 2)
+        self.assertEquals(first.returning_users, 0)
+
+        # Nothing new, nothing written
+        self.assertEquals(LaunchRollup.objects.rollup(), 0)
+        self.assertEquals(LaunchRollup.objects.count(), 2)
+
+
+# The replay's worker threads use their own database connections, so the test data
+# must be committed
+@override_settings(ALLOWED_HOSTS=['.lti.example.com'])
+class LaunchReplayCommandTest(TransactionTestCase):
+
+    def setUp(self):
+        super(LaunchReplayCommandTest, self).setUp()
+        cache.clear()
+        launch_buckets.reset()
+        cohort_registry.reset()
+
+    def test_replay_in_process(self):
+        cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        launch = {'lti_message_type': 'basic-lti-launch-request'}
+        recording = tempfile.NamedTemporaryFile(suffix='.jsonl')
+        for (t, uid) in ((100.0, 'student1'), (100.5, 'student2')):
+            recording.write(json.dumps({'t': t, 'path': reverse('lti-entry'),
+                                        'params': dict(launch, user_id=uid)}) + '\n')
+        recording.flush()
+
+        # The launches are signed for, and posted to, a host the project accepts
+        out = StringIO()
+        call_command('lti_replay_launches', recording.name, cohort='mykey', speed=100,
+                     stdout=out)
+        recording.close()
+        self.assertIn('Replayed 2 launches.', out.getvalue())
+        self.assertNotIn('status 400', out.getvalue())
+        self.assertNotIn('status 403', out.getvalue())
+        self.assertEquals(sorted(User.objects.filter(cohort=cohort).values_list('username', flat=True)),
+                          ['cuid:student1', 'cuid:student2'])
@@ -0,0 +1,106 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth.models import Group
+
+from django_adelaidex.lti.conf import check_permission_cache, get_config, load_config
+from django_adelaidex.lti.models import User
+
+
+class LTISettingsTest(TestCase):
+
+    @override_settings(ADELAIDEX_LTI={
+        'LINK_TEXT': 'My Course',
+        'LOGIN_URL': 'http://google.com',
+        'PERSIST_PARAMS': ['next'],
+    }, LTI_OAUTH_CREDENTIALS={'mykey': 'mysecret'},
+    ADELAIDEX_LTI_DISQUS={'SHORTNAME': 'mycourse'})
+    def test_snapshot(self):
+        config = get_config()
+        self.assertIs(get_config(), config)
+        self.assertEquals(config.link_text, 'My Course')
+        self.assertEquals(config.disqus_shortname, 'mycourse')
+        self.assertEquals(config.disqus_secret_key, '')
+        self.assertTrue(config.has_oauth_key('mykey'))
+        self.assertEquals(config.oauth_secret('mykey'), 'mysecret')
+        self.assertIsNone(config.oauth_secret('otherkey'))
+        self.assertRaises(AttributeError, setattr, config, 'link_text', 'Other')
+        self.assertRaises(AttributeError, setattr, config, 'other', 'Other')
+        self.assertEquals(config.oauth_credentials, (('mykey', 'mysecret'),))
+
+        cohort = config.settings_cohort()
+        self.assertEquals(cohort.title, 'My Course')
+        self.assertEquals(cohort.oauth_key, 'mykey')
+        self.assertEquals(cohort.persist_params, ['next'])
+
+        # It's only built once
+        self.assertIs(config.settings_cohort(), cohort)
+
+        # Rebuilt when settings change
+        with override_settings(ADELAIDEX_LTI_DISQUS={'SHORTNAME': 'other'}):
+            self.assertEquals(get_config().disqus_shortname, 'other')
+        self.assertEquals(get_config().disqus_shortname, 'mycourse')
+        self.assertIsNot(get_config().settings_cohort(), cohort)
+
+    @override_settings(ADELAIDEX_LTI={}, LTI_OAUTH_CREDENTIALS={})
+    def test_no_settings_cohort(self):
+        self.assertIsNone(get_config().settings_cohort())
+
+    def test_invalid(self):
+        with override_settings(LTI_OAUTH_CREDENTIALS=['mykey']):
+            self.assertRaises(ImproperlyConfigured, load_config)
+        with override_settings(ADELAIDEX_LTI_STAFF_MEMBER_GROUP=['Staff']):
+            self.assertRaises(ImproperlyConfigured, load_config)
+
+    def test_staff_group_by_name(self):
+        group = Group.objects.create(name='Course Staff')
+        with override_settings(ADELAIDEX_LTI_STAFF_MEMBER_GROUP='Course Staff'):
+            self.assertEquals(get_config().staff_group_id(), group.pk)
+            user = User.objects.create_staffuser('staff1')
+            self.assertEquals(list(user.groups.all()), [group])
+
+    def test_no_staff_group(self):
+        # The setting is optional
+        with self.settings():
+            del settings.ADELAIDEX_LTI_STAFF_MEMBER_GROUP
+            self.assertIsNone(load_config().staff_group_id())
+
+    @override_settings(ADELAIDEX_LTI_STAFF_MEMBER_GROUP='Missing Staff')
+    def test_missing_staff_group(self):
+        # Users can still be saved, and the group is used once it exists
+        self.assertIsNone(get_config().staff_group_id())
+        user = User.objects.create_staffuser('staff1')
+        self.assertEquals(list(user.groups.all()), [])
+
+        # The missing group isn't looked up again
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_config().staff_group_id())
+
+        group = Group.objects.create(name='Missing Staff')
+        self.assertEquals(get_config().staff_group_id(), group.pk)
+
+    @override_settings(ADELAIDEX_LTI_STAFF_MEMBER_GROUP=None)
+    def test_staff_group_disabled(self):
+        user = User.objects.create_staffuser('staff1')
+        self.assertEquals(list(user.groups.all()), [])
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+SHARED_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                             'LOCATION': 'lti_cache'}}
+
+
+class PermissionCacheCheckTest(TestCase):
+
+    @override_settings(ADELAIDEX_LTI_PERMISSION_CACHE_TTL=300, CACHES=LOCMEM_CACHES)
+    def test_local_cache(self):
+        self.assertEquals([error.id for error in check_permission_cache(None)], ['lti.W001'])
+
+    @override_settings(ADELAIDEX_LTI_PERMISSION_CACHE_TTL=300, CACHES=SHARED_CACHES)
+    def test_shared_cache(self):
+        self.assertEquals(check_permission_cache(None), [])
+
+    @override_settings(ADELAIDEX_LTI_PERMISSION_CACHE_TTL=0, CACHES=LOCMEM_CACHES)
+    def test_disabled(self):
+        self.assertEquals(check_permission_cache(None), [])
@@ -6,10 +6,15 @@ from django.core.urlresolvers import reverse
 import re
 
 from django_adelaidex.util.test import UserSetUp
+from django_adelaidex.lti.registry import cohort_registry
 
 
 class LTILinkTextTest(TestCase):
 
+    def setUp(self):
+        super(LTILinkTextTest, self).setUp()
+        cohort_registry.reset()
+
     def test_lti_link_text_not_set(self):
         client = Client()
         response = client.get(reverse('home'))
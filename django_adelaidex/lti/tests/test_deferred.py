@@ -0,0 +1,98 @@
+from django.db import DatabaseError
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from mock import patch
+
+from django_adelaidex.lti.deferred import DeferredUpdates, defer_user_update, process_queued_updates
+from django_adelaidex.lti.models import Cohort, CohortStats, DeferredUserUpdate, User
+
+
+class ManualDeferredUpdates(DeferredUpdates):
+    '''Doesn't start the background thread, so tests can flush when they choose.'''
+    def start(self):
+        self.thread = False
+
+
+class DeferredUpdatesTest(TestCase):
+
+    def setUp(self):
+        super(DeferredUpdatesTest, self).setUp()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        self.user = User.objects.create_user('user1', cohort=self.cohort)
+
+    def test_flush(self):
+        updates = ManualDeferredUpdates()
+        now = timezone.now()
+        updates.add(self.user.pk, {'email': 'old@example.com'})
+        updates.add(self.user.pk, {'email': 'new@example.com', 'last_login': now})
+
+        # Updates to the same user are coalesced into one write
+        self.assertEquals(updates.flush(), 1)
+        self.assertEquals(updates.pending, {})
+
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEquals(user.email, 'new@example.com')
+        self.assertEquals(user.last_login, now)
+
+        # Login counted towards the cohort's active users
+        self.assertEquals(CohortStats.objects.get(cohort=self.cohort).active_users, 1)
+
+    def test_flush_failed(self):
+        updates = ManualDeferredUpdates()
+        updates.add(self.user.pk, {'email': 'old@example.com', 'last_name': 'Smith'})
+
+        def fail(batch):
+            # another launch arrives while the batch is being written
+            updates.add(self.user.pk, {'email': 'new@example.com'})
+            raise DatabaseError('down')
+
+        with patch('django_adelaidex.lti.deferred.apply_updates', side_effect=fail):
+            self.assertRaises(DatabaseError, updates.flush)
+
+        # The failed batch is kept for the next flush, under the newer update
+        self.assertEquals(updates.pending, {
+            self.user.pk: {'email': 'new@example.com', 'last_name': 'Smith'},
+        })
+        self.assertEquals(updates.flush(), 1)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEquals(user.email, 'new@example.com')
+        self.assertEquals(user.last_name, 'Smith')
+
+    @override_settings(ADELAIDEX_LTI_DEFERRED_UPDATES={'MODE': 'queue'})
+    def test_queue(self):
+        now = timezone.now()
+        other = User.objects.create_user('user2', cohort=self.cohort)
+        updates = ManualDeferredUpdates()
+        with patch('django_adelaidex.lti.deferred.deferred_updates', updates):
+            # Launches don't write anything inline
+            with self.assertNumQueries(0):
+                defer_user_update(self.user.pk, {'last_name': 'Smith', 'last_launch': now})
+                defer_user_update(self.user.pk, {'last_name': 'Jones'})
+                defer_user_update(other.pk, {'last_launch': now})
+        self.assertEquals(DeferredUserUpdate.objects.count(), 0)
+
+        # The three launches are queued with one INSERT, of one row per user
+        with self.assertNumQueries(1):
+            self.assertEquals(updates.flush(), 2)
+        self.assertEquals(DeferredUserUpdate.objects.count(), 2)
+        self.assertIsNone(User.objects.get(pk=self.user.pk).last_launch)
+
+        self.assertEquals(process_queued_updates(), 2)
+        self.assertEquals(DeferredUserUpdate.objects.count(), 0)
+
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEquals(user.last_name, 'Jones')
+        self.assertEquals(user.last_launch, now)
+        self.assertEquals(User.objects.get(pk=other.pk).last_launch, now)
+
+    def test_staff_group_skipped(self):
+        # Saving fields other than is_staff doesn't touch the staff group
+        self.user.email = 'new@example.com'
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['email'])
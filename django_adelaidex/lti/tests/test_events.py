@@ -0,0 +1,80 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from django_adelaidex.lti.events import LaunchEventBuffer, launch_events, record_launch
+from django_adelaidex.lti.models import Cohort, LaunchEvent, User
+
+
+class ManualLaunchEventBuffer(LaunchEventBuffer):
+    '''Records the timer instead of starting it, so tests can flush when they choose.'''
+    timers = 0
+
+    def start_timer(self, interval):
+        self.timers += 1
+
+
+class LaunchEventBufferTest(TestCase):
+
+    def setUp(self):
+        super(LaunchEventBufferTest, self).setUp()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        self.user = User.objects.create_user('user1', cohort=self.cohort)
+        launch_events.flush()
+
+    def event(self):
+        return LaunchEvent(cohort=self.cohort, user=self.user, launched_at=timezone.now())
+
+    @override_settings(ADELAIDEX_LTI_LAUNCH_EVENTS={'BATCH_SIZE': 3, 'INTERVAL': 60})
+    def test_batch_size(self):
+        buffer = ManualLaunchEventBuffer()
+        buffer.add(self.event())
+        buffer.add(self.event())
+        self.assertEquals(LaunchEvent.objects.count(), 0)
+
+        # Third event writes all three in one query
+        with self.assertNumQueries(1):
+            buffer.add(self.event())
+        self.assertEquals(LaunchEvent.objects.count(), 3)
+        self.assertEquals(buffer.events, [])
+
+    @override_settings(ADELAIDEX_LTI_LAUNCH_EVENTS={'BATCH_SIZE': 100, 'INTERVAL': 0})
+    def test_interval(self):
+        buffer = ManualLaunchEventBuffer()
+        buffer.add(self.event())
+        self.assertEquals(LaunchEvent.objects.count(), 1)
+        self.assertEquals(buffer.timers, 0)
+
+    @override_settings(ADELAIDEX_LTI_LAUNCH_EVENTS={'BATCH_SIZE': 100, 'INTERVAL': 60})
+    def test_timer(self):
+        buffer = ManualLaunchEventBuffer()
+        buffer.add(self.event())
+        buffer.add(self.event())
+
+        # One timer for the batch, started by its first event
+        self.assertEquals(buffer.timers, 1)
+        self.assertEquals(LaunchEvent.objects.count(), 0)
+        buffer.flush()
+        self.assertEquals(LaunchEvent.objects.count(), 2)
+
+        buffer.add(self.event())
+        self.assertEquals(buffer.timers, 2)
+
+    def test_disabled(self):
+        record_launch(self.user)
+        self.assertEquals(launch_events.events, [])
+
+    @override_settings(ADELAIDEX_LTI_LAUNCH_EVENTS={'ENABLED': True, 'BATCH_SIZE': 100})
+    def test_record_launch(self):
+        record_launch(self.user, is_new=True)
+        self.assertEquals(launch_events.flush(), 1)
+
+        event = LaunchEvent.objects.get()
+        self.assertEquals(event.cohort, self.cohort)
+        self.assertEquals(event.user, self.user)
+        self.assertTrue(event.is_new)
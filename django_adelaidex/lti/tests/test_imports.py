@@ -0,0 +1,28 @@
+from django.test import SimpleTestCase
+import json
+import os
+import subprocess
+import sys
+
+
+class LazyImportTest(SimpleTestCase):
+    '''The LTI verification stack is only imported on the first launch.'''
+
+    heavy_modules = ('ims_lti_py', 'oauth2', 'httplib2')
+
+    def loaded_modules(self, module):
+        code = ('import json, os, sys\n'
+                'os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_adelaidex.lti.tests.settings")\n'
+                'import django\n'
+                'django.setup()\n'
+                'import %s\n'
+                'print(json.dumps(sorted(sys.modules)))\n' % module)
+        output = subprocess.check_output([sys.executable, '-c', code], env=os.environ.copy())
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_lazy_imports(self):
+        for module in ('django_adelaidex.lti.backends',
+                       'django_adelaidex.lti.middleware'):
+            loaded = set(name.split('.')[0] for name in self.loaded_modules(module))
+            for heavy in self.heavy_modules:
+                self.assertNotIn(heavy, loaded, '%s imports %s' % (module, heavy))
@@ -0,0 +1,174 @@
+from django.test import TestCase
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.core.urlresolvers import reverse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django_adelaidex.util.test import UserSetUp
+from django_adelaidex.lti import metrics
+
+
+class RegistryTest(TestCase):
+
+    def setUp(self):
+        super(RegistryTest, self).setUp()
+        self.registry = metrics.Registry()
+        self.counter = self.registry.counter('test_total', 'Test counter.', ['result'])
+        self.histogram = self.registry.histogram('test_seconds', 'Test histogram.', buckets=(0.1, 1))
+
+    def test_counter(self):
+        self.counter.inc(result='ok')
+        self.counter.inc(result='ok')
+        self.counter.inc(3, result='fail')
+
+        exposed = self.registry.expose()
+        self.assertIn('# TYPE test_total counter\n', exposed)
+        self.assertIn('test_total{result="fail"} 3\n', exposed)
+        self.assertIn('test_total{result="ok"} 2\n', exposed)
+
+    def test_histogram(self):
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+
+        exposed = self.registry.expose()
+        self.assertIn('# TYPE test_seconds histogram\n', exposed)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1\n', exposed)
+        self.assertIn('test_seconds_bucket{le="1"} 2\n', exposed)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3\n', exposed)
+        self.assertIn('test_seconds_sum 5.55\n', exposed)
+        self.assertIn('test_seconds_count 3\n', exposed)
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, metrics.Metric, self.registry, 'test', 'Abstract.')
+
+    def test_settings_read_once(self):
+        with override_settings(ADELAIDEX_LTI_METRICS={'FLUSH_INTERVAL': 60}):
+            self.assertEqual(metrics.metrics_settings()['FLUSH_INTERVAL'], 60)
+            self.assertIs(metrics.metrics_settings(), metrics.metrics_settings())
+        self.assertEqual(metrics.metrics_settings()['FLUSH_INTERVAL'], 5)
+
+    def test_duplicate(self):
+        self.assertRaises(ValueError, self.registry.counter, 'test_total', 'Duplicate.')
+
+    def test_escape_labels(self):
+        self.counter.inc(result='say "hi"\n')
+        self.assertIn('test_total{result="say \\"hi\\"\\n"} 1\n', self.registry.expose())
+
+    def test_shared_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # Values written by another process are added in
+        with open(os.path.join(directory, 'metrics-1.json'), 'w') as other:
+            json.dump({
+                'test_total': [[['ok'], 5]],
+                'test_seconds': [[[], [1, 0, 0, 0.01]]],
+            }, other)
+
+        with override_settings(ADELAIDEX_LTI_METRICS={'DIRECTORY': directory, 'FLUSH_INTERVAL': 0}):
+            self.counter.inc(result='ok')
+            self.histogram.observe(0.5)
+            self.assertTrue(os.path.exists(self.registry.filename(directory)))
+
+            exposed = self.registry.expose()
+            self.assertIn('test_total{result="ok"} 6\n', exposed)
+            self.assertIn('test_seconds_bucket{le="0.1"} 1\n', exposed)
+            self.assertIn('test_seconds_count 2\n', exposed)
+
+    def shared_directory(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+    def exited_pid(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def test_exited_process_archived(self):
+        directory = self.shared_directory()
+        exited = self.registry.filename(directory, self.exited_pid())
+        with open(exited, 'w') as other:
+            json.dump({'test_total': [[['ok'], 5]]}, other)
+
+        with override_settings(ADELAIDEX_LTI_METRICS={'DIRECTORY': directory, 'FLUSH_INTERVAL': 0}):
+            self.counter.inc(result='ok')
+            self.assertIn('test_total{result="ok"} 6\n', self.registry.expose())
+            self.assertFalse(os.path.exists(exited))
+            self.assertTrue(os.path.exists(os.path.join(directory, metrics.Registry.ARCHIVE_FILENAME)))
+
+            # Archived values are counted once
+            self.assertIn('test_total{result="ok"} 6\n', self.registry.expose())
+
+    def test_reused_pid(self):
+        directory = self.shared_directory()
+
+        # An exited process with this process's pid left its values behind
+        with open(self.registry.filename(directory), 'w') as other:
+            json.dump({'test_total': [[['ok'], 5]]}, other)
+
+        with override_settings(ADELAIDEX_LTI_METRICS={'DIRECTORY': directory, 'FLUSH_INTERVAL': 0}):
+            self.counter.inc(result='ok')
+            self.assertIn('test_total{result="ok"} 6\n', self.registry.expose())
+
+    def test_quiet_process_flushed(self):
+        directory = self.shared_directory()
+        timers = []
+        self.registry.start_timer = lambda wait, directory: timers.append(wait)
+
+        with override_settings(ADELAIDEX_LTI_METRICS={'DIRECTORY': directory, 'FLUSH_INTERVAL': 60}):
+            self.counter.inc(result='ok')
+            self.counter.inc(result='ok')
+
+            # One timer flushes the values, though no more arrive
+            self.assertEquals(len(timers), 1)
+            self.assertFalse(os.path.exists(self.registry.filename(directory)))
+            self.registry.flush(directory)
+            self.assertTrue(os.path.exists(self.registry.filename(directory)))
+
+            self.counter.inc(result='ok')
+            self.assertEquals(len(timers), 2)
+
+
+class MetricsViewTest(UserSetUp, TestCase):
+
+    def test_disabled(self):
+        client = Client()
+        response = client.get(reverse('lti-metrics'))
+        self.assertEquals(response.status_code, 404)
+
+    @override_settings(ADELAIDEX_LTI_METRICS={'ENABLED': True})
+    def test_anonymous(self):
+        client = Client()
+        response = client.get(reverse('lti-metrics'))
+        self.assertEquals(response.status_code, 403)
+
+    @override_settings(ADELAIDEX_LTI_METRICS={'ENABLED': True})
+    def test_student(self):
+        client = Client()
+        self.assertLogin(client, reverse('home'), user='student')
+        response = client.get(reverse('lti-metrics'))
+        self.assertEquals(response.status_code, 403)
+
+    @override_settings(ADELAIDEX_LTI_METRICS={'ENABLED': True})
+    def test_staff(self):
+        client = Client()
+        self.assertLogin(client, reverse('home'), user='staff')
+        response = client.get(reverse('lti-metrics'))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn('# TYPE lti_launches_total counter', response.content)
+
+    @override_settings(ADELAIDEX_LTI_METRICS={'ENABLED': True, 'ALLOWED_IPS': ['127.0.0.1']})
+    def test_allowed_ip(self):
+        client = Client()
+        response = client.get(reverse('lti-metrics'), REMOTE_ADDR='127.0.0.1')
+        self.assertEquals(response.status_code, 200)
+
+        response = client.get(reverse('lti-metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEquals(response.status_code, 403)
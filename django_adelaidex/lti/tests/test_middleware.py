@@ -2,12 +2,21 @@ from django.test import TestCase
 from django.utils import timezone
 from django.contrib import auth
 from django.contrib.auth.models import AnonymousUser
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.test.utils import override_settings
+from django.http import HttpResponse
+from django.core.urlresolvers import reverse
+import glob
+import os
 import pytz
+import shutil
+import tempfile
 from mock import Mock
 
 from django_adelaidex.lti.middleware import TimezoneMiddleware, AnonymousCohortMiddleware
+from django_adelaidex.lti.middleware import ProfilingMiddleware, ActiveCohortMiddleware
+from django_adelaidex.lti.models import ACTIVE_COHORT_SESSION_KEY, Cohort, CohortMembership, User
+from django_adelaidex.lti.registry import cohort_registry
 
 
 class TimezoneMiddlewareTest(TestCase):
@@ -61,6 +70,7 @@ class AnonymousCohortMiddlewareTest(TestCase):
 
     def setUp(self):
         super(AnonymousCohortMiddlewareTest, self).setUp()
+        cohort_registry.reset()
         self.acm = AnonymousCohortMiddleware()
         self.request = Mock()
 
@@ -118,3 +128,125 @@ class AnonymousCohortMiddlewareTest(TestCase):
         self.assertIsNotNone(self.request.user.cohort)
         self.assertEquals(self.request.user.cohort, own_cohort)
 
+    def test_anonymous_default_cohort_cached(self):
+        cohort = Cohort.objects.create(title='Test Cohort', oauth_key='mykey',
+                                       oauth_secret='mysecret', login_url='http://google.com',
+                                       is_default=True)
+        for queries in (1, 0):
+            request = RequestFactory().get('/')
+            request.user = AnonymousUser()
+            with self.assertNumQueries(queries):
+                self.assertIsNone(self.acm.process_request(request))
+            self.assertEquals(request.user.cohort, cohort)
+
+
+
+class ActiveCohortMiddlewareTest(TestCase):
+
+    def setUp(self):
+        super(ActiveCohortMiddlewareTest, self).setUp()
+        self.cohort = Cohort.objects.create(title='Test Cohort', oauth_key='mykey',
+                                            oauth_secret='mysecret', login_url='http://google.com')
+        self.cohort2 = Cohort.objects.create(title='Test Cohort 2', oauth_key='mykey2',
+                                             oauth_secret='mysecret2', login_url='http://google.com')
+        self.user = User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        self.middleware = ActiveCohortMiddleware()
+
+    def request(self, cohort=None):
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(id=self.user.id)
+        request.session = {}
+        if cohort:
+            request.session[ACTIVE_COHORT_SESSION_KEY] = cohort.pk
+        return request
+
+    def test_own_cohort(self):
+        for cohort in (None, self.cohort):
+            request = self.request(cohort)
+            with self.assertNumQueries(0):
+                self.assertIsNone(self.middleware.process_request(request))
+            self.assertIsNone(request.user.active_membership)
+            self.assertEquals(Cohort.objects.get_current(request.user), self.cohort)
+
+    def test_other_cohort(self):
+        membership = CohortMembership.objects.join(self.user, self.cohort2)
+        membership.is_staff = True
+        membership.save()
+        request = self.request(self.cohort2)
+        self.assertIsNone(self.middleware.process_request(request))
+        self.assertEquals(request.user.active_membership, membership)
+        self.assertTrue(request.user.is_staff)
+        with self.assertNumQueries(0):
+            self.assertEquals(Cohort.objects.get_current(request.user), self.cohort2)
+
+    def test_anonymous(self):
+        request = self.request()
+        request.user = AnonymousUser()
+        self.assertIsNone(self.middleware.process_request(request))
+        self.assertFalse(hasattr(request.user, 'active_membership'))
+
+
+class ProfilingMiddlewareTest(TestCase):
+
+    def setUp(self):
+        super(ProfilingMiddlewareTest, self).setUp()
+        self.pm = ProfilingMiddleware()
+        self.factory = RequestFactory()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def profile(self, path, **extra):
+        request = self.factory.get(path, **extra)
+        request.user = AnonymousUser()
+        self.assertIsNone(self.pm.process_request(request))
+        profiled = hasattr(request, 'lti_profiler')
+        response = HttpResponse('ok')
+        self.assertEquals(self.pm.process_response(request, response), response)
+        return profiled
+
+    def profiles(self):
+        return glob.glob(os.path.join(self.directory, '*.prof'))
+
+    def test_not_sampled(self):
+        with self.settings(ADELAIDEX_LTI_PROFILING={'DIRECTORY': self.directory}):
+            self.assertFalse(self.profile(reverse('lti-403')))
+        self.assertEquals(self.profiles(), [])
+
+    def test_sampled(self):
+        with self.settings(ADELAIDEX_LTI_PROFILING={'DIRECTORY': self.directory, 'RATE': 1}):
+            self.assertTrue(self.profile(reverse('lti-403')))
+            self.assertFalse(self.profile(reverse('home')))
+        profiles = self.profiles()
+        self.assertEquals(len(profiles), 1)
+        self.assertIn('-lti-403-', profiles[0])
+
+    def test_header(self):
+        with self.settings(ADELAIDEX_LTI_PROFILING={'DIRECTORY': self.directory, 'TOKEN': 'secret'}):
+            # Anonymous users need the token
+            self.assertFalse(self.profile(reverse('home'), HTTP_X_LTI_PROFILE='1'))
+            self.assertTrue(self.profile(reverse('home'), HTTP_X_LTI_PROFILE='secret'))
+        self.assertEquals(len(self.profiles()), 1)
+
+    def test_header_staff(self):
+        request = self.factory.get(reverse('home'), HTTP_X_LTI_PROFILE='1')
+        request.user = Mock()
+        request.user.is_authenticated = lambda: True
+        request.user.is_staff = True
+        with self.settings(ADELAIDEX_LTI_PROFILING={'DIRECTORY': self.directory}):
+            self.pm.process_request(request)
+            self.assertTrue(hasattr(request, 'lti_profiler'))
+            self.pm.process_response(request, HttpResponse('ok'))
+        self.assertEquals(len(self.profiles()), 1)
+
+    def test_rotate(self):
+        with self.settings(ADELAIDEX_LTI_PROFILING={'DIRECTORY': self.directory, 'RATE': 1,
+                                                    'MAX_FILES': 2}):
+            for i in range(4):
+                self.profile(reverse('lti-403'))
+        self.assertEquals(len(self.profiles()), 2)
+
+        # Profiles are only logged with MAX_FILES 0
+        with self.settings(ADELAIDEX_LTI_PROFILING={'DIRECTORY': self.directory, 'RATE': 1,
+                                                    'MAX_FILES': 0}):
+            self.profile(reverse('lti-403'))
+        self.assertEquals(len(self.profiles()), 0)
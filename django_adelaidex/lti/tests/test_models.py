@@ -1,17 +1,30 @@
+from django.apps import apps
 from django.test import TestCase
 from django.core import mail
 from django.core.management import call_command
 from django.contrib.auth.models import AnonymousUser
 from django.test.utils import override_settings
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import IntegrityError
-from mock import Mock
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+from importlib import import_module
+from mock import Mock, patch
 
-from django_adelaidex.lti.models import Cohort, User, UserManager, UserForm
+from django_adelaidex.lti.models import Cohort, CohortMembership, CohortStats, User, UserManager, UserForm
+from django_adelaidex.lti.models import update_last_login
+from django_adelaidex.lti.registry import cohort_registry
+from django_adelaidex.util.widgets import SelectTimeZoneWidget
 
 
 class CohortManagerTests(TestCase):
 
+    def setUp(self):
+        super(CohortManagerTests, self).setUp()
+        cohort_registry.reset()
+
     def test_no_default(self):
         cohort = Cohort.objects.get_current()
         self.assertIsNone(cohort)
@@ -117,6 +130,114 @@ class CohortTests(TestCase):
         self.assertEquals(cohort.persist_params, ['abc', 'def', 'ghi'])
 
 
+class CohortStatsTests(TestCase):
+
+    def setUp(self):
+        super(CohortStatsTests, self).setUp()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        self.cohort2 = Cohort.objects.create(
+            title='Test Cohort 2',
+            oauth_key='mykey2',
+            oauth_secret='mysecret2',
+            login_url='http://google.com',
+        )
+
+    def assertStats(self, cohort, users, staff, active_users):
+        stats = CohortStats.objects.get(cohort=cohort)
+        self.assertEquals((stats.users, stats.staff, stats.active_users),
+                          (users, staff, active_users))
+
+    def test_no_cohort(self):
+        User.objects.create_user('user1')
+        self.assertEquals(CohortStats.objects.count(), 0)
+
+    def test_create(self):
+        User.objects.create_user('user1', cohort=self.cohort)
+        self.assertStats(self.cohort, 1, 0, 0)
+
+        User.objects.create_staffuser('staff1', cohort=self.cohort)
+        self.assertStats(self.cohort, 2, 1, 0)
+
+    def test_update(self):
+        user = User.objects.create_user('user1', cohort=self.cohort)
+        self.assertStats(self.cohort, 1, 0, 0)
+
+        user.is_staff = True
+        user.save()
+        self.assertStats(self.cohort, 1, 1, 0)
+
+        user.last_login = timezone.now()
+        user.save(update_fields=['last_login'])
+        self.assertStats(self.cohort, 1, 1, 1)
+
+        # Saving again doesn't count the user twice
+        user.save()
+        self.assertStats(self.cohort, 1, 1, 1)
+
+        # refetch to ensure the loaded state is tracked
+        user = User.objects.get(username='user1')
+        user.cohort = self.cohort2
+        user.save()
+        self.assertStats(self.cohort, 0, 0, 0)
+        self.assertStats(self.cohort2, 1, 1, 1)
+
+    def test_inactive_login(self):
+        user = User.objects.create_user('user1', cohort=self.cohort,
+            last_login=timezone.now() - timedelta(days=CohortStats.ACTIVE_DAYS + 1))
+        self.assertStats(self.cohort, 1, 0, 0)
+
+    def test_delete(self):
+        user = User.objects.create_user('user1', cohort=self.cohort)
+        User.objects.create_user('user2', cohort=self.cohort)
+        self.assertStats(self.cohort, 2, 0, 0)
+
+        user.delete()
+        self.assertStats(self.cohort, 1, 0, 0)
+
+        User.objects.all().delete()
+        self.assertStats(self.cohort, 0, 0, 0)
+
+    def test_adjust_seeds_from_count(self):
+        User.objects.create_user('user1', cohort=self.cohort)
+        User.objects.create_user('user2', cohort=self.cohort)
+        CohortStats.objects.all().delete()
+
+        # Bulk update, then let CohortStats know what changed
+        User.objects.filter(cohort=self.cohort).update(is_staff=True)
+        CohortStats.objects.adjust({self.cohort.id: {'staff': 2}})
+        self.assertStats(self.cohort, 2, 2, 0)
+
+        CohortStats.objects.adjust({self.cohort.id: {'staff': -1}})
+        self.assertStats(self.cohort, 2, 1, 0)
+
+    def test_recount(self):
+        User.objects.create_user('user1', cohort=self.cohort)
+        User.objects.create_user('user2', cohort=self.cohort)
+
+        # Bulk updates bypass the signals, so recount the cohorts they touched
+        User.objects.filter(cohort=self.cohort).update(is_staff=True)
+        self.assertStats(self.cohort, 2, 0, 0)
+        CohortStats.objects.recount([self.cohort.id, self.cohort2.id])
+        self.assertStats(self.cohort, 2, 2, 0)
+        self.assertStats(self.cohort2, 0, 0, 0)
+
+    def test_recompute(self):
+        User.objects.create_user('user1', cohort=self.cohort, last_login=timezone.now())
+        User.objects.create_staffuser('staff1', cohort=self.cohort)
+        User.objects.create_user('user2', cohort=self.cohort2)
+        User.objects.create_user('user3')
+        CohortStats.objects.all().update(users=100, staff=100, active_users=100)
+
+        self.assertEquals(CohortStats.objects.recompute(chunk_size=1), 2)
+        self.assertStats(self.cohort, 2, 1, 1)
+        self.assertStats(self.cohort2, 1, 0, 0)
+
+
 class UserManagerTests(TestCase):
 
     def test_create_staffuser(self):
@@ -220,6 +341,264 @@ class UserTests(TestCase):
             'user2', first_name='First', cohort=cohort)
 
 
+class UserNicknameTests(TestCase):
+
+    def setUp(self):
+        super(UserNicknameTests, self).setUp()
+        cache.clear()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+
+    def test_nickname_key(self):
+        user = User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        self.assertEquals(user.nickname_key, 'alice')
+
+        user.first_name = 'ALICE2'
+        user.save(update_fields=['first_name'])
+        self.assertEquals(User.objects.get(id=user.id).nickname_key, 'alice2')
+
+        user = User.objects.create_user('user2')
+        self.assertIsNone(user.nickname_key)
+
+    def test_nickname_unique_ignores_case(self):
+        User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        self.assertRaises(IntegrityError, User.objects.create_user,
+            'user2', first_name='alice', cohort=self.cohort)
+
+    def test_nickname_available(self):
+        user = User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        other = User.objects.create_user('user2', cohort=self.cohort)
+
+        self.assertTrue(User.objects.nickname_available('Alice', user))
+        self.assertTrue(User.objects.nickname_available('Bob', other))
+        self.assertFalse(User.objects.nickname_available('ALICE', other))
+
+        # Clashes are cached
+        user.delete()
+        with self.assertNumQueries(0):
+            self.assertFalse(User.objects.nickname_available('alice', other))
+
+        cache.clear()
+        self.assertTrue(User.objects.nickname_available('alice', other))
+
+
+    def test_suggest_nicknames(self):
+        user = User.objects.create_user('user1', cohort=self.cohort)
+        User.objects.create_user('user2', first_name='Alice', cohort=self.cohort)
+        User.objects.create_user('user3', first_name='alice2', cohort=self.cohort)
+        User.objects.create_user('user4', first_name='Alice3', cohort=self.cohort)
+
+        with self.assertNumQueries(1):
+            suggestions = User.objects.suggest_nicknames('Alice', user)
+
+        self.assertEquals(len(suggestions), 3)
+        self.assertEquals(suggestions[0], 'Alice4')
+        for suggestion in suggestions:
+            self.assertTrue(suggestion.startswith('Alice'))
+            self.assertTrue(User.objects.nickname_available(suggestion, user))
+
+    def test_resolve_nickname_clashes(self):
+        migration = import_module('django_adelaidex.lti.migrations.0016_resolve_nickname_clashes')
+        User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        User.objects.create_user('user2', first_name='alice2', cohort=self.cohort)
+        user = User.objects.create_user('user3', first_name='Bob', cohort=self.cohort)
+
+        # A case-only clash, as left by 0010_user_nickname_key
+        User.objects.filter(pk=user.pk).update(first_name='ALICE', nickname_key=None)
+        CohortMembership.objects.filter(user=user).update(first_name='ALICE', nickname_key=None)
+
+        migration.resolve_nickname_clashes(apps, None)
+        user = User.objects.get(pk=user.pk)
+        self.assertEquals(user.first_name, 'ALICE3')
+        self.assertEquals(CohortMembership.objects.get(user=user).nickname_key, 'alice3')
+
+        # so the user can be saved again
+        user.save()
+        self.assertEquals(User.objects.get(pk=user.pk).nickname_key, 'alice3')
+
+    def test_suggest_nicknames_other_cohort(self):
+        user = User.objects.create_user('user1', cohort=self.cohort)
+        User.objects.create_user('user2', first_name='Alice')
+        self.assertEquals(User.objects.suggest_nicknames('Alice', user)[0], 'Alice2')
+        self.assertEquals(User.objects.suggest_nicknames('', user), [])
+
+
+class CohortMembershipTests(TestCase):
+
+    def setUp(self):
+        super(CohortMembershipTests, self).setUp()
+        cache.clear()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        self.cohort2 = Cohort.objects.create(
+            title='Test Cohort 2',
+            oauth_key='mykey2',
+            oauth_secret='mysecret2',
+            login_url='http://google.com',
+        )
+
+    def test_own_cohort(self):
+        # The user's own cohort membership follows the user
+        user = User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        membership = CohortMembership.objects.get(user=user)
+        self.assertEquals(membership.cohort, self.cohort)
+        self.assertEquals(membership.nickname_key, 'alice')
+        self.assertFalse(membership.is_staff)
+
+        user.first_name = 'Bob'
+        user.is_staff = True
+        user.save()
+        membership = CohortMembership.objects.get(user=user)
+        self.assertEquals(membership.nickname_key, 'bob')
+        self.assertTrue(membership.is_staff)
+
+        # Other fields leave it alone
+        with self.assertNumQueries(1):
+            user.save(update_fields=['email'])
+
+        # Users without a cohort have no memberships
+        User.objects.create_user('user2', first_name='Carol')
+        self.assertEquals(CohortMembership.objects.count(), 1)
+
+    def test_join(self):
+        user = User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        membership = CohortMembership.objects.join(user, self.cohort2)
+        self.assertIsNone(membership.first_name)
+        self.assertEquals(CohortMembership.objects.join(user, self.cohort2), membership)
+        self.assertEquals(User.objects.get(id=user.id).cohort, self.cohort)
+
+    def test_nickname_unique(self):
+        User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        user = User.objects.create_user('user2', first_name='Alice', cohort=self.cohort2)
+        user.active_membership = CohortMembership.objects.join(user, self.cohort)
+
+        self.assertFalse(User.objects.nickname_available('alice', user))
+        self.assertEquals(User.objects.suggest_nicknames('Alice', user)[0], 'Alice2')
+
+        user.active_membership.first_name = 'ALICE'
+        self.assertRaises(IntegrityError, user.active_membership.save)
+
+    def test_sync_nickname_taken(self):
+        user = User.objects.create_user('user1', first_name='Bob', cohort=self.cohort)
+        other = User.objects.create_user('user2', first_name='Alice', cohort=self.cohort2)
+        membership = CohortMembership.objects.join(other, self.cohort)
+        membership.first_name = 'Carol'
+        membership.save()
+
+        # Validation (e.g. in the admin) sees the other cohort's member
+        user.first_name = 'carol'
+        self.assertRaises(ValidationError, user.validate_unique)
+        user.validate_unique(exclude=['first_name'])
+
+        # The form reports it as a duplicate, and saves nothing
+        form = UserForm(instance=User.objects.get(pk=user.pk),
+                        data={'first_name': 'Carol', 'cohort': self.cohort.id})
+        self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save())
+        self.assertEquals(form['first_name'].errors, [UserForm.duplicate_nickname_message])
+        self.assertEquals(User.objects.get(pk=user.pk).first_name, 'Bob')
+
+        # Saving anyway raises a ValidationError, and leaves the transaction usable
+        self.assertRaises(ValidationError, user.save)
+        self.assertEquals(CohortMembership.objects.get(user=user).first_name, 'Bob')
+
+    def test_form(self):
+        User.objects.create_user('user1', first_name='Alice', cohort=self.cohort)
+        user = User.objects.create_user('user2', first_name='Alice', cohort=self.cohort2)
+        user.active_membership = CohortMembership.objects.join(user, self.cohort)
+
+        form = UserForm(instance=user, data={'first_name': 'Alice', 'cohort': self.cohort2.id})
+        self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save())
+        self.assertEquals(form['first_name'].errors, [UserForm.duplicate_nickname_message])
+
+        # The nickname is saved to the membership, and the time zone to the user
+        form = UserForm(instance=user, data={'first_name': 'Bob', 'time_zone': 'Australia/Adelaide',
+                                             'cohort': self.cohort2.id})
+        self.assertTrue(form.is_valid())
+        self.assertEquals(form.save(), user)
+        self.assertEquals(CohortMembership.objects.get(user=user, cohort=self.cohort).first_name, 'Bob')
+        user = User.objects.get(id=user.id)
+        self.assertEquals(user.first_name, 'Alice')
+        self.assertEquals(user.time_zone, 'Australia/Adelaide')
+        self.assertEquals(user.cohort, self.cohort2)
+
+
+class UserLaunchTests(TestCase):
+
+    def test_touch_launch(self):
+        user = User.objects.create_user('user_name')
+        self.assertIsNone(user.last_login)
+        self.assertIsNone(user.last_launch)
+
+        now = timezone.now()
+        self.assertEquals(user.touch_launch(now), ['last_login', 'last_launch'])
+        self.assertEquals(user.last_login, now)
+        self.assertEquals(user.last_launch, now)
+
+        # Default window is 0 minutes, so any later launch is recorded
+        later = now + timedelta(seconds=1)
+        self.assertEquals(user.touch_launch(later), ['last_login', 'last_launch'])
+        self.assertEquals(user.last_launch, later)
+
+    @override_settings(ADELAIDEX_LTI_LAST_LOGIN_WINDOW=10)
+    def test_touch_launch_window(self):
+        user = User.objects.create_user('user_name')
+        now = timezone.now()
+        user.touch_launch(now)
+
+        self.assertEquals(user.touch_launch(now + timedelta(minutes=9)), [])
+        self.assertEquals(user.last_launch, now)
+
+        later = now + timedelta(minutes=11)
+        self.assertEquals(user.touch_launch(later), ['last_login', 'last_launch'])
+        self.assertEquals(user.last_launch, later)
+
+    def test_update_launch(self):
+        cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        user = User.objects.create_user('user_name', email='me@example.com')
+        now = timezone.now()
+
+        changed = user.update_launch(now, cohort=cohort, email='me@example.com', last_name='Last')
+        self.assertEquals(sorted(changed), ['cohort', 'last_launch', 'last_login', 'last_name'])
+        self.assertEquals(user.cohort, cohort)
+        self.assertEquals(user.last_name, 'Last')
+
+        self.assertEquals(user.update_launch(now, cohort=cohort, last_name='Last'), [])
+
+    @override_settings(ADELAIDEX_LTI_LAST_LOGIN_WINDOW=10)
+    def test_update_last_login(self):
+        user = User.objects.create_user('user_name')
+        update_last_login(None, user)
+        last_login = User.objects.get(id=user.id).last_login
+        self.assertIsNotNone(last_login)
+
+        # refetch, so the login isn't marked as recorded
+        user = User.objects.get(id=user.id)
+        with self.assertNumQueries(0):
+            update_last_login(None, user)
+        self.assertEquals(User.objects.get(id=user.id).last_login, last_login)
+
+    def test_update_last_login_recorded(self):
+        user = User.objects.create_user('user_name')
+        user.touch_launch()
+        with self.assertNumQueries(0):
+            update_last_login(None, user)
+
+
 class UserGroupTests(TestCase):
 
     @classmethod
@@ -327,8 +706,12 @@ class UserModelFormTests(TestCase):
         user.cohort = cohort
         user.save()
 
+        # Cohort duplicates are rejected by the unique constraint on save
         form = UserForm(data={'first_name': user.first_name, 'cohort': user.cohort.id})
+        self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save())
         self.assertFalse(form.is_valid())
+        self.assertEquals(form['first_name'].errors, [UserForm.duplicate_nickname_message])
 
         form = UserForm(data={'first_name': 'adifferentname', 'cohort': user.cohort.id})
         self.assertTrue(form.is_valid())
@@ -336,6 +719,39 @@ class UserModelFormTests(TestCase):
         form = UserForm(data={'first_name': user.first_name, 'cohort': None})
         self.assertTrue(form.is_valid())
 
+    def test_name_unique_save(self):
+        cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        User.objects.create_user('user1', first_name='First', cohort=cohort)
+        user2 = User.objects.create_user('user2', cohort=cohort)
+
+        # Validating a cohort user's nickname doesn't query auth_user,
+        # only the cohort choice.
+        form = UserForm(instance=user2, data={'first_name': 'First', 'cohort': cohort.id})
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+
+        self.assertIsNone(form.save())
+        self.assertEquals(form['first_name'].errors, [UserForm.duplicate_nickname_message])
+        self.assertEquals(len(form.nickname_suggestions), 3)
+        self.assertIsNone(User.objects.get(id=user2.id).first_name)
+
+        form = UserForm(instance=user2, data={'first_name': 'Second', 'cohort': cohort.id})
+        self.assertTrue(form.is_valid())
+        self.assertEquals(form.save(), user2)
+        self.assertEquals(User.objects.get(id=user2.id).first_name, 'Second')
+
+    def test_name_unique_ignores_case(self):
+        user = User.objects.create_user('user1', first_name='First')
+
+        form = UserForm(data={'first_name': 'FIRST', 'cohort': None})
+        self.assertFalse(form.is_valid())
+        self.assertEquals(form.nickname_suggestions[0], 'FIRST2')
+
     def test_time_zone(self):
 
         # Time zone not required
@@ -352,3 +768,33 @@ class UserModelFormTests(TestCase):
         data['time_zone'] = 'Australia/Adelaide'
         form = UserForm(data=data)
         self.assertTrue(form.is_valid())
+
+    def test_time_zone_widget(self):
+        # Options are rendered once, and only the user's time zone is selected
+        user = User.objects.create_user('user1', time_zone='Australia/Adelaide')
+        form = UserForm(instance=user)
+        html = unicode(form['time_zone'])
+        self.assertEquals(html.count('selected="selected"'), 1)
+        self.assertIn('<option value="Australia/Adelaide" selected="selected">', html)
+
+        # The same options as the uncached widget
+        widget = form.fields['time_zone'].widget
+        for value in ('Australia/Adelaide', '', None, 'NOT A TIME ZONE'):
+            self.assertEquals(widget.render_options((), [value]),
+                              SelectTimeZoneWidget.render_options(widget, (), [value]))
+
+        with patch.object(SelectTimeZoneWidget, 'render_options') as render_options:
+            html = unicode(UserForm(instance=User(time_zone='Europe/London'))['time_zone'])
+            self.assertFalse(render_options.called)
+        self.assertEquals(html.count('selected="selected"'), 1)
+        self.assertIn('<option value="Europe/London" selected="selected">', html)
+
+    def test_base_fields(self):
+        UserForm()
+        first_name = UserForm.base_fields['first_name']
+        self.assertTrue(first_name.required)
+        self.assertEquals(first_name.validators, User._meta.get_field('first_name').validators)
+
+        # Each form gets its own copy
+        form = UserForm()
+        self.assertIsNot(form.fields['first_name'].validators, first_name.validators)
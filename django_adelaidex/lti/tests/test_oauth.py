@@ -0,0 +1,116 @@
+from django.test import SimpleTestCase, RequestFactory
+from django.test.utils import override_settings
+
+from django_adelaidex.lti.oauth import (
+    LaunchFields, base_string_uri, hmac_keys, sign, signature_base_string, verify_request
+)
+from django_adelaidex.lti.replay import sign_launch
+
+
+class SignatureBaseStringTest(SimpleTestCase):
+
+    def test_example(self):
+        # OAuth 1.0 specification, appendix A.5.1
+        params = [
+            ('file', 'vacation.jpg'),
+            ('size', 'original'),
+            ('oauth_consumer_key', 'dpf43f3p2l4k3l03'),
+            ('oauth_token', 'nnch734d00sl2jdk'),
+            ('oauth_signature_method', 'HMAC-SHA1'),
+            ('oauth_signature', 'ignored'),
+            ('oauth_timestamp', '1191242096'),
+            ('oauth_nonce', 'kllo9940pd9333jh'),
+            ('oauth_version', '1.0'),
+        ]
+        self.assertEquals(
+            signature_base_string('get', 'http://photos.example.net/photos', params),
+            'GET&http%3A%2F%2Fphotos.example.net%2Fphotos&file%3Dvacation.jpg'
+            '%26oauth_consumer_key%3Ddpf43f3p2l4k3l03%26oauth_nonce%3Dkllo9940pd9333jh'
+            '%26oauth_signature_method%3DHMAC-SHA1%26oauth_timestamp%3D1191242096'
+            '%26oauth_token%3Dnnch734d00sl2jdk%26oauth_version%3D1.0%26size%3Doriginal')
+
+    def test_encoding(self):
+        params = [(u'name', u'Jos\xe9 ~a b+c/d'), ('a', '2'), ('a', '1')]
+        self.assertEquals(
+            signature_base_string('POST', 'https://example.com/lti', params),
+            'POST&https%3A%2F%2Fexample.com%2Flti'
+            '&a%3D1%26a%3D2%26name%3DJos%25C3%25A9%2520~a%2520b%252Bc%252Fd')
+
+    def test_base_string_uri(self):
+        self.assertEquals(base_string_uri('HTTP', 'Example.COM:80', '/lti/'), 'http://example.com/lti/')
+        self.assertEquals(base_string_uri('https', 'example.com:443', '/'), 'https://example.com/')
+        self.assertEquals(base_string_uri('http', 'example.com:8080', ''), 'http://example.com:8080/')
+
+    def test_sign_cached_key(self):
+        hmac_keys.clear()
+        signature = sign('base string', 'secret')
+        self.assertEquals(sign('base string', 'secret'), signature)
+        self.assertNotEquals(sign('other string', 'secret'), signature)
+        self.assertNotEquals(sign('base string', 'other secret'), signature)
+        self.assertEquals(len(hmac_keys.keys), 2)
+
+
+@override_settings(ALLOWED_HOSTS=['testserver', 'lti.example.com'])
+class VerifyRequestTest(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.params = {
+            'lti_message_type': 'basic-lti-launch-request',
+            'lti_version': 'LTI-1p0',
+            'resource_link_id': 'link',
+            'user_id': 'student',
+            'lis_person_name_family': u'Fran\xe7ois',
+            'custom_canvas_user_login_id': 'login',
+        }
+
+    def launch(self, url='http://testserver/lti/', secret='secret', **extra):
+        params = sign_launch(url, self.params, 'key', secret)
+        params.update(extra)
+        return self.factory.post(url, params)
+
+    def test_valid(self):
+        self.assertTrue(verify_request(self.launch(), 'secret'))
+
+    def test_wrong_secret(self):
+        self.assertFalse(verify_request(self.launch(), 'other secret'))
+        self.assertFalse(verify_request(self.launch(secret='other secret'), 'secret'))
+
+    def test_tampered(self):
+        self.assertFalse(verify_request(self.launch(user_id='teacher'), 'secret'))
+        self.assertFalse(verify_request(self.launch(oauth_signature=''), 'secret'))
+
+    def test_oauth_version(self):
+        self.assertFalse(verify_request(self.launch(oauth_version='2.0'), 'secret'))
+
+    def test_query_string(self):
+        # query string params are signed along with the POST body
+        signed = sign_launch('http://testserver/lti/', dict(self.params, course='1'), 'key', 'secret')
+        del signed['course']
+        request = self.factory.post('/lti/?course=1', signed)
+        self.assertTrue(verify_request(request, 'secret'))
+
+    def test_host(self):
+        signed = sign_launch('https://lti.example.com/lti/', self.params, 'key', 'secret')
+        request = self.factory.post('/lti/', signed, HTTP_HOST='lti.example.com:443', secure=True)
+        self.assertTrue(verify_request(request, 'secret'))
+        request = self.factory.post('/lti/', signed, HTTP_HOST='lti.example.com:443')
+        self.assertFalse(verify_request(request, 'secret'))
+
+
+class LaunchFieldsTest(SimpleTestCase):
+
+    def test_fields(self):
+        launch = LaunchFields({
+            'user_id': 'student',
+            'lis_person_sourcedid': 'sis:123',
+            'lis_person_contact_email_primary': 'student@example.com',
+            'custom_canvas_user_login_id': 'login',
+            'resource_link_id': 'link',
+        })
+        self.assertEquals(launch.user_id, 'student')
+        self.assertEquals(launch.lis_person_sourcedid, 'sis:123')
+        self.assertEquals(launch.lis_person_contact_email_primary, 'student@example.com')
+        self.assertIsNone(launch.lis_person_name_family)
+        self.assertEquals(launch.get_custom_param('canvas_user_login_id'), 'login')
+        self.assertIsNone(launch.get_custom_param('missing'))
@@ -0,0 +1,117 @@
+from django.test import TestCase
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.utils.six import StringIO
+from mock import patch
+
+from django_adelaidex.lti import metrics
+from django_adelaidex.lti.models import Cohort, User
+from django_adelaidex.lti.pages import PAGE_NAMES, page_key, render_page
+
+
+@override_settings(ADELAIDEX_LTI_STATIC_PAGES={'ENABLED': True})
+class PrerenderedPageTest(TestCase):
+
+    def setUp(self):
+        super(PrerenderedPageTest, self).setUp()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+            is_default=True,
+        )
+        cache.clear()
+        metrics.registry.reset()
+        self.client = Client()
+
+    def test_403(self):
+        path = reverse('lti-403')
+        response = self.client.get(path + '?next=/profile')
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, 'Test Cohort')
+        self.assertContains(response, '%s?next=/profile' % reverse('lti-enrol'))
+        self.assertContains(response, 'href="/profile"')
+        self.assertIn('ETag', response)
+
+        # Served from the cache, and filled in for each request
+        with patch('django_adelaidex.lti.pages.render_page') as render_page:
+            other = self.client.get(path + '?next=/other')
+            self.assertFalse(render_page.called)
+        self.assertContains(other, 'href="/other"')
+        self.assertNotEquals(other['ETag'], response['ETag'])
+        self.assertIn('lti_page_cache_total{page="lti-403",result="hit"} 1', metrics.registry.expose())
+
+        # Unchanged pages aren't sent again
+        response = self.client.get(path + '?next=/profile', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.content, '')
+
+    def test_escaped(self):
+        response = self.client.get(reverse('lti-403'), {'next': '"><script>'})
+        self.assertNotContains(response, '"><script>')
+        self.assertContains(response, 'href="&quot;&gt;&lt;script&gt;"')
+
+    def test_inactive(self):
+        response = self.client.get(reverse('lti-inactive'))
+        self.assertContains(response, 'Inactive Account')
+        self.assertIsNotNone(cache.get(page_key('lti-inactive', self.cohort)))
+
+    def test_rerendered_on_cohort_change(self):
+        self.client.get(reverse('lti-403'))
+        self.cohort.title = 'New Title'
+        self.cohort.save()
+        self.assertIsNone(cache.get(page_key('lti-403', self.cohort)))
+        self.assertContains(self.client.get(reverse('lti-403')), 'New Title')
+
+    def test_rendered_without_visitor_request(self):
+        # Nothing from the first visitor's request is kept for the others
+        self.client.cookies['csrftoken'] = 'visitortoken'
+        self.client.get(reverse('lti-403') + '?next=/visitorpage', HTTP_ACCEPT_LANGUAGE='de')
+        page = cache.get(page_key('lti-403', self.cohort))
+        self.assertNotIn('visitortoken', page)
+        self.assertNotIn('/visitorpage', page)
+        self.assertEquals(page, render_page('lti-403', self.cohort))
+
+    def test_rerendered_per_cohort(self):
+        other = Cohort.objects.create(title='Other Cohort', oauth_key='otherkey',
+                                      oauth_secret='othersecret', login_url='http://google.com')
+        self.client.get(reverse('lti-403'))
+
+        with patch('django_adelaidex.lti.pages.transaction.on_commit', lambda func: func()):
+            # Other cohorts' changes leave the page alone
+            with patch('django_adelaidex.lti.pages.render_page') as render:
+                other.title = 'Other Title'
+                other.save()
+                self.assertFalse(render.called)
+            self.assertIsNotNone(cache.get(page_key('lti-403', self.cohort)))
+
+            # The default cohort's pages are re-rendered
+            self.cohort.title = 'New Title'
+            self.cohort.save()
+        self.assertIn('New Title', cache.get(page_key('lti-403', self.cohort)))
+        self.assertIsNone(cache.get(page_key('lti-403', other)))
+
+    def test_authenticated(self):
+        user = User.objects.create_user('user1', password='password')
+        self.client.login(username='user1', password='password')
+        response = self.client.get(reverse('lti-403'))
+        self.assertEquals(response.context['user'], user)
+        self.assertNotIn('ETag', response)
+        self.assertIsNone(cache.get(page_key('lti-403', self.cohort)))
+
+    @override_settings(ADELAIDEX_LTI_STATIC_PAGES={'ENABLED': False})
+    def test_disabled(self):
+        response = self.client.get(reverse('lti-403'))
+        self.assertEquals(response.context['ADELAIDEX_LTI_LINK_TEXT'], 'Test Cohort')
+        self.assertIsNone(cache.get(page_key('lti-403', self.cohort)))
+
+    def test_command(self):
+        out = StringIO()
+        call_command('lti_render_pages', stdout=out)
+        self.assertEquals(out.getvalue().strip(), 'Rendered %d pages.' % len(PAGE_NAMES))
+        for name in PAGE_NAMES:
+            self.assertIsNotNone(cache.get(page_key(name, self.cohort)))
@@ -0,0 +1,124 @@
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+import os
+import shutil
+import tempfile
+
+from django_adelaidex.lti.middleware import LaunchRecordingMiddleware
+from django_adelaidex.lti.replay import (read_launches, replay_launches, replay_schedule,
+                                         sanitize_launch)
+
+
+class SanitizeLaunchTest(TestCase):
+
+    def test_sanitize(self):
+        params = {
+            'oauth_consumer_key': 'mykey',
+            'oauth_signature': 'signature',
+            'oauth_nonce': '1234',
+            'user_id': 'student',
+            'lis_person_contact_email_primary': 'student@adelaide.edu.au',
+            'lti_message_type': 'basic-lti-launch-request',
+            'roles': 'Student',
+        }
+        sanitized = sanitize_launch(params, 'salt')
+        self.assertEquals(sorted(sanitized.keys()), [
+            'lis_person_contact_email_primary', 'lti_message_type', 'roles', 'user_id'])
+        self.assertEquals(sanitized['roles'], 'Student')
+        self.assertNotEquals(sanitized['user_id'], 'student')
+        self.assertTrue(sanitized['lis_person_contact_email_primary'].endswith('@example.com'))
+
+        # Hashes are stable for a given salt, so replayed users match up
+        self.assertEquals(sanitize_launch(params, 'salt'), sanitized)
+        self.assertNotEquals(sanitize_launch(params, 'pepper')['user_id'], sanitized['user_id'])
+
+    def test_sanitize_pii_families(self):
+        params = {
+            'lis_person_name_given': 'Alice',
+            'lis_person_contact_email_personal': 'alice@example.org',
+            'lis_result_sourcedid': 'course:alice',
+            'ext_user_username': 'a1234567',
+            'custom_lis_person_name_full': 'Alice Smith',
+            'custom_canvas_user_login_id': 'a1234567',
+            'custom_user_id': 'alice',
+            'custom_course': 'CS101',
+            'context_title': 'Computing',
+        }
+        sanitized = sanitize_launch(params, 'salt')
+        for name in ('lis_person_name_given', 'lis_result_sourcedid', 'ext_user_username',
+                     'custom_lis_person_name_full', 'custom_canvas_user_login_id', 'custom_user_id'):
+            self.assertNotEquals(sanitized[name], params[name])
+        self.assertTrue(sanitized['lis_person_contact_email_personal'].endswith('@example.com'))
+        self.assertEquals(sanitized['custom_course'], 'CS101')
+        self.assertEquals(sanitized['context_title'], 'Computing')
+
+
+class LaunchRecordingTest(TestCase):
+
+    def setUp(self):
+        super(LaunchRecordingTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'launches.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(LaunchRecordingTest, self).tearDown()
+
+    def test_record(self):
+        request = RequestFactory().post('/lti/', {
+            'oauth_signature': 'signature',
+            'user_id': 'student',
+            'lti_message_type': 'basic-lti-launch-request',
+        })
+        with override_settings(ADELAIDEX_LTI_RECORDING={'FILE': self.filename}):
+            LaunchRecordingMiddleware().process_request(request)
+            LaunchRecordingMiddleware().process_request(RequestFactory().post('/other/'))
+
+        with open(self.filename) as recording:
+            launches = list(read_launches(recording))
+        self.assertEquals(len(launches), 1)
+        self.assertEquals(launches[0]['path'], '/lti/')
+        self.assertNotIn('oauth_signature', launches[0]['params'])
+        self.assertNotEquals(launches[0]['params']['user_id'], 'student')
+
+    def test_not_recording(self):
+        request = RequestFactory().post('/lti/', {'lti_message_type': 'basic-lti-launch-request'})
+        LaunchRecordingMiddleware().process_request(request)
+        self.assertFalse(os.path.exists(self.filename))
+
+
+class ReplayTest(TestCase):
+
+    launches = [
+        {'t': 100.0, 'path': '/lti/', 'params': {'user_id': 'a'}},
+        {'t': 101.0, 'path': '/lti/', 'params': {'user_id': 'b'}},
+        {'t': 103.0, 'path': '/lti/', 'params': {'user_id': 'c'}},
+    ]
+
+    def test_schedule(self):
+        self.assertEquals([offset for (offset, launch) in replay_schedule(self.launches)],
+                          [0, 1, 3])
+        self.assertEquals([offset for (offset, launch) in replay_schedule(self.launches, speed=2)],
+                          [0, 0.5, 1.5])
+        self.assertEquals([offset for (offset, launch) in replay_schedule(self.launches, rate=10)],
+                          [0, 0.1, 0.2])
+
+    def test_replay(self):
+        sent = []
+
+        class Sender(object):
+            def url(self, path):
+                return 'http://testserver%s' % path
+
+            def send(self, url, params):
+                sent.append(params)
+                return 200
+
+        results = replay_launches(self.launches, Sender(), 'mykey', 'mysecret',
+                                  rate=1000, concurrency=2)
+        self.assertEquals([status for (status, seconds) in results], [200, 200, 200])
+        self.assertEquals(sorted(params['user_id'] for params in sent), ['a', 'b', 'c'])
+        for params in sent:
+            self.assertEquals(params['oauth_consumer_key'], 'mykey')
+            self.assertIn('oauth_signature', params)
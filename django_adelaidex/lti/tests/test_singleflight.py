@@ -0,0 +1,47 @@
+from django.test import TestCase
+from django.core.cache import cache
+from mock import patch
+
+from django_adelaidex.lti.singleflight import SingleFlight
+
+
+class SingleFlightTest(TestCase):
+
+    def setUp(self):
+        super(SingleFlightTest, self).setUp()
+        cache.clear()
+        self.flight = SingleFlight('test-flight')
+        self.calls = 0
+
+    def work(self):
+        self.calls += 1
+        return self.calls
+
+    def test_shared(self):
+        self.assertEquals(self.flight.do('key', self.work, 10, 1), (1, False))
+        self.assertEquals(self.flight.do('key', self.work, 10, 1), (1, True))
+        self.assertEquals(self.flight.do('other', self.work, 10, 1), (2, False))
+        self.assertEquals(self.calls, 2)
+
+        self.flight.forget('key')
+        self.assertEquals(self.flight.do('key', self.work, 10, 1), (3, False))
+
+    def test_none_not_shared(self):
+        self.assertEquals(self.flight.do('key', lambda: None, 10, 1), (None, False))
+        self.assertEquals(self.flight.do('key', self.work, 10, 1), (1, False))
+
+    def test_wait_for_result(self):
+        # Another request holds the lock, and finishes while we wait
+        cache.add(self.flight.cache_key('lock', 'key'), 1)
+
+        def finish(seconds):
+            cache.set(self.flight.cache_key('result', 'key'), 'theirs')
+        with patch('django_adelaidex.lti.singleflight.time.sleep', side_effect=finish):
+            self.assertEquals(self.flight.do('key', self.work, 10, 1), ('theirs', True))
+        self.assertEquals(self.calls, 0)
+
+    def test_lock_timeout(self):
+        # Another request holds the lock, and doesn't finish in time
+        cache.add(self.flight.cache_key('lock', 'key'), 1)
+        self.flight.poll_interval = 0.01
+        self.assertEquals(self.flight.do('key', self.work, 10, 0.05), (1, False))
@@ -0,0 +1,110 @@
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.core.cache import cache
+import threading
+
+from django_adelaidex.lti.middleware import LaunchThrottleMiddleware
+from django_adelaidex.lti.models import Cohort
+from django_adelaidex.lti.throttling import FixedWindow, launch_buckets, throttle_key, throttle_user
+
+
+class FixedWindowTest(TestCase):
+
+    def setUp(self):
+        super(FixedWindowTest, self).setUp()
+        cache.clear()
+        self.bucket = FixedWindow(prefix='test-throttle')
+
+    def test_consume(self):
+        now = 960.0
+        # 2 per minute
+        self.assertEquals(self.bucket.consume('key', 2, now=now), 0)
+        self.assertEquals(self.bucket.consume('key', 2, now=now + 10), 0)
+
+        # Full: next window in 50s
+        self.assertEquals(self.bucket.consume('key', 2, now=now + 10), 50)
+
+        # Other buckets unaffected
+        self.assertEquals(self.bucket.consume('other', 2, now=now + 10), 0)
+
+        # Next window
+        self.assertEquals(self.bucket.consume('key', 2, now=now + 60), 0)
+        self.assertEquals(self.bucket.consume('key', 2, now=now + 60), 0)
+        self.assertEquals(self.bucket.consume('key', 2, now=now + 60), 60)
+
+    def test_capacity(self):
+        # 5 launches per 5 second window
+        now = 1000.0
+        for i in range(5):
+            self.assertEquals(self.bucket.consume('key', 60, capacity=5, now=now), 0)
+        self.assertEquals(self.bucket.consume('key', 60, capacity=5, now=now + 1), 4)
+
+    def test_concurrent(self):
+        # Concurrent launches can't all take the last slot
+        now = 960.0
+        results = []
+
+        def launch():
+            bucket = FixedWindow(prefix='test-throttle')
+            results.append(bucket.consume('key', 5, now=now))
+
+        threads = [threading.Thread(target=launch) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results.count(0), 5)
+
+    def test_local_block(self):
+        now = 960.0
+        self.bucket.consume('key', 1, now=now)
+        self.assertEquals(self.bucket.consume('key', 1, now=now), 60)
+
+        # Throttled clients don't reach the cache
+        cache.clear()
+        self.assertEquals(self.bucket.consume('key', 1, now=now + 10), 50)
+
+        self.bucket.reset()
+        self.assertEquals(self.bucket.consume('key', 1, now=now + 10), 0)
+
+
+class ThrottleLaunchTest(TestCase):
+
+    def setUp(self):
+        super(ThrottleLaunchTest, self).setUp()
+        cache.clear()
+        launch_buckets.reset()
+
+    def test_unlimited(self):
+        for i in range(10):
+            self.assertEquals(throttle_key('mykey'), 0)
+            self.assertEquals(throttle_user('mykey', 'student'), 0)
+
+    @override_settings(ADELAIDEX_LTI_THROTTLE={'USER_RATE': 1})
+    def test_user_rate(self):
+        self.assertEquals(throttle_user('mykey', 'student'), 0)
+        self.assertTrue(throttle_user('mykey', 'student') > 0)
+        self.assertEquals(throttle_user('mykey', 'student2'), 0)
+        self.assertEquals(throttle_key('mykey'), 0)
+
+    @override_settings(ADELAIDEX_LTI_THROTTLE={'KEY_RATE': 100})
+    def test_cohort_rate(self):
+        cohort = Cohort(oauth_key='mykey', launch_rate_limit=2)
+        self.assertEquals(throttle_key('mykey', cohort), 0)
+        self.assertEquals(throttle_key('mykey', cohort), 0)
+        self.assertTrue(throttle_key('mykey', cohort) > 0)
+
+
+class LaunchThrottleMiddlewareTest(TestCase):
+
+    def test_not_throttled(self):
+        request = RequestFactory().post('/lti/')
+        self.assertIsNone(LaunchThrottleMiddleware().process_request(request))
+
+    def test_throttled(self):
+        request = RequestFactory().post('/lti/')
+        request.lti_throttled = 2.5
+        response = LaunchThrottleMiddleware().process_request(request)
+        self.assertEquals(response.status_code, 429)
+        self.assertEquals(response['Retry-After'], '3')
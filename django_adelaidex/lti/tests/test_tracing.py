@@ -0,0 +1,109 @@
+from django.test import TestCase
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.core.urlresolvers import reverse
+import json
+import os
+import shutil
+import tempfile
+
+from django_adelaidex.util.test import UserSetUp
+from django_adelaidex.lti import tracing
+from django_adelaidex.lti.views import LTIEntryView
+
+
+class RecordingTracer(object):
+    '''Keeps finished spans in memory.'''
+
+    spans = []
+
+    def span(self, name, **attributes):
+        return tracing.Span(self, name, attributes)
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class TracingTest(TestCase):
+
+    def setUp(self):
+        super(TracingTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        RecordingTracer.spans = []
+
+    def test_noop(self):
+        self.assertIsInstance(tracing.get_tracer(), tracing.NoopTracer)
+        with tracing.span('test', key='value') as span:
+            span.set_attribute('other', 'value')
+
+    def test_json_lines(self):
+        filename = os.path.join(self.directory, 'spans.jsonl')
+        with self.settings(ADELAIDEX_LTI_TRACING={
+                'TRACER': 'django_adelaidex.lti.tracing.JSONLinesTracer',
+                'FILE': filename}):
+            with tracing.span('outer', key='value'):
+                with tracing.span('inner') as inner:
+                    inner.set_attribute('result', 'ok')
+
+            try:
+                with tracing.span('failed'):
+                    raise ValueError('oops')
+            except ValueError:
+                pass
+
+        with open(filename) as spans:
+            (inner, outer, failed) = [json.loads(line) for line in spans]
+
+        self.assertEquals(outer['name'], 'outer')
+        self.assertEquals(outer['attributes'], {'key': 'value'})
+        self.assertIsNone(outer['parent_id'])
+        self.assertEquals(inner['name'], 'inner')
+        self.assertEquals(inner['attributes'], {'result': 'ok'})
+        self.assertEquals(inner['parent_id'], outer['span_id'])
+        self.assertEquals(inner['trace_id'], outer['trace_id'])
+        self.assertTrue(outer['duration_ms'] >= inner['duration_ms'])
+        self.assertNotEquals(failed['trace_id'], outer['trace_id'])
+        self.assertEquals(failed['error'], 'ValueError')
+
+        # Reverts to no-op
+        self.assertIsInstance(tracing.get_tracer(), tracing.NoopTracer)
+
+    def test_traced(self):
+        @tracing.traced('decorated')
+        def decorated(value):
+            return value
+
+        with self.settings(ADELAIDEX_LTI_TRACING={'TRACER': RecordingTracer}):
+            self.assertEquals(decorated(1), 1)
+        self.assertEquals([span.name for span in RecordingTracer.spans], ['decorated'])
+
+
+class TracedViewTest(UserSetUp, TestCase):
+
+    def setUp(self):
+        super(TracedViewTest, self).setUp()
+        RecordingTracer.spans = []
+
+    @override_settings(ADELAIDEX_LTI_TRACING={'TRACER': RecordingTracer})
+    def test_entry_view(self):
+        client = Client()
+        self.assertLogin(client, reverse('lti-entry'))
+
+        names = [span.name for span in RecordingTracer.spans]
+        self.assertIn('lti.view.entry', names)
+        self.assertIn('lti.render', names)
+        self.assertIn('lti.context.lti_settings', names)
+        self.assertIn('lti.cohort.get_current', names)
+
+        # Rendering is traced within the view span
+        render = [span for span in RecordingTracer.spans if span.name == 'lti.render'][-1]
+        view = [span for span in RecordingTracer.spans if span.span_id == render.parent_id]
+        self.assertEquals(view[0].name, 'lti.view.entry')
+
+    def test_entry_view_lazy(self):
+        # Without a tracer, the response is left for template response middleware to render
+        request = RequestFactory().get(reverse('lti-entry'))
+        request.user = self.user
+        response = LTIEntryView.as_view()(request)
+        self.assertFalse(response.is_rendered)
@@ -0,0 +1,247 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.db import DatabaseError
+from django.utils import timezone
+from datetime import timedelta
+from mock import patch
+import time
+
+from django_adelaidex.lti import metrics
+from django_adelaidex.lti.models import Cohort, CohortCredential
+from django_adelaidex.lti.registry import cohort_registry
+from django_adelaidex.lti.validation import LaunchRejected, validate_launch
+
+
+class ValidateLaunchTest(TestCase):
+
+    def setUp(self):
+        super(ValidateLaunchTest, self).setUp()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        metrics.registry.reset()
+        self.now = 1400000000
+        self.params = {
+            'oauth_consumer_key': 'mykey',
+            'oauth_nonce': '1234',
+            'oauth_signature': 'signature',
+            'oauth_signature_method': 'HMAC-SHA1',
+            'oauth_timestamp': str(self.now),
+            'lti_message_type': 'basic-lti-launch-request',
+        }
+
+    def assertRejected(self, reason, params):
+        with self.assertRaises(LaunchRejected) as context:
+            validate_launch(params, now=self.now)
+        self.assertEquals(context.exception.reason, reason)
+        self.assertEquals(metrics.launch_rejections.values.get((reason,)), 1)
+
+    def test_valid(self):
+        self.assertEquals(validate_launch(self.params, now=self.now), self.cohort)
+
+    def test_missing_params(self):
+        del self.params['oauth_nonce']
+        self.assertRejected('missing_params', self.params)
+
+    def test_message_type(self):
+        self.params['lti_message_type'] = 'ContentItemSelectionRequest'
+        self.assertRejected('message_type', self.params)
+
+    def test_signature_method(self):
+        self.params['oauth_signature_method'] = 'PLAINTEXT'
+        self.assertRejected('signature_method', self.params)
+
+    def test_timestamp(self):
+        self.params['oauth_timestamp'] = str(self.now - 60 * 60 - 1)
+        self.assertRejected('timestamp', self.params)
+
+    def test_timestamp_future(self):
+        self.params['oauth_timestamp'] = str(self.now + 60 * 60 + 1)
+        self.assertRejected('timestamp', self.params)
+
+    def test_timestamp_invalid(self):
+        self.params['oauth_timestamp'] = 'yesterday'
+        self.assertRejected('timestamp', self.params)
+
+    @override_settings(ADELAIDEX_LTI_TIMESTAMP_WINDOW=60)
+    def test_timestamp_window(self):
+        self.params['oauth_timestamp'] = str(self.now - 61)
+        self.assertRejected('timestamp', self.params)
+
+    def test_unknown_key(self):
+        self.params['oauth_consumer_key'] = 'otherkey'
+        self.assertRejected('unknown_key', self.params)
+
+    @override_settings(LTI_OAUTH_CREDENTIALS={'otherkey': 'othersecret'})
+    def test_settings_key(self):
+        self.params['oauth_consumer_key'] = 'otherkey'
+        self.assertIsNone(validate_launch(self.params, now=self.now))
+
+    def test_no_queries_before_key(self):
+        # Malformed launches are rejected without touching the database
+        self.params['oauth_consumer_key'] = 'otherkey'
+        self.params['oauth_timestamp'] = '0'
+        with self.assertNumQueries(0):
+            self.assertRaises(LaunchRejected, validate_launch, self.params, now=self.now)
+
+
+class CohortRegistryTest(TestCase):
+
+    def setUp(self):
+        super(CohortRegistryTest, self).setUp()
+        cohort_registry.reset()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            self.assertEquals(cohort_registry.get('mykey'), self.cohort)
+        with self.assertNumQueries(0):
+            self.assertEquals(cohort_registry.get('mykey'), self.cohort)
+
+        # Unknown keys are remembered too
+        with self.assertNumQueries(1):
+            self.assertIsNone(cohort_registry.get('otherkey'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(cohort_registry.get('otherkey'))
+
+    def test_cleared_on_save(self):
+        cohort_registry.get('mykey')
+        self.cohort.oauth_secret = 'newsecret'
+        self.cohort.save()
+        self.assertEquals(cohort_registry.get('mykey').oauth_secret, 'newsecret')
+
+    @override_settings(ADELAIDEX_LTI_COHORT_CACHE_TTL=10)
+    def test_expires(self):
+        cohort_registry.get('mykey', now=1000)
+        with self.assertNumQueries(0):
+            cohort_registry.get('mykey', now=1009)
+        with self.assertNumQueries(1):
+            cohort_registry.get('mykey', now=1011)
+
+    def test_secrets(self):
+        now = timezone.now()
+        CohortCredential.objects.create(cohort=self.cohort, oauth_secret='newsecret')
+        CohortCredential.objects.create(cohort=self.cohort, oauth_secret='inactive', is_active=False)
+        CohortCredential.objects.create(cohort=self.cohort, oauth_secret='expired',
+                                        valid_until=now - timedelta(minutes=1))
+        CohortCredential.objects.create(cohort=self.cohort, oauth_secret='future',
+                                        valid_from=now + timedelta(minutes=1))
+        self.assertEquals(cohort_registry.secrets('mykey'), ['mysecret', 'newsecret'])
+
+        # Credentials are cached along with the cohort
+        with self.assertNumQueries(0):
+            self.assertEquals(cohort_registry.secrets('mykey'), ['mysecret', 'newsecret'])
+
+        # The secret which last verified a launch is tried first
+        cohort_registry.prefer('mykey', 'newsecret')
+        self.assertEquals(cohort_registry.secrets('mykey'), ['newsecret', 'mysecret'])
+
+        # Unknown secrets are ignored
+        cohort_registry.prefer('mykey', 'unknown')
+        self.assertEquals(cohort_registry.secrets('mykey'), ['mysecret', 'newsecret'])
+        self.assertEquals(cohort_registry.secrets('otherkey'), [])
+
+    @override_settings(LTI_OAUTH_CREDENTIALS={'mykey': 'settingsecret'})
+    def test_settings_secret(self):
+        self.assertEquals(cohort_registry.secrets('mykey'), ['settingsecret', 'mysecret'])
+
+    def test_cleared_on_credential_change(self):
+        self.assertEquals(cohort_registry.secrets('mykey'), ['mysecret'])
+        credential = CohortCredential.objects.create(cohort=self.cohort, oauth_secret='newsecret')
+        self.assertEquals(cohort_registry.secrets('mykey'), ['mysecret', 'newsecret'])
+        credential.is_active = False
+        credential.save()
+        self.assertEquals(cohort_registry.secrets('mykey'), ['mysecret'])
+
+    @override_settings(ADELAIDEX_LTI_COHORT_CACHE_TTL=10, ADELAIDEX_LTI_COHORT_CACHE_STALE=30)
+    def test_stale_while_revalidate(self):
+        cohort_registry.get('mykey', now=1000)
+
+        # Expired entries are served while one background refresh runs
+        with patch.object(cohort_registry, 'spawn') as spawn:
+            with self.assertNumQueries(0):
+                self.assertEquals(cohort_registry.get('mykey', now=1011), self.cohort)
+                self.assertEquals(cohort_registry.get('mykey', now=1012), self.cohort)
+            self.assertEquals(spawn.call_count, 1)
+            self.assertEquals(cohort_registry.refreshing, set(['mykey']))
+
+        # The refresh reloads the cohort and its credentials
+        with self.assertNumQueries(2):
+            cohort_registry.refresh('mykey')
+        self.assertEquals(cohort_registry.refreshing, set())
+        with self.assertNumQueries(0):
+            self.assertEquals(cohort_registry.secrets('mykey'), ['mysecret'])
+
+        # But not past the stale window
+        with self.assertNumQueries(1):
+            cohort_registry.get('mykey', now=time.time() + 41)
+
+    @override_settings(ADELAIDEX_LTI_COHORT_CACHE_TTL=10, ADELAIDEX_LTI_COHORT_CACHE_STALE=30)
+    def test_stale_on_error(self):
+        cohort_registry.get('mykey', now=1000)
+        with patch.object(Cohort.objects, 'filter', side_effect=DatabaseError('down')):
+            with patch.object(cohort_registry, 'spawn', lambda target, *args: target(*args)):
+                self.assertEquals(cohort_registry.get('mykey', now=1011), self.cohort)
+                self.assertEquals(cohort_registry.refreshing, set())
+                self.assertEquals(cohort_registry.get('mykey', now=1039), self.cohort)
+                self.assertRaises(DatabaseError, cohort_registry.get, 'mykey', now=1041)
+
+    def test_cleared_during_load(self):
+        generation = cohort_registry.generation
+        cohort_registry.clear()
+        cohort_registry.set('mykey', None, generation=generation)
+        self.assertEquals(cohort_registry.get('mykey'), self.cohort)
+
+    @override_settings(ADELAIDEX_LTI_COHORT_CACHE_TTL=10, ADELAIDEX_LTI_COHORT_CACHE_STALE=30)
+    def test_default_on_error(self):
+        self.cohort.is_default = True
+        self.cohort.save()
+        self.assertEquals(Cohort.objects.get_current(), self.cohort)
+
+        with patch.object(Cohort.objects, 'filter', side_effect=DatabaseError('down')):
+            with patch.object(cohort_registry, 'spawn', lambda target, *args: target(*args)):
+                self.assertEquals(cohort_registry.default(now=time.time() + 39), self.cohort)
+                self.assertRaises(DatabaseError, cohort_registry.default, now=time.time() + 41)
+
+    @override_settings(ADELAIDEX_LTI_COHORT_CACHE_TTL=10, ADELAIDEX_LTI_COHORT_CACHE_STALE=0)
+    def test_no_default_on_error_when_disabled(self):
+        self.cohort.is_default = True
+        self.cohort.save()
+        self.assertEquals(Cohort.objects.get_current(), self.cohort)
+
+        with patch.object(Cohort.objects, 'filter', side_effect=DatabaseError('down')):
+            self.assertRaises(DatabaseError, cohort_registry.default, now=time.time() + 11)
+
+    @override_settings(ADELAIDEX_LTI_COHORT_CACHE_TTL=10, ADELAIDEX_LTI_COHORT_CACHE_STALE=30)
+    def test_default_cached(self):
+        self.assertIsNone(cohort_registry.default())
+        self.cohort.is_default = True
+        self.cohort.save()
+
+        self.assertEquals(cohort_registry.default(), self.cohort)
+        with self.assertNumQueries(0):
+            self.assertEquals(cohort_registry.default(), self.cohort)
+
+        # Served while it's reloaded in the background once expired
+        with patch.object(cohort_registry, 'spawn') as spawn:
+            with self.assertNumQueries(0):
+                self.assertEquals(cohort_registry.default(now=time.time() + 11), self.cohort)
+            self.assertEquals(spawn.call_count, 1)
+        with self.assertNumQueries(1):
+            cohort_registry.refresh(None)
+
+        # And reloaded once any cohort changes
+        other = Cohort.objects.create(title='Other Cohort', oauth_key='otherkey',
+                                      oauth_secret='othersecret', login_url='http://google.com',
+                                      is_default=True)
+        self.assertEquals(cohort_registry.default(), other)
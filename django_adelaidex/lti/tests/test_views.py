@@ -1,13 +1,17 @@
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.test.utils import override_settings
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
+import json
 import sys
 from urlparse import urlparse
 
 from django_adelaidex.util.test import UserSetUp, InactiveUserSetUp, TestOverrideSettings
+from django_adelaidex.lti.models import ACTIVE_COHORT_SESSION_KEY, Cohort, CohortMembership, UserForm
+from django_adelaidex.lti.views import UserProfileView
 
 
 class LTIEntryViewTest(UserSetUp, TestCase):
@@ -103,6 +107,35 @@ class LTIEntryViewTest(UserSetUp, TestCase):
         user = get_user_model().objects.get(username=self.user.username)
         self.assertEqual(user.first_name, form_data['first_name'])
 
+    def test_set_duplicate_nickname(self):
+
+        '''Nicknames must be unique within the cohort.'''
+        cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        self.user.cohort = cohort
+        self.user.save()
+        get_user_model().objects.create_user('other', first_name='TakenNickname', cohort=cohort)
+
+        client = Client()
+        self.assertLogin(client, reverse('home'))
+
+        lti_login_path = reverse('lti-entry')
+        form_data = {'first_name': 'TakenNickname'}
+        response = client.post(lti_login_path, form_data)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEquals(UserForm.duplicate_nickname_message,
+                          response.context['form']['first_name'].errors[0])
+        self.assertContains(response, 'TakenNickname2')
+
+        # Ensure the nickname wasn't updated
+        user = get_user_model().objects.get(username=self.user.username)
+        self.assertNotEqual(user.first_name, form_data['first_name'])
+
     def test_set_empty_nickname(self):
 
         '''Non-empty nickname is required.'''
@@ -179,6 +212,113 @@ class LTIEntryViewTest(UserSetUp, TestCase):
         self.assertFalse(user.is_staff)
 
 
+class NicknameAvailabilityViewTest(UserSetUp, TestCase):
+
+    def setUp(self):
+        super(NicknameAvailabilityViewTest, self).setUp()
+        cache.clear()
+
+    def test_anon(self):
+        client = Client()
+        response = client.get(reverse('lti-nickname'), {'nickname': 'Someone'})
+        self.assertEqual(403, response.status_code)
+
+    def test_available(self):
+        get_user_model().objects.create_user('other', first_name='TakenNickname')
+
+        client = Client()
+        self.assertLogin(client, reverse('home'))
+
+        response = client.get(reverse('lti-nickname'), {'nickname': 'FreeNickname'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'nickname': 'FreeNickname', 'available': True},
+                         json.loads(response.content))
+
+        response = client.get(reverse('lti-nickname'), {'nickname': 'takennickname'})
+        data = json.loads(response.content)
+        self.assertFalse(data['available'])
+        self.assertEqual(UserForm.duplicate_nickname_message, data['error'])
+        self.assertEqual('takennickname2', data['suggestions'][0])
+
+    def test_invalid(self):
+        client = Client()
+        self.assertLogin(client, reverse('home'))
+
+        response = client.get(reverse('lti-nickname'), {'nickname': 'not valid'})
+        data = json.loads(response.content)
+        self.assertFalse(data['available'])
+        self.assertEqual('Please enter a valid nickname.', data['error'])
+
+        response = client.get(reverse('lti-nickname'), {'nickname': ' '})
+        data = json.loads(response.content)
+        self.assertFalse(data['available'])
+        self.assertEqual('This field is required.', data['error'])
+
+
+@override_settings(ADELAIDEX_LTI_CONDITIONAL_VIEWS={'ENABLED': True, 'TEMPLATE_VERSION': '1'})
+class ConditionalGetTest(UserSetUp, TestCase):
+
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        cache.clear()
+        self.client = Client()
+        self.assertLogin(self.client, reverse('home'))
+
+    def assertNotModified(self, path):
+        response = self.client.get(path)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        # Unchanged pages aren't rendered again
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('', response.content)
+        self.assertEqual(etag, response['ETag'])
+        return etag
+
+    def test_entry(self):
+        path = reverse('lti-entry')
+        etag = self.assertNotModified(path)
+
+        # Launches don't change the page
+        self.user.save(update_fields=self.user.touch_launch() or ['last_launch'])
+        self.assertEqual(304, self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        # Saving the user does
+        self.user.first_name = 'MyNickname'
+        self.user.save()
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_profile(self):
+        path = '%s?next=%s' % (reverse('lti-user-profile'), reverse('home'))
+        etag = self.assertNotModified(path)
+
+        # The page shows the query string
+        response = self.client.get(reverse('lti-user-profile'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+
+        with override_settings(ADELAIDEX_LTI_CONDITIONAL_VIEWS={'ENABLED': True, 'TEMPLATE_VERSION': '2'}):
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(200, response.status_code)
+
+    def test_cohort_changed(self):
+        path = reverse('lti-entry')
+        etag = self.assertNotModified(path)
+        Cohort.objects.create(title='Other', oauth_key='otherkey', oauth_secret='othersecret',
+                              login_url='http://google.com')
+        self.assertEqual(200, self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code)
+
+    @override_settings(ADELAIDEX_LTI_CONDITIONAL_VIEWS={'ENABLED': False})
+    def test_disabled(self):
+        response = self.client.get(reverse('lti-entry'))
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('ETag', response)
+
+
 class LTIInactiveEntryViewTest(InactiveUserSetUp, TestCase):
     """LTI Login view tests for inactive user"""
 
@@ -544,6 +684,28 @@ class UserProfileViewTest(UserSetUp, TestCase):
         self.assertEqual(user.first_name, form_data['first_name'])
         self.assertEqual(user.time_zone, '')
 
+    def test_post_other_cohort(self):
+        '''The active cohort is loaded from the session, even without ActiveCohortMiddleware'''
+        cohort = Cohort.objects.create(title='Test Cohort', oauth_key='mykey',
+                                       oauth_secret='mysecret', login_url='http://google.com')
+        cohort2 = Cohort.objects.create(title='Test Cohort 2', oauth_key='mykey2',
+                                        oauth_secret='mysecret2', login_url='http://google.com')
+        self.user.cohort = cohort
+        self.user.first_name = 'Alice'
+        self.user.save()
+        CohortMembership.objects.join(self.user, cohort2)
+
+        request = RequestFactory().post(reverse('lti-user-profile'),
+                                        {'first_name': 'Bob', 'cohort': cohort.id})
+        request.user = get_user_model().objects.get(pk=self.user.pk)
+        request.session = {ACTIVE_COHORT_SESSION_KEY: cohort2.pk}
+        response = UserProfileView.as_view()(request)
+        self.assertEqual(302, response.status_code)
+
+        # The nickname is saved to the membership, not the user
+        self.assertEqual(CohortMembership.objects.get(user=self.user, cohort=cohort2).first_name, 'Bob')
+        self.assertEqual(get_user_model().objects.get(pk=self.user.pk).first_name, 'Alice')
+
     def test_post_timezone(self):
         '''Username required, timezone optional'''
         client = Client()
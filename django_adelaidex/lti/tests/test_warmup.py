@@ -0,0 +1,62 @@
+from django.test import TestCase
+from django.apps import apps
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+from django.utils.six import StringIO
+from mock import patch
+
+from django_adelaidex.lti.models import Cohort, User
+from django_adelaidex.lti.registry import cohort_registry
+from django_adelaidex.lti.warmup import warm_up
+
+
+class WarmUpTest(TestCase):
+
+    def setUp(self):
+        super(WarmUpTest, self).setUp()
+        self.cohort = Cohort.objects.create(
+            title='Test Cohort',
+            oauth_key='mykey',
+            oauth_secret='mysecret',
+            login_url='http://google.com',
+        )
+        User.objects.create_user('user1', time_zone='Australia/Adelaide')
+
+    def test_warm_up(self):
+        loaded = warm_up()
+        self.assertEquals(loaded['cohorts'], 1)
+        self.assertEquals(loaded['time_zones'], 2)
+        self.assertEquals(loaded['urls'], 8)
+        self.assertTrue(loaded['templates'] > 0)
+
+        # Launches find the cohort without a query
+        with self.assertNumQueries(0):
+            self.assertEquals(cohort_registry.get('mykey'), self.cohort)
+
+        # And its secrets
+        with self.assertNumQueries(0):
+            self.assertEquals(cohort_registry.secrets('mykey'), [self.cohort.oauth_secret])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('lti_warmup', stdout=out)
+        self.assertIn('Warmed up 1 cohorts.', out.getvalue())
+        self.assertIn('Warmed up 2 time zones.', out.getvalue())
+
+    def test_first_request(self):
+        self.addCleanup(request_started.disconnect, dispatch_uid='lti_warm_up')
+
+        # The app loads without querying the database
+        with self.settings(ADELAIDEX_LTI_WARMUP=True):
+            with self.assertNumQueries(0):
+                apps.get_app_config('lti').ready()
+
+        # And warms up on the first request only
+        cohort_registry.reset()
+        with patch('django_adelaidex.lti.warmup.warm_up', wraps=warm_up) as warm:
+            self.client.get(reverse('home'))
+            self.client.get(reverse('home'))
+        self.assertEquals(warm.call_count, 1)
+        with self.assertNumQueries(0):
+            self.assertEquals(cohort_registry.get('mykey'), self.cohort)
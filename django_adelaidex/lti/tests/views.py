@@ -1,12 +1,10 @@
 import os
-import time
-from random import randint
-from oauth2 import Request, Consumer, SignatureMethod_HMAC_SHA1 as SignatureMethod
 
 from django.views.generic import TemplateView
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django_adelaidex.lti.models import Cohort
+from django_adelaidex.lti.replay import new_nonce, sign_launch
 
 
 class TestDisqusSSOView(TemplateView):
@@ -50,29 +48,14 @@ class TestOauthPostView(TemplateView):
         if not secret:
             return None
 
-        consumer = Consumer(key, secret)
-
-        nonce = ''
-        for i in range(32):
-            nonce = nonce + str(randint(0,9))
-        nonce = int(nonce)
-
         if not uid:
-            uid = str(nonce)
+            uid = new_nonce()
 
-        signer = SignatureMethod()
-        oauth_params = {
-            'oauth_consumer_key': key,
-            'oauth_signature_method': signer.name,
-            'oauth_timestamp': str(int(time.time())),
-            'oauth_nonce': str(nonce),
+        launch_params = {
             'user_id': uid,
-            'oauth_version': '1.0',
             'lti_message_type': 'basic-lti-launch-request',
         }
-        request = Request(method, action, oauth_params)
-        oauth_params['oauth_signature'] = signer.sign(request, consumer, None)
-        return oauth_params
+        return sign_launch(action, launch_params, key, secret, method)
 
     def get_context_data(self, **kwargs):
         context = super(TestOauthPostView, self).get_context_data(**kwargs)
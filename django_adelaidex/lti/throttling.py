@@ -0,0 +1,122 @@
+'''
+Fixed window rate limiting for LTI launches, per oauth consumer key and per username.
+
+Launches are counted in the Django cache with atomic add() and incr() calls, so the
+counts are shared between worker processes, and concurrent launches can't both take
+the last slot.  Each process also remembers which buckets it has seen run dry, so
+repeated launches from a throttled client are refused without a cache round trip.
+'''
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+import hashlib
+import threading
+import time
+
+
+class LaunchThrottled(PermissionDenied):
+    '''Raised by CohortLTIAuthBackend when a launch exceeds its rate limit.'''
+
+    def __init__(self, retry_after):
+        super(LaunchThrottled, self).__init__('LTI launch rate limit exceeded')
+        self.retry_after = retry_after
+
+
+def throttle_settings():
+    '''Return settings.ADELAIDEX_LTI_THROTTLE, with defaults filled in.
+
+       Rates are launches per minute, and are used for Cohorts without their own
+       limits.  None means unlimited.'''
+    conf = {
+        'KEY_RATE': None,
+        'USER_RATE': None,
+    }
+    conf.update(getattr(settings, 'ADELAIDEX_LTI_THROTTLE', {}))
+    return conf
+
+
+class FixedWindow(object):
+
+    # Stop remembering dry buckets locally once there are this many
+    max_blocked = 10000
+
+    def __init__(self, prefix='lti-throttle'):
+        self.prefix = prefix
+        self.blocked_until = {}
+        self.lock = threading.Lock()
+
+    def cache_key(self, key, window):
+        return '%s:%s:%d' % (self.prefix, hashlib.md5(key.encode('utf-8')).hexdigest(), window)
+
+    def consume(self, key, rate, capacity=None, now=None):
+        '''Count a launch against the named bucket, which allows capacity launches
+           (default: rate) in each window of capacity / rate minutes.  Windows start at
+           multiples of their length, so all processes agree on them.
+
+           Returns 0 if the launch is allowed, or else the number of seconds until the
+           next window starts.'''
+        if not now:
+            now = time.time()
+
+        blocked_until = self.blocked_until.get(key)
+        if blocked_until:
+            if now < blocked_until:
+                return blocked_until - now
+            with self.lock:
+                self.blocked_until.pop(key, None)
+
+        if not capacity:
+            capacity = rate
+        length = capacity * 60.0 / rate
+        window = int(now // length)
+        cache_key = self.cache_key(key, window)
+        timeout = int(length) + 60
+
+        if cache.add(cache_key, 1, timeout):
+            count = 1
+        else:
+            try:
+                count = cache.incr(cache_key)
+            except ValueError:
+                # expired since the add
+                cache.add(cache_key, 1, timeout)
+                count = 1
+        if count <= capacity:
+            return 0
+
+        retry_after = (window + 1) * length - now
+        with self.lock:
+            if len(self.blocked_until) >= self.max_blocked:
+                self.blocked_until = dict((k, t) for (k, t) in self.blocked_until.items() if t > now)
+            self.blocked_until[key] = now + retry_after
+        return retry_after
+
+    def reset(self):
+        with self.lock:
+            self.blocked_until = {}
+
+
+launch_buckets = FixedWindow()
+
+
+def throttle_key(consumer_key, cohort=None):
+    '''Return 0 if a launch with the consumer key may proceed, or the seconds to wait
+       before retrying.  This runs before the launch signature is checked.
+
+       Uses the cohort's launch rate limit if set, or else ADELAIDEX_LTI_THROTTLE.'''
+    key_rate = (cohort and cohort.launch_rate_limit) or throttle_settings()['KEY_RATE']
+    if key_rate:
+        return launch_buckets.consume(u'key:%s' % consumer_key, key_rate)
+    return 0
+
+
+def throttle_user(consumer_key, username, cohort=None):
+    '''Return 0 if the user's launch may proceed, or the seconds to wait before
+       retrying.  Only call this once the launch signature is verified, so forged
+       launches can't use up a user's launches.
+
+       Uses the cohort's user launch rate limit if set, or else ADELAIDEX_LTI_THROTTLE.'''
+    user_rate = (cohort and cohort.user_launch_rate_limit) or throttle_settings()['USER_RATE']
+    if user_rate and username:
+        return launch_buckets.consume(u'user:%s:%s' % (consumer_key, username), user_rate)
+    return 0
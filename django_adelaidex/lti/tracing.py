@@ -0,0 +1,174 @@
+'''
+Lightweight tracing spans around the LTI launch, cohort resolution and rendering.
+
+By default spans are no-ops.  Point settings.ADELAIDEX_LTI_TRACING['TRACER'] at a tracer
+class (or instance) with a ``span(name, **attributes)`` method returning a context
+manager, to record them, e.g. the bundled JSONLinesTracer:
+
+    ADELAIDEX_LTI_TRACING = {
+        'TRACER': 'django_adelaidex.lti.tracing.JSONLinesTracer',
+        'FILE': '/var/log/myapp/spans.jsonl',
+    }
+'''
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from functools import wraps
+import binascii
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class NoopSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+class NoopTracer(object):
+
+    noop_span = NoopSpan()
+
+    def span(self, name, **attributes):
+        return self.noop_span
+
+
+class Span(object):
+    '''A timed span, nested under whichever span is open on the current thread.'''
+
+    local = threading.local()
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = new_id(8)
+        self.trace_id = None
+        self.parent_id = None
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        if stack:
+            self.trace_id = stack[-1].trace_id
+            self.parent_id = stack[-1].span_id
+        else:
+            self.trace_id = new_id(16)
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        stack = self.local.stack
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.tracer.export(self)
+        return False
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+            'pid': os.getpid(),
+        }
+
+
+class JSONLinesTracer(object):
+    '''Appends each finished span as a line of JSON to ADELAIDEX_LTI_TRACING['FILE'].'''
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = getattr(settings, 'ADELAIDEX_LTI_TRACING', {}).get('FILE', 'lti-spans.jsonl')
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def span(self, name, **attributes):
+        return Span(self, name, attributes)
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), default=str)
+        try:
+            with self.lock:
+                with open(self.filename, 'a') as spans:
+                    spans.write(line + '\n')
+        except (IOError, OSError):
+            logger.exception('Could not write span to %s' % self.filename)
+
+
+def new_id(size):
+    return binascii.hexlify(os.urandom(size))
+
+
+_tracer = None
+
+
+def get_tracer():
+    '''Return the configured tracer, creating it on first use.'''
+    global _tracer
+    if _tracer is None:
+        tracer = getattr(settings, 'ADELAIDEX_LTI_TRACING', {}).get('TRACER')
+        if not tracer:
+            tracer = NoopTracer()
+        else:
+            if isinstance(tracer, basestring):
+                tracer = import_string(tracer)
+            if isinstance(tracer, type):
+                tracer = tracer()
+        _tracer = tracer
+    return _tracer
+
+
+@receiver(setting_changed)
+def reset_tracer(sender, setting=None, **kwargs):
+    global _tracer
+    if setting == 'ADELAIDEX_LTI_TRACING':
+        _tracer = None
+
+
+def enabled():
+    '''Return True if a tracer is configured.'''
+    return not isinstance(get_tracer(), NoopTracer)
+
+
+def span(name, **attributes):
+    '''Return a context manager tracing the enclosed code as the named span.'''
+    return get_tracer().span(name, **attributes)
+
+
+def traced(name):
+    '''Decorator which traces each call to the decorated function as the named span.'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_tracer().span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -15,4 +15,8 @@ urlpatterns = [
         name='lti-enrol'),
     url(r'^inactive', views.LTIInactiveView.as_view(),
         name='lti-inactive'),
+    url(r'^nickname', views.NicknameAvailabilityView.as_view(),
+        name='lti-nickname'),
+    url(r'^metrics', views.MetricsView.as_view(),
+        name='lti-metrics'),
 ]
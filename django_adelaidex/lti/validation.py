@@ -0,0 +1,95 @@
+'''
+Cheap checks run on each LTI launch before any signature verification or user writes.
+
+The checks run in order, cheapest first, and the first failure rejects the launch
+with a LaunchRejected error naming the reason.
+'''
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+import time
+
+from django_adelaidex.lti import metrics
+from django_adelaidex.lti.conf import get_config
+from django_adelaidex.lti.registry import cohort_registry
+
+
+REQUIRED_PARAMS = (
+    'oauth_consumer_key',
+    'oauth_nonce',
+    'oauth_signature',
+    'oauth_signature_method',
+    'oauth_timestamp',
+    'lti_message_type',
+)
+
+MESSAGE_TYPES = ('basic-lti-launch-request',)
+
+SIGNATURE_METHODS = ('HMAC-SHA1',)
+
+
+class LaunchRejected(PermissionDenied):
+    '''Raised when a launch fails pre-validation.'''
+
+    def __init__(self, reason, message):
+        super(LaunchRejected, self).__init__(message)
+        self.reason = reason
+
+
+def check_required_params(params, now):
+    missing = [name for name in REQUIRED_PARAMS if not params.get(name)]
+    if missing:
+        raise LaunchRejected('missing_params', 'Missing LTI parameters: %s' % ', '.join(missing))
+
+
+def check_message_type(params, now):
+    message_type = params.get('lti_message_type')
+    if message_type not in MESSAGE_TYPES:
+        raise LaunchRejected('message_type', 'Unsupported lti_message_type: %s' % message_type)
+
+
+def check_signature_method(params, now):
+    method = params.get('oauth_signature_method')
+    if method not in SIGNATURE_METHODS:
+        raise LaunchRejected('signature_method', 'Unsupported oauth_signature_method: %s' % method)
+
+
+def check_timestamp(params, now):
+    '''Timestamps must be within ADELAIDEX_LTI_TIMESTAMP_WINDOW seconds (default 1 hour)
+       of the server clock.'''
+    window = getattr(settings, 'ADELAIDEX_LTI_TIMESTAMP_WINDOW', 60 * 60)
+    try:
+        timestamp = int(params.get('oauth_timestamp'))
+    except (TypeError, ValueError):
+        raise LaunchRejected('timestamp', 'Invalid oauth_timestamp')
+    if abs(now - timestamp) > window:
+        raise LaunchRejected('timestamp', 'oauth_timestamp is outside the allowed window')
+
+
+VALIDATORS = (
+    check_required_params,
+    check_message_type,
+    check_signature_method,
+    check_timestamp,
+)
+
+
+def validate_launch(params, now=None):
+    '''Run the pre-validation checks over the launch params, then find the launch's
+       consumer key in settings.LTI_OAUTH_CREDENTIALS or the Cohort registry.
+
+       Returns the Cohort for the consumer key, if any.  Raises LaunchRejected if any
+       check fails, or the consumer key is unknown.'''
+    if not now:
+        now = time.time()
+    try:
+        for validator in VALIDATORS:
+            validator(params, now)
+
+        oauth_key = params.get('oauth_consumer_key')
+        cohort = cohort_registry.get(oauth_key)
+        if not cohort and not get_config().has_oauth_key(oauth_key):
+            raise LaunchRejected('unknown_key', 'Unknown oauth_consumer_key: %s' % oauth_key)
+    except LaunchRejected as rejected:
+        metrics.launch_rejections.inc(reason=rejected.reason)
+        raise
+    return cohort
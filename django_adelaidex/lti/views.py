@@ -1,13 +1,15 @@
-from django.views.generic import UpdateView, TemplateView, RedirectView
+from django.views.generic import UpdateView, TemplateView, RedirectView, View
 from django_auth_lti.mixins import LTIUtilityMixin, LTIRoleRestrictionMixin
 from django.core.urlresolvers import reverse, resolve, get_script_prefix
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, JsonResponse, Http404
 from django.utils.http import is_safe_url
 from django.shortcuts import get_object_or_404
+from django.core.exceptions import ValidationError
 from django_adelaidex.util.mixins import TemplatePathMixin, CSRFExemptMixin, LoggedInMixin
-from django_adelaidex.lti.models import UserForm, Cohort
+from django_adelaidex.lti.models import UserForm, Cohort, activate_session_cohort
+from django_adelaidex.lti import conditional, metrics, pages, tracing
 import re
 import pickle
 
@@ -17,16 +19,28 @@ class UserViewMixin(object):
     model = UserForm._meta.model
 
     def get_object(self):
-        '''This view's object is the current user'''
+        '''This view's object is the current user, with the nickname and staff role of
+           their active CohortMembership, if any.  The membership is loaded from the
+           session here if ActiveCohortMiddleware hasn't already, so the form never saves
+           another cohort's nickname to the user's own.'''
         if self.request.user.is_authenticated():
-            return get_object_or_404(self.model, pk=self.request.user.id)
+            user = get_object_or_404(self.model, pk=self.request.user.id)
+            membership = activate_session_cohort(self.request.user, self.request.session)
+            if membership:
+                user.activate_membership(membership)
+                user.first_name = membership.first_name
+            return user
         else:
             return HttpResponseRedirect(reverse('lti-403'))
 
     def form_valid(self, form):
         # Set cohort to current user's cohort
         form.instance.cohort = self.request.user.cohort
-        return super(UserViewMixin, self).form_valid(form)
+
+        # Save fails if the nickname was taken in the meantime
+        if form.save() is None:
+            return self.form_invalid(form)
+        return HttpResponseRedirect(self.get_success_url())
 
     def get_success_url(self, next_param=None, default='home'):
 
@@ -52,20 +66,104 @@ class UserViewMixin(object):
         return reverse(url_name, kwargs=kwargs)
 
 
-class UserProfileView(LoggedInMixin, UserViewMixin, TemplatePathMixin, UpdateView):
+class ConditionalGetMixin(object):
+    '''Answers authenticated GETs with a weak ETag for the current user's page, and a
+       304 Not Modified if the browser already has it, if enabled in
+       django_adelaidex.lti.conditional.'''
+    page_name = None
+
+    def get(self, request, *args, **kwargs):
+        etag = None
+        if conditional.serves(request):
+            etag = conditional.user_etag(request, request.user, self.template_name)
+            response = conditional.not_modified_response(request, self.page_name, etag)
+            if response is not None:
+                return response
+
+        response = super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        if etag:
+            conditional.set_etag(response, etag)
+        return response
+
+
+class UserProfileView(LoggedInMixin, ConditionalGetMixin, UserViewMixin, TemplatePathMixin, UpdateView):
     TemplatePathMixin.template_dir = 'django_adelaidex_lti'
     template_name = TemplatePathMixin.prepend_template_path('profile.html')
+    page_name = 'lti-user-profile'
+
 
+class NicknameAvailabilityView(View):
+    '''Lets the profile and entry forms check whether a nickname is free in the
+       current user's cohort, as the student types.'''
 
-class LTIPermissionDeniedView(TemplatePathMixin, TemplateView):
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            return JsonResponse({'error': 'Login required.'}, status=403)
+
+        nickname = request.GET.get('nickname', '').strip()
+        data = {'nickname': nickname, 'available': False}
+
+        model = UserViewMixin.model
+        try:
+            if not nickname:
+                raise ValidationError('This field is required.')
+            model._meta.get_field('first_name').run_validators(nickname)
+        except ValidationError as e:
+            data['error'] = ' '.join(e.messages)
+            return JsonResponse(data)
+
+        data['available'] = model.objects.nickname_available(nickname, request.user)
+        if not data['available']:
+            data['error'] = UserForm.duplicate_nickname_message
+            data['suggestions'] = model.objects.suggest_nicknames(nickname, request.user)
+        return JsonResponse(data)
+
+
+class PrerenderedPageMixin(object):
+    '''Serves anonymous GETs from the page pre-rendered by django_adelaidex.lti.pages,
+       if enabled.'''
+    page_name = None
+
+    def get(self, request, *args, **kwargs):
+        if pages.serves(request):
+            return pages.page_response(request, self.page_name)
+        return super(PrerenderedPageMixin, self).get(request, *args, **kwargs)
+
+
+class LTIPermissionDeniedView(PrerenderedPageMixin, TemplatePathMixin, TemplateView):
 
     TemplatePathMixin.template_dir = 'django_adelaidex_lti'
     template_name = TemplatePathMixin.prepend_template_path('lti-403.html')
+    page_name = 'lti-403'
 
+    def get(self, request, *args, **kwargs):
+        metrics.permission_denied.inc(source='lti-403')
+        return super(LTIPermissionDeniedView, self).get(request, *args, **kwargs)
 
-class LTIInactiveView(CSRFExemptMixin, TemplatePathMixin, TemplateView):
+
+class LTIInactiveView(CSRFExemptMixin, PrerenderedPageMixin, TemplatePathMixin, TemplateView):
     TemplatePathMixin.template_dir = 'django_adelaidex_lti'
     template_name = TemplatePathMixin.prepend_template_path('lti-inactive.html')
+    page_name = 'lti-inactive'
+
+
+class MetricsView(View):
+    '''Exposes the LTI metrics in Prometheus text format.
+
+       Must be enabled with settings.ADELAIDEX_LTI_METRICS['ENABLED'], and is only
+       shown to staff, or to requests from the ADELAIDEX_LTI_METRICS['ALLOWED_IPS'].'''
+
+    def get(self, request, *args, **kwargs):
+        conf = metrics.metrics_settings()
+        if not conf['ENABLED']:
+            raise Http404
+
+        user = getattr(request, 'user', None)
+        is_staff = user and user.is_authenticated() and user.is_staff
+        if not is_staff and request.META.get('REMOTE_ADDR') not in conf['ALLOWED_IPS']:
+            return HttpResponseForbidden()
+
+        return HttpResponse(metrics.registry.expose(), content_type=metrics.CONTENT_TYPE)
 
 
 class LTIRedirectView(RedirectView):
@@ -74,6 +172,7 @@ class LTIRedirectView(RedirectView):
     permanent=False
 
     # Store current GET parms to a cookie, to be used by LTIEntryView.get_success_url()
+    @tracing.traced('lti.view.redirect')
     def dispatch(self, *args, **kwargs):
 
         if 'redirect_url' in kwargs:
@@ -118,11 +217,22 @@ class LTIEnrolRedirectView(LTIRedirectView):
         return cohort.enrol_url if cohort else None
 
 
-class LTIEntryView(UserViewMixin, CSRFExemptMixin, LTIUtilityMixin, TemplatePathMixin, UpdateView):
+class LTIEntryView(ConditionalGetMixin, UserViewMixin, CSRFExemptMixin, LTIUtilityMixin, TemplatePathMixin, UpdateView):
 
     TemplatePathMixin.template_dir = 'django_adelaidex_lti'
     template_name = TemplatePathMixin.prepend_template_path('lti-entry.html')
+    page_name = 'lti-entry'
+
+    def render_to_response(self, context, **response_kwargs):
+        '''If tracing, render within the view span, so rendering time is traced too.
+           Otherwise leave the response lazy, for template response middleware.'''
+        response = super(LTIEntryView, self).render_to_response(context, **response_kwargs)
+        if tracing.enabled():
+            with tracing.span('lti.render', template=self.template_name):
+                response.render()
+        return response
 
+    @tracing.traced('lti.view.entry')
     def get(self, request, *args, **kwargs):
         if self.request.user.is_authenticated():
             if self.request.user.is_active:
@@ -132,6 +242,7 @@ class LTIEntryView(UserViewMixin, CSRFExemptMixin, LTIUtilityMixin, TemplatePath
 
         return HttpResponseRedirect('%s?%s=%s' % (reverse('login'), REDIRECT_FIELD_NAME, self.request.get_full_path()))
 
+    @tracing.traced('lti.view.entry')
     def post(self, request, *args, **kwargs):
         '''Bypass this form if we already have a user.first_name 
            (and we're not trying to POST an update).'''
@@ -157,6 +268,8 @@ class LTIEntryView(UserViewMixin, CSRFExemptMixin, LTIUtilityMixin, TemplatePath
             form.instance.is_staff = False
 
         response = super(LTIEntryView, self).form_valid(form)
+        if form.errors:
+            return response
 
         # clear out the persistent LTI parameters; 
         # they've been used by get_success_url()
@@ -0,0 +1,122 @@
+'''
+Warm up the LTI app's caches before a worker accepts traffic, so the first launches
+after a deploy don't pay for them.
+
+Run it from your WSGI script, after the application is created:
+
+    application = get_wsgi_application()
+
+    from django_adelaidex.lti.warmup import warm_up
+    warm_up()
+
+or set settings.ADELAIDEX_LTI_WARMUP = True to run it at the start of each process's
+first request, or run `manage.py lti_warmup` to check what it loads.  It isn't run
+from AppConfig.ready(), since that also runs for management commands, and before
+migrate has created the tables.
+'''
+from django.conf import settings
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.db import DatabaseError
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
+from django.template.loader import get_template
+import logging
+import os
+import pytz
+import threading
+
+from django_adelaidex.lti import urls
+from django_adelaidex.lti.models import Cohort, User
+from django_adelaidex.lti.registry import cohort_registry
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+def warm_cohorts():
+    '''Load every Cohort and its credentials into the registry, and look up the default cohort.'''
+    cohorts = list(Cohort.objects.prefetch_related('credentials'))
+    for cohort in cohorts:
+        cohort_registry.set(cohort.oauth_key, cohort, credentials=cohort.credentials.all())
+    Cohort.objects.get_current()
+    return len(cohorts)
+
+
+def warm_time_zones():
+    '''Load the pytz zones chosen by users, and the default zone.'''
+    names = set(User.objects.exclude(time_zone__isnull=True).exclude(time_zone='')
+                    .values_list('time_zone', flat=True).distinct())
+    names.add(settings.TIME_ZONE)
+    loaded = 0
+    for name in names:
+        try:
+            pytz.timezone(name)
+            loaded += 1
+        except pytz.UnknownTimeZoneError:
+            logger.warning('Unknown time zone %s' % name)
+    return loaded
+
+
+def warm_urls():
+    '''Reverse the lti-* urls, populating the URL resolver.'''
+    reversed_urls = 0
+    for pattern in urls.urlpatterns:
+        try:
+            reverse(pattern.name)
+            reversed_urls += 1
+        except NoReverseMatch:
+            logger.debug('Could not reverse %s' % pattern.name)
+    return reversed_urls
+
+
+def warm_templates():
+    '''Compile the django_adelaidex_lti templates.'''
+    compiled = 0
+    for (directory, subdirectories, filenames) in os.walk(TEMPLATE_DIR):
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(directory, filename), TEMPLATE_DIR)
+            try:
+                get_template(name)
+                compiled += 1
+            except (TemplateDoesNotExist, TemplateSyntaxError):
+                logger.warning('Could not compile template %s' % name, exc_info=True)
+    return compiled
+
+
+def warm_up(fail_silently=False):
+    '''Warm up the caches, and return the number of items loaded into each.'''
+    loaded = {}
+    for (name, warmer) in (('cohorts', warm_cohorts),
+                           ('time_zones', warm_time_zones),
+                           ('urls', warm_urls),
+                           ('templates', warm_templates)):
+        try:
+            loaded[name] = warmer()
+        except DatabaseError:
+            # e.g. running migrate on a new database
+            if not fail_silently:
+                raise
+            logger.warning('Could not warm up %s' % name, exc_info=True)
+    return loaded
+
+
+_warmed_up = False
+_warm_up_lock = threading.Lock()
+
+
+def warm_up_on_first_request():
+    '''Warm up the caches at the start of this process's first request.'''
+    global _warmed_up
+    _warmed_up = False
+    request_started.connect(first_request_started, dispatch_uid='lti_warm_up')
+
+
+def first_request_started(sender, **kwargs):
+    global _warmed_up
+    with _warm_up_lock:
+        if _warmed_up:
+            return
+        _warmed_up = True
+    request_started.disconnect(dispatch_uid='lti_warm_up')
+    warm_up(fail_silently=True)
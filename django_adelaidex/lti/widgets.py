@@ -0,0 +1,36 @@
+from django.utils.encoding import force_text
+from django.utils.html import conditional_escape
+from django.utils.translation import get_language
+import threading
+
+from django_adelaidex.util.widgets import SelectTimeZoneWidget
+
+
+class CachedSelectTimeZoneWidget(SelectTimeZoneWidget):
+    '''A SelectTimeZoneWidget which renders its hundreds of <option>s once per process
+       and language, and then only marks the selected option on each render.'''
+
+    # {language: (choices, rendered options)}
+    rendered_options = {}
+    lock = threading.Lock()
+
+    def render_options(self, choices, selected_choices):
+        if choices:
+            return super(CachedSelectTimeZoneWidget, self).render_options(choices, selected_choices)
+
+        language = get_language()
+        cached = self.rendered_options.get(language)
+        if cached is None or cached[0] != self.choices:
+            options = super(CachedSelectTimeZoneWidget, self).render_options((), [])
+            cached = (list(self.choices), options)
+            with self.lock:
+                self.rendered_options[language] = cached
+        options = cached[1]
+
+        for value in selected_choices:
+            value = conditional_escape(force_text('' if value is None else value))
+            option = u'<option value="%s">' % value
+            if option in options:
+                # only one option may be selected, as Select.render_option does
+                return options.replace(option, u'<option value="%s" selected="selected">' % value, 1)
+        return options